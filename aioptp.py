@@ -0,0 +1,452 @@
+# v2
+'''
+asyncio transport of the PTP protocol: the same segments as sender.py / receiver.py, driven by an event loop
+instead of blocking sockets, threads and sleeps, so many transfers can run in one process.
+
+    size = await send_file("file.bin", ("127.0.0.1", 9000), max_win=50000, rot=100)
+    size = await receive_file("received.bin", ("127.0.0.1", 9000))
+
+All the retransmission timers of a connection (SYN, DATA, FIN) live in one heap served by a single
+loop.call_at handle, instead of one socket timeout per segment.
+'''
+import asyncio
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import random
+
+from congestion import CONTROLLERS
+from ptp import TYPE_DICT, SEQ_MODULO, OPT_WIDE_SEQ, OPT_FILE_SIZE, OPT_MSS, MAX_MSS, pack_header, unpack_header, unwrap_seq, \
+    pack_sack, unpack_sack, pack_options, unpack_options
+from sender import SEGMENT_SIZE, DUP_ACK_THRESHOLD, MIN_RTO, MAX_RTO, CLOCK_GRANULARITY, GIVE_UP_TIME
+from receiver import MAX_SACK_BLOCKS, RCV_WINDOW, WRITE_COALESCE, OutputFile
+
+FIN_LINGER = 1.0  # seconds the receiver keeps acking resent FINs once the transfer is complete
+
+
+class TimerHeap:
+    '''
+    Retransmission timers of one connection: (deadline, key, generation) entries in a heap and one call_at
+    handle for the earliest deadline. Entries are never removed, the callback drops stale generations.
+    '''
+    def __init__(self, loop, callback) -> None:
+        self.loop = loop
+        self.callback = callback  # callback(key, generation)
+        self.heap = []
+        self.counter = itertools.count()  # tie-break, keys are not comparable
+        self.handle = None
+        self.handle_when = None
+
+    def schedule(self, deadline: float, key, generation: int) -> None:
+        heapq.heappush(self.heap, (deadline, next(self.counter), key, generation))
+        if self.handle_when is None or deadline < self.handle_when:
+            self.arm()
+
+    def arm(self) -> None:
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = None
+        self.handle_when = None
+        if self.heap:
+            self.handle_when = self.heap[0][0]
+            self.handle = self.loop.call_at(self.handle_when, self.fire)
+
+    def fire(self) -> None:
+        self.handle = None
+        self.handle_when = None
+        now = self.loop.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, key, generation = heapq.heappop(self.heap)
+            self.callback(key, generation)
+        self.arm()
+
+    def cancel(self) -> None:
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = None
+        self.handle_when = None
+        self.heap.clear()
+
+
+class SenderProtocol(asyncio.DatagramProtocol):
+    def __init__(self, filename: str, max_win: int, rot: int, give_up_time: float = GIVE_UP_TIME,
+                 wide_seq: bool = True, cc: str = "reno", mss: int = SEGMENT_SIZE) -> None:
+        '''
+        :param filename: the file to send, memory-mapped and sent as bytes.
+        :param max_win: the maximum window size in bytes, the upper limit of the congestion window.
+        :param rot: the initial retransmission timer in milliseconds.
+        :param give_up_time: seconds a segment may stay unacked before the connection is reset.
+        :param wide_seq: offer 64-bit sequence numbers in the SYN.
+        :param cc: congestion controller, one of congestion.CONTROLLERS.
+        :param mss: the DATA payload size offered in the SYN, the receiver may lower it.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()  # result: bytes sent
+        self.transport = None
+        self.state = "CLOSED"
+
+        self.file_map = None
+        self.file_view = None
+        with open(filename, "rb") as file:
+            self.file_size = os.fstat(file.fileno()).st_size
+            if self.file_size > 0:  # an empty file cannot be mapped
+                self.file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.file_view = memoryview(self.file_map)
+        self.offer_mss = min(max(int(mss), 1), MAX_MSS)
+        self.mss = min(SEGMENT_SIZE, self.offer_mss)  # until the SYN ACK
+        self.packets_num = -(-self.file_size // self.mss)
+
+        self.timeout = int(rot) / 1000  # current RTO, the DATA timers back it off per segment
+        self.srtt = None
+        self.rttvar = None
+        self.last_timeout = 0  # time of the last DATA timeout event
+        self.give_up_time = float(give_up_time)
+        self.timers = TimerHeap(self.loop, self.on_timer)
+
+        self.offer_wide_seq = wide_seq
+        self.wide_seq = False
+        self.isn = random.randint(0, SEQ_MODULO - 1)
+        self.data_isn = self.isn + 1
+        self.fin_seq = self.data_isn + self.file_size
+
+        self.send_base = 0
+        self.next_num = 0
+        self.bytes_in_flight = 0
+        self.in_flight = {}  # num : [send_time, send_times, first_send_time]
+        self.control = {}  # "SYN"/"FIN" : [send_time, send_times, first_send_time]
+        self.sacked_num = set()
+        self.max_win = int(max_win)
+        self.cc_name = cc
+        self.cc = CONTROLLERS[cc](self.mss, self.max_win)
+        self.dup_acks = 0
+        self.recover_num = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        self.state = "SYN_SENT"
+        self.send_control("SYN")
+
+    def datagram_received(self, data, addr) -> None:
+        if self.done.done():
+            return
+        if self.state == "SYN_SENT":
+            rev_type_no, rev_ack_no, payload_start = unpack_header(data)
+            if rev_type_no == TYPE_DICT["ACK"] and rev_ack_no == (self.isn + 1) % SEQ_MODULO:
+                self.rtt_sample(self.control.pop("SYN"))
+                syn_options = unpack_options(data[payload_start:])
+                self.wide_seq = OPT_WIDE_SEQ in syn_options
+                if OPT_MSS in syn_options:
+                    self.mss = min(int.from_bytes(syn_options[OPT_MSS], byteorder='big'), self.offer_mss)
+                max_win = self.max_win
+                if not self.wide_seq:
+                    # the window has to span less than half of the 2-byte sequence space
+                    self.mss = min(self.mss, SEQ_MODULO // 4)
+                    max_win = min(max_win, SEQ_MODULO // 2 - self.mss)
+                self.packets_num = -(-self.file_size // self.mss)
+                self.cc = CONTROLLERS[self.cc_name](self.mss, max_win)
+                self.state = "ESTABLISHED"
+                self.fill_window()
+            return
+
+        rev_type_no, rev_ack_no, payload_start = unpack_header(data, self.wide_seq)
+        if rev_type_no == TYPE_DICT["RESET"]:
+            self.fail(ConnectionResetError("reset by the receiver"), send_reset=False)
+        elif rev_type_no != TYPE_DICT["ACK"]:
+            return
+        elif self.state == "ESTABLISHED":
+            base_seq = self.data_isn + self.send_base * self.mss
+            self.ack_window(unwrap_seq(rev_ack_no, base_seq, self.wide_seq) - self.data_isn)
+            for start, end in unpack_sack(data[payload_start:], self.wide_seq):
+                self.sack_window(unwrap_seq(start, base_seq, self.wide_seq) - self.data_isn,
+                                 unwrap_seq(end, base_seq, self.wide_seq) - self.data_isn)
+            self.fill_window()
+        elif self.state == "FIN_WAIT" and unwrap_seq(rev_ack_no, self.fin_seq + 1, self.wide_seq) == self.fin_seq + 1:
+            self.rtt_sample(self.control.pop("FIN"))
+            self.close()
+            self.done.set_result(self.file_size)
+
+    def error_received(self, exc) -> None:
+        # e.g. ICMP port unreachable before the receiver is up, the timers resend
+        logging.debug(f"sender socket error: {exc}")
+
+    def connection_lost(self, exc) -> None:
+        if not self.done.done():
+            self.done.set_exception(exc or ConnectionError("socket closed"))
+
+    # sending
+    def send_control(self, type_name: str) -> None:
+        now = self.loop.time()
+        entry = self.control.setdefault(type_name, [now, 0, now])
+        entry[0] = now
+        entry[1] += 1
+        if type_name == "SYN":
+            options = {OPT_FILE_SIZE: self.file_size.to_bytes(8, byteorder='big'),
+                       OPT_MSS: self.offer_mss.to_bytes(2, byteorder='big')}
+            if self.offer_wide_seq:
+                options[OPT_WIDE_SEQ] = b''
+            msg = pack_header(TYPE_DICT["SYN"], self.isn) + pack_options(options)
+        else:
+            msg = pack_header(TYPE_DICT[type_name], self.fin_seq, self.wide_seq)
+        self.transport.sendto(msg)
+        self.timers.schedule(now + self.timeout, type_name, entry[1])
+
+    def send_DATA(self, num: int) -> None:
+        offset = num * self.mss
+        length = min(self.mss, self.file_size - offset)
+        self.transport.sendto(pack_header(TYPE_DICT["DATA"], self.data_isn + offset, self.wide_seq) +
+                              self.file_view[offset:offset + length])
+        now = self.loop.time()
+        entry = self.in_flight[num]
+        entry[0] = now
+        entry[1] += 1
+        self.timers.schedule(now + self.segment_rto(entry[1]), num, entry[1])
+
+    def fill_window(self) -> None:
+        # keep min(cwnd, max_win) bytes in flight, at least one segment
+        while self.next_num < self.packets_num:
+            length = min(self.mss, self.file_size - self.next_num * self.mss)
+            if self.bytes_in_flight > 0 and self.bytes_in_flight + length > self.cc.window:
+                break
+            now = self.loop.time()
+            self.in_flight[self.next_num] = [now, 0, now]
+            self.bytes_in_flight += length
+            self.send_DATA(self.next_num)
+            self.next_num += 1
+        if self.send_base == self.packets_num and self.state == "ESTABLISHED":
+            self.state = "FIN_WAIT"
+            self.send_control("FIN")
+
+    # acknowledgements
+    def ack_window(self, ack_offset: int) -> None:
+        if ack_offset % self.mss != 0 and ack_offset != self.file_size:
+            return
+        num = -(-ack_offset // self.mss)
+        if num == self.send_base and self.in_flight:
+            self.dup_ack()
+            return
+        if num <= self.send_base or num > self.next_num:
+            return
+        # Karn's rule: no sample from an ACK that waited for a resent hole below or for a selectively acked segment
+        if num - 1 not in self.sacked_num and all(self.in_flight[n][1] == 1 for n in range(self.send_base, num)):
+            self.rtt_sample(self.in_flight[num - 1])
+        acked_bytes = 0
+        for acked_num in range(self.send_base, num):
+            acked_bytes += min(self.mss, self.file_size - acked_num * self.mss)
+            del self.in_flight[acked_num]
+            self.sacked_num.discard(acked_num)
+        self.bytes_in_flight -= acked_bytes
+        self.send_base = num
+        self.dup_acks = 0
+        if self.recover_num is None:
+            self.cc.on_ack(acked_bytes, self.loop.time(), self.srtt)
+        elif self.send_base >= self.recover_num:
+            self.recover_num = None
+            self.cc.exit_recovery()
+        elif self.send_base < self.next_num:
+            self.cc.on_partial_ack(acked_bytes)
+            self.fast_retransmit(self.send_base)
+
+    def sack_window(self, start: int, end: int) -> None:
+        for num in range(max(self.send_base, start // self.mss), min(self.next_num, -(-end // self.mss))):
+            if start <= num * self.mss < end:
+                self.sacked_num.add(num)
+
+    def dup_ack(self) -> None:
+        self.dup_acks += 1
+        if self.recover_num is not None:
+            self.cc.on_dup_ack()
+        elif self.dup_acks == DUP_ACK_THRESHOLD:
+            self.recover_num = self.next_num
+            self.cc.on_fast_loss(self.bytes_in_flight, self.loop.time())
+            self.fast_retransmit(self.send_base)
+
+    def fast_retransmit(self, num: int) -> None:
+        if num not in self.sacked_num:
+            self.send_DATA(num)
+
+    # timers
+    def on_timer(self, key, generation: int) -> None:
+        entry = self.control.get(key) if key in ("SYN", "FIN") else self.in_flight.get(key)
+        if entry is None or entry[1] != generation or key in self.sacked_num or self.done.done():
+            return  # acked, resent since, or selectively acked
+        now = self.loop.time()
+        if now - entry[2] > self.give_up_time:
+            self.fail(ConnectionError(f"no ACK for {key} within {self.give_up_time}s"))
+            return
+        logging.debug(f"Timeout! Resend {key}")
+        if key in ("SYN", "FIN"):
+            self.timeout = min(self.timeout * 2, MAX_RTO)  # kept until the next valid RTT sample
+            self.send_control(key)
+            return
+        if entry[0] >= self.last_timeout:
+            # segments of a window lost together expire one after the other: one congestion event
+            self.last_timeout = now
+            self.cc.on_timeout(self.bytes_in_flight, now)
+            self.recover_num = None
+            self.dup_acks = 0
+        self.send_DATA(key)
+
+    def segment_rto(self, send_times: int) -> float:
+        # the timer of a segment sent send_times times, doubled by each of its retransmissions (RFC 6298 5.5)
+        return min(self.timeout * 2 ** max(send_times - 1, 0), MAX_RTO)
+
+    def rtt_sample(self, entry) -> None:
+        send_time, send_times, _ = entry
+        if send_times != 1:  # Karn's rule
+            return
+        rtt = self.loop.time() - send_time
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(max(self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar), MIN_RTO), MAX_RTO)
+
+    # teardown
+    def fail(self, exc: Exception, send_reset: bool = True) -> None:
+        if send_reset and self.transport is not None:
+            self.transport.sendto(pack_header(TYPE_DICT["RESET"], 0, self.wide_seq))
+        self.close()
+        if not self.done.done():
+            self.done.set_exception(exc)
+
+    def close(self) -> None:
+        self.timers.cancel()
+        if self.transport is not None:
+            self.transport.close()
+        if self.file_map is not None:
+            self.file_view.release()
+            self.file_map.close()
+            self.file_map = None
+
+
+class ReceiverProtocol(asyncio.DatagramProtocol):
+    def __init__(self, filename: str, preallocate: bool = False) -> None:
+        '''
+        :param filename: the file into which the received bytes are written.
+        :param preallocate: reserve the file size announced in the SYN on disk.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()  # result: bytes received
+        self.transport = None
+        self.filename = filename
+        self.preallocate = preallocate
+        self.wide_seq = False
+        self.data_isn = None
+        self.expected_offset = 0
+        self.buffer = {}  # offset : end offset, out-of-order segments held by the output or already written
+        self.output = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data, addr) -> None:
+        rev_type_no = int.from_bytes(data[:2], byteorder='big')
+        rev_type_no, rev_seq_no, payload_start = unpack_header(data, self.wide_seq and rev_type_no != TYPE_DICT["SYN"])
+
+        if rev_type_no == TYPE_DICT["SYN"]:
+            syn_options = unpack_options(data[payload_start:])
+            accepted_options = {OPT_WIDE_SEQ: b''} if OPT_WIDE_SEQ in syn_options else {}
+            if OPT_MSS in syn_options:
+                accepted_options[OPT_MSS] = min(int.from_bytes(syn_options[OPT_MSS], byteorder='big'),
+                                                MAX_MSS).to_bytes(2, byteorder='big')
+            if self.data_isn != rev_seq_no + 1 and not self.done.done():  # not a resent SYN
+                self.wide_seq = OPT_WIDE_SEQ in accepted_options
+                self.data_isn = rev_seq_no + 1
+                self.expected_offset = 0
+                self.buffer.clear()
+                if self.output is not None:
+                    self.output.close()
+                file_size = int.from_bytes(syn_options[OPT_FILE_SIZE], byteorder='big') \
+                    if OPT_FILE_SIZE in syn_options else None
+                ring_size = RCV_WINDOW + WRITE_COALESCE if file_size is None else min(RCV_WINDOW + WRITE_COALESCE, file_size)
+                self.output = OutputFile(self.filename, file_size, self.preallocate, ring_size=ring_size)
+            self.transport.sendto(pack_header(TYPE_DICT["ACK"], rev_seq_no + 1) + pack_options(accepted_options), addr)
+
+        elif rev_type_no == TYPE_DICT["DATA"]:
+            if self.data_isn is None or self.done.done():
+                return
+            content = memoryview(data)[payload_start:]
+            offset = unwrap_seq(rev_seq_no, self.data_isn + self.expected_offset, self.wide_seq) - self.data_isn
+            if offset == self.expected_offset:
+                self.output.store(offset, content)
+                self.expected_offset += len(content)
+                while self.expected_offset in self.buffer:
+                    self.expected_offset = self.buffer.pop(self.expected_offset)
+                self.output.advance(self.expected_offset)
+            elif offset > self.expected_offset and offset not in self.buffer:
+                self.output.store(offset, content)
+                self.buffer[offset] = offset + len(content)
+            blocks = []
+            for start in sorted(self.buffer):
+                if blocks and blocks[-1][1] == self.data_isn + start:
+                    blocks[-1][1] = self.data_isn + self.buffer[start]
+                elif len(blocks) == MAX_SACK_BLOCKS:
+                    break
+                else:
+                    blocks.append([self.data_isn + start, self.data_isn + self.buffer[start]])
+            self.transport.sendto(pack_header(TYPE_DICT["ACK"], self.data_isn + self.expected_offset, self.wide_seq) +
+                                  pack_sack(blocks, self.wide_seq), addr)
+
+        elif rev_type_no == TYPE_DICT["FIN"]:
+            if self.data_isn is None:
+                return
+            self.transport.sendto(pack_header(TYPE_DICT["ACK"], rev_seq_no + 1, self.wide_seq), addr)
+            if not self.done.done():
+                self.close_output()
+                self.done.set_result(self.expected_offset)
+                # keep acking resent FINs for a while in case this ACK is lost
+                self.loop.call_later(FIN_LINGER, self.transport.close)
+
+        elif rev_type_no == TYPE_DICT["RESET"]:
+            self.close_output()
+            self.transport.close()
+            if not self.done.done():
+                self.done.set_exception(ConnectionResetError("reset by the sender"))
+
+    def connection_lost(self, exc) -> None:
+        self.close_output()
+        if not self.done.done():
+            self.done.set_exception(exc or ConnectionError("socket closed"))
+
+    def close_output(self) -> None:
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+
+async def send_file(filename: str, receiver_address, max_win: int = 50000, rot: int = 100, local_address=None,
+                    **kwargs) -> int:
+    '''
+    Send one file to a PTP receiver.
+    :param receiver_address: (host, port) of the receiver
+    :param local_address: (host, port) to bind, an ephemeral port by default
+    :param kwargs: give_up_time, wide_seq, cc, mss, see SenderProtocol
+    :return: the number of bytes sent, raises ConnectionError if the transfer has been reset
+    '''
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_datagram_endpoint(
+        lambda: SenderProtocol(filename, max_win, rot, **kwargs), local_addr=local_address, remote_addr=receiver_address)
+    try:
+        return await protocol.done
+    finally:
+        protocol.close()
+
+
+async def receive_file(filename: str, local_address, preallocate: bool = False) -> int:
+    '''
+    Receive one file from a PTP sender.
+    :param local_address: (host, port) to listen on
+    :return: the number of bytes received, raises ConnectionResetError if the sender reset the transfer
+    '''
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: ReceiverProtocol(filename, preallocate), local_addr=local_address)
+    try:
+        return await protocol.done
+    except BaseException:
+        transport.close()
+        raise
@@ -0,0 +1,154 @@
+# v2
+'''
+Benchmark suite: runs sender.py and receiver.py on loopback through the impairment proxy (impair.py) for every
+combination of file size, max_win, rot and loss profile, and writes one JSON line per run:
+
+    python3 bench.py --sizes 1M,16M --max-win 64000,1000000 --rot 50 --profiles clean,bursty --out bench.jsonl
+
+Each line has the parameters, the completion time and goodput measured by the sender, the retransmission overhead,
+the CPU time of both processes and the proxy's counters, so that two runs of the suite can be diffed for regressions.
+The receiver runs with flp = rlp = 0, all the losses come from the proxy.
+'''
+import argparse
+import filecmp
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from impair import ImpairmentProxy, Link, parse_link
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# name : (forward link, reverse link), see impair.py
+PROFILES = {
+    "clean": ("", ""),
+    "lossy": ("loss=0.01", "loss=0.01"),
+    "bursty": ("ge_p=0.005,ge_r=0.3", ""),
+    "reorder": ("delay=2,jitter=1,reorder=0.02,reorder_delay=5", "delay=2"),
+    "wan": ("delay=20,jitter=2,rate=12500000,queue=262144", "delay=20"),
+    "lossy-wan": ("delay=20,jitter=2,rate=12500000,queue=262144,ge_p=0.002,ge_r=0.5", "delay=20,loss=0.005"),
+}
+RUN_TIMEOUT = 300  # seconds for one transfer
+BASE_PORT = 21000
+
+
+def parse_size(text: str) -> int:
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1:].upper()])
+    return int(text)
+
+
+def make_file(directory: str, size: int, seed: int) -> str:
+    # half random, half repeated text, so that the compression paths see both kinds of data
+    filename = os.path.join(directory, f"in_{size}.bin")
+    if not os.path.exists(filename):
+        rng = random.Random(seed)
+        half = size // 2
+        text = b"The quick brown fox jumps over the lazy dog. " * (half // 45 + 1)
+        with open(filename, "wb") as file:
+            file.write(rng.randbytes(size - half) + text[:half])
+    return filename
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_case(directory: str, filename: str, size: int, max_win: int, rot: int, profile: str, ports,
+             seed: int, sender_args, receiver_args) -> dict:
+    '''
+    One transfer through the proxy.
+    :param ports: (sender port, proxy port, receiver port)
+    :return: the result line
+    '''
+    sender_port, proxy_port, receiver_port = ports
+    output = os.path.join(directory, "out.bin")
+    sender_metrics = os.path.join(directory, "sender_metrics.json")
+    for path in (output, sender_metrics):
+        if os.path.exists(path):
+            os.remove(path)
+    forward, reverse = PROFILES[profile]
+    proxy = ImpairmentProxy(proxy_port, receiver_port, Link(**dict(parse_link(forward), seed=seed)),
+                            Link(**dict(parse_link(reverse), seed=seed + 1)))
+    proxy.start()
+    cpu = children_cpu()
+    receiver = subprocess.Popen([sys.executable, os.path.join(HERE, "receiver.py"), str(receiver_port),
+                                 str(sender_port), output, "0", "0", "--trace", "off", *receiver_args], cwd=directory)
+    time.sleep(0.3)  # the receiver binds its port
+    started = time.monotonic()
+    sender = subprocess.Popen([sys.executable, os.path.join(HERE, "sender.py"), str(sender_port), str(proxy_port),
+                               filename, str(max_win), str(rot), "--trace", "off", "--metrics", sender_metrics,
+                               *sender_args], cwd=directory)
+    try:
+        sender.wait(RUN_TIMEOUT)
+        receiver.wait(10)
+    except subprocess.TimeoutExpired:
+        sender.kill()
+        receiver.kill()
+        sender.wait()
+        receiver.wait()
+    wall_time = time.monotonic() - started
+    cpu = children_cpu() - cpu
+    proxy.stop()
+
+    result = {"size": size, "max_win": max_win, "rot": rot, "profile": profile, "sender_args": " ".join(sender_args),
+              "ok": sender.returncode == 0 and os.path.exists(output) and filecmp.cmp(filename, output, shallow=False),
+              "wall_time": round(wall_time, 3), "cpu_time": round(cpu, 3), "proxy": proxy.stats()}
+    if os.path.exists(sender_metrics):
+        with open(sender_metrics) as file:
+            metrics = json.load(file)
+        counters = metrics["counters"]
+        retransmits = counters.get("retransmits_timeout", 0) + counters.get("retransmits_fast", 0)
+        result.update(
+            completion_time=metrics["elapsed"],
+            goodput=round(size / metrics["elapsed"]) if metrics["elapsed"] else None,  # bytes per second
+            retransmits=retransmits,
+            timeouts=counters.get("timeouts", 0),
+            retransmit_overhead=round((counters.get("bytes_sent", 0) - size) / size, 4) if size else 0,
+            srtt=metrics["srtt"],
+            rtt_mean=metrics["rtt"]["mean"],
+        )
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 bench.py [--sizes 1M,16M] [--max-win 64000] [--rot 50] "
+                                           "[--profiles clean,lossy] [--out results.jsonl] [-- sender options]")
+    parser.add_argument("--sizes", default="1M,16M", help="file sizes, with K/M/G suffixes")
+    parser.add_argument("--max-win", default="64000,1000000", help="max_win values in bytes")
+    parser.add_argument("--rot", default="50", help="initial RTO values in ms")
+    parser.add_argument("--profiles", default=",".join(PROFILES), help=f"loss profiles among {', '.join(PROFILES)}")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each combination")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the files and of the proxy")
+    parser.add_argument("--port", type=int, default=BASE_PORT, help="first port, each run takes the next three")
+    parser.add_argument("--receiver-args", default="", help="extra receiver options, as one string")
+    parser.add_argument("--out", help="append the results to this file instead of stdout")
+    parser.add_argument("sender_args", nargs=argparse.REMAINDER, help="extra sender options, after --")
+    args = parser.parse_args()
+    sender_args = args.sender_args[1:] if args.sender_args[:1] == ["--"] else args.sender_args
+    profiles = args.profiles.split(",")
+    for profile in profiles:
+        if profile not in PROFILES:
+            parser.error(f"unknown profile {profile}")
+
+    out = open(args.out, "a") if args.out else sys.stdout
+    with tempfile.TemporaryDirectory(prefix="ptpbench") as directory:
+        cases = itertools.product([parse_size(size) for size in args.sizes.split(",")],
+                                  [int(max_win) for max_win in args.max_win.split(",")],
+                                  [int(rot) for rot in args.rot.split(",")], profiles, range(args.repeat))
+        for index, (size, max_win, rot, profile, run) in enumerate(cases):
+            ports = (args.port + 3 * index, args.port + 3 * index + 1, args.port + 3 * index + 2)
+            result = run_case(directory, make_file(directory, size, args.seed), size, max_win, rot, profile, ports,
+                              args.seed + run, sender_args, args.receiver_args.split())
+            result["run"] = run
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    if out is not sys.stdout:
+        out.close()
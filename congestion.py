@@ -0,0 +1,103 @@
+# v2
+'''
+Congestion controllers of the sender. The window is counted in bytes and capped by max_win:
+the sender keeps min(cwnd, max_win) bytes in flight.
+'''
+INITIAL_WINDOW = 4  # segments, RFC 3390 style initial window
+
+
+class Reno:
+    '''
+    Slow start + AIMD (RFC 5681): cwnd grows by the acked bytes below ssthresh and by about one
+    segment per RTT above it; a timeout halves ssthresh and restarts from one segment, a fast
+    retransmit halves cwnd and inflates it during fast recovery.
+    '''
+    def __init__(self, mss: int, max_win: int) -> None:
+        self.mss = mss
+        self.max_win = max_win
+        self.cwnd = min(INITIAL_WINDOW * mss, max_win)
+        self.ssthresh = max_win
+
+    @property
+    def window(self) -> int:
+        return max(min(int(self.cwnd), self.max_win), self.mss)
+
+    def on_ack(self, acked_bytes: int, now: float, srtt=None) -> None:
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked_bytes  # slow start
+        else:
+            self.congestion_avoidance(acked_bytes, now, srtt)
+        self.cwnd = min(self.cwnd, self.max_win)
+
+    def congestion_avoidance(self, acked_bytes: int, now: float, srtt) -> None:
+        self.cwnd += self.mss * acked_bytes / self.cwnd
+
+    def on_timeout(self, bytes_in_flight: int, now: float) -> None:
+        self.ssthresh = max(bytes_in_flight / 2, 2 * self.mss)
+        self.cwnd = self.mss
+
+    # fast recovery (RFC 6582), driven by the sender's duplicate ACK counting
+    def on_fast_loss(self, bytes_in_flight: int, now: float) -> None:
+        self.ssthresh = max(bytes_in_flight / 2, 2 * self.mss)
+        self.cwnd = self.ssthresh + 3 * self.mss
+
+    def on_dup_ack(self) -> None:
+        self.cwnd += self.mss
+
+    def on_partial_ack(self, acked_bytes: int) -> None:
+        self.cwnd = max(self.cwnd - acked_bytes + self.mss, self.mss)
+
+    def exit_recovery(self) -> None:
+        self.cwnd = self.ssthresh
+
+
+class Cubic(Reno):
+    '''
+    CUBIC (RFC 8312) congestion avoidance: after a loss the window follows
+    W(t) = C * (t - K)^3 + W_max, with a Reno-friendly lower bound. Slow start is Reno's.
+    '''
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, mss: int, max_win: int) -> None:
+        super().__init__(mss, max_win)
+        self.w_max = 0  # segments, window before the last reduction
+        self.k = 0
+        self.epoch_start = None
+        self.w_est = 0  # segments, Reno-friendly estimate
+
+    def congestion_avoidance(self, acked_bytes: int, now: float, srtt) -> None:
+        cwnd_seg = self.cwnd / self.mss
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if self.w_max < cwnd_seg:
+                self.w_max = cwnd_seg
+            self.k = ((self.w_max - cwnd_seg) / self.C) ** (1 / 3)
+            self.w_est = cwnd_seg
+        rtt = srtt or 0
+        t = now - self.epoch_start + rtt
+        target = self.C * (t - self.k) ** 3 + self.w_max
+        acked_seg = acked_bytes / self.mss
+        self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * acked_seg / cwnd_seg
+        target = max(target, self.w_est)
+        if target > cwnd_seg:
+            self.cwnd += self.mss * (target - cwnd_seg) / cwnd_seg * acked_seg
+        else:
+            self.cwnd += self.mss * acked_seg / (100 * cwnd_seg)
+
+    def on_timeout(self, bytes_in_flight: int, now: float) -> None:
+        self.reduce()
+        self.cwnd = self.mss
+
+    def on_fast_loss(self, bytes_in_flight: int, now: float) -> None:
+        self.reduce()
+        self.cwnd = self.ssthresh + 3 * self.mss
+
+    def reduce(self) -> None:
+        # multiplicative decrease by BETA, the cubic curve restarts from the current window
+        self.w_max = self.cwnd / self.mss
+        self.epoch_start = None
+        self.ssthresh = max(self.cwnd * self.BETA, 2 * self.mss)
+
+
+CONTROLLERS = {"reno": Reno, "cubic": Cubic}
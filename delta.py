@@ -0,0 +1,119 @@
+# v2
+'''
+Block-hash delta sync (rsync style), shared by the sender and the receiver.
+
+The receiver cuts its existing copy into blocks and sends one signature per block: a weak rolling hash (adler32)
+and a strong hash (8-byte blake2b). The sender slides a window over its file, rolls the weak hash byte by byte
+where blocks do not line up, confirms candidates with the strong hash and turns the matches into copy instructions
+(dst offset, src offset, length). Everything else is sent as ordinary DATA.
+'''
+import hashlib
+import struct
+import zlib
+
+BLOCK_SIZE = 8192  # bytes per signed block, at least one segment
+SIG_LEN = 4 + 8  # weak + strong hash of one block
+SIG_BATCH = 80  # signatures in one SIG segment
+COPY_BATCH = 40  # copy instructions in one COPY segment
+MAX_ROLL_BLOCKS = 4  # unmatched blocks in a row after which the search stops rolling until the next match
+ADLER_MOD = 65521
+
+
+def strong_hash(block) -> bytes:
+    return hashlib.blake2b(block, digest_size=8).digest()
+
+
+def block_signatures(view, block_size: int, first: int, count: int) -> bytes:
+    '''
+    :param view: the receiver's copy, a memoryview over its mmap
+    :return: the signatures of blocks [first, first + count), the last block of the file may be shorter
+    '''
+    sigs = bytearray()
+    for index in range(first, min(first + count, -(-len(view) // block_size))):
+        block = view[index * block_size:(index + 1) * block_size]
+        sigs += struct.pack(">I", zlib.adler32(block)) + strong_hash(block)
+    return bytes(sigs)
+
+
+def unpack_signatures(data: bytes):
+    return [(struct.unpack_from(">I", data, i)[0], bytes(data[i + 4:i + SIG_LEN]))
+            for i in range(0, len(data) - SIG_LEN + 1, SIG_LEN)]
+
+
+def pack_copies(copies) -> bytes:
+    return b''.join(struct.pack(">QQQ", dst, src, length) for dst, src, length in copies)
+
+
+def unpack_copies(data: bytes):
+    return [struct.unpack_from(">QQQ", data, i) for i in range(0, len(data) - 23, 24)]
+
+
+def match_blocks(view, block_size: int, signatures, basis_size: int, mss: int):
+    '''
+    Find the blocks of the receiver's copy in the file.
+    :param view: the sender's file
+    :param signatures: [(weak, strong)] of the receiver's blocks, indexed by block number
+    :param basis_size: the size of the receiver's copy, its last block may be shorter
+    :param mss: the segment size, copies are cut to segment boundaries so that the sender can skip whole segments
+    :return: [(dst offset, src offset, length)] runs of matching bytes, in file order
+    '''
+    table = {}  # weak : [block index]
+    for index, (weak, _) in enumerate(signatures):
+        table.setdefault(weak, []).append(index)
+
+    def find(weak, pos, length):
+        for index in table.get(weak, ()):
+            if strong_hash(view[pos:pos + length]) == signatures[index][1] and \
+                    min(block_size, basis_size - index * block_size) == length:
+                return index
+        return None
+
+    matches = []  # [dst, src, length]
+
+    def add(dst, src, length):
+        # extend the previous run if both sides are contiguous
+        if matches and matches[-1][0] + matches[-1][2] == dst and matches[-1][1] + matches[-1][2] == src:
+            matches[-1][2] += length
+        else:
+            matches.append([dst, src, length])
+
+    size = len(view)
+    pos = 0
+    misses = 0
+    while pos + block_size <= size:
+        weak = zlib.adler32(view[pos:pos + block_size])
+        index = find(weak, pos, block_size)
+        if index is None and misses < MAX_ROLL_BLOCKS:
+            # roll the window one byte at a time over the next block
+            a, b = weak & 0xffff, weak >> 16
+            for p in range(pos, min(pos + block_size, size - block_size)):
+                x_out, x_in = view[p], view[p + block_size]
+                a = (a - x_out + x_in) % ADLER_MOD
+                b = (b - block_size * x_out + a - 1) % ADLER_MOD
+                if (b << 16 | a) in table:
+                    index = find(b << 16 | a, p + 1, block_size)
+                    if index is not None:
+                        pos = p + 1
+                        break
+        if index is None:
+            misses += 1
+            pos += block_size
+            continue
+        misses = 0
+        add(pos, index * block_size, block_size)
+        pos += block_size
+
+    # the tail may be the short last block of the receiver's copy
+    tail = size - pos
+    if signatures and 0 < tail < block_size:
+        index = find(zlib.adler32(view[pos:]), pos, tail)
+        if index is not None:
+            add(pos, index * block_size, tail)
+
+    copies = []
+    for dst, src, length in matches:
+        start = -(-dst // mss) * mss
+        end = dst + length if dst + length == size else (dst + length) // mss * mss
+        if start < end:
+            copies.append((start, src + start - dst, end - start))
+    return copies
@@ -0,0 +1,202 @@
+# v2
+'''
+A local UDP proxy impairing the path between a sender and a receiver on loopback, in the spirit of netem.
+
+The sender sends to the proxy port instead of the receiver port; every datagram goes through the forward Link
+(sender -> receiver) or the reverse Link (receiver -> sender), which decides when it leaves, or drops it:
+
+    python3 impair.py 9000 8000 --forward "delay=20,jitter=2,ge_p=0.01,ge_r=0.3" --reverse "delay=20"
+    python3 sender.py 7000 9000 file.bin 64000 100
+
+Link options, as key=value pairs separated by commas:
+    delay, jitter       one-way delay and its uniform +- variation in ms, the datagrams stay in order
+    loss                loss probability (in the good state of the Gilbert-Elliott model)
+    ge_p, ge_r, ge_loss Gilbert-Elliott bursty loss: good -> bad and bad -> good transition probabilities per
+                        packet, and the loss probability in the bad state (1 by default)
+    reorder             probability that a datagram is held back reorder_delay ms more than the others
+    reorder_delay       ms, 10 by default
+    duplicate           probability that a datagram is delivered twice
+    rate, queue         bottleneck rate in bytes per second, and the drop-tail queue in front of it in bytes
+    seed                seed of the random generator, for reproducible runs
+'''
+import argparse
+import heapq
+import logging
+import random
+import select
+import socket
+import threading
+import time
+
+from ptp import set_buffer_sizes
+
+BUFFERSIZE = 65536
+SOCKET_BUFFER = 4 * 1024 * 1024  # SO_RCVBUF/SO_SNDBUF of the proxy sockets, the proxy must not be the one dropping
+QUEUE_LIMIT = 256 * 1024  # bytes queued in front of a rate-limited link
+REORDER_DELAY = 10  # ms
+LINK_OPTIONS = {"delay": float, "jitter": float, "loss": float, "ge_p": float, "ge_r": float, "ge_loss": float,
+                "reorder": float, "reorder_delay": float, "duplicate": float, "rate": float, "queue": int, "seed": int}
+
+
+def parse_link(spec: str) -> dict:
+    '''
+    :param spec: "key=value,key=value", see LINK_OPTIONS
+    :return: the keyword arguments of Link
+    '''
+    options = {}
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        key, _, value = item.partition("=")
+        if key not in LINK_OPTIONS:
+            raise ValueError(f"unknown link option {key}, one of {', '.join(LINK_OPTIONS)}")
+        options[key] = LINK_OPTIONS[key](value)
+    return options
+
+
+class Link:
+    '''
+    One direction of the impaired path.
+    '''
+    def __init__(self, delay: float = 0, jitter: float = 0, loss: float = 0, ge_p: float = 0, ge_r: float = 1,
+                 ge_loss: float = 1, reorder: float = 0, reorder_delay: float = REORDER_DELAY, duplicate: float = 0,
+                 rate: float = 0, queue: int = QUEUE_LIMIT, seed=None) -> None:
+        self.random = random.Random(seed)
+        self.delay = delay / 1000
+        self.jitter = jitter / 1000
+        self.loss = loss
+        self.ge_p = ge_p
+        self.ge_r = ge_r
+        self.ge_loss = ge_loss
+        self.bad = False  # state of the Gilbert-Elliott chain
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay / 1000
+        self.duplicate = duplicate
+        self.rate = rate
+        self.queue = queue
+        self.link_free = 0  # time at which the bottleneck has sent everything queued so far
+        self.last_arrival = 0  # jitter keeps the datagrams in order, only reorder overtakes
+        self.stats = {"packets": 0, "bytes": 0, "lost": 0, "queue_drops": 0, "duplicated": 0, "reordered": 0}
+
+    def schedule(self, now: float, size: int):
+        '''
+        :return: the delivery times of one datagram, none if it is dropped, two if it is duplicated
+        '''
+        self.stats["packets"] += 1
+        self.stats["bytes"] += size
+        if self.ge_p:
+            self.bad = self.random.random() >= self.ge_r if self.bad else self.random.random() < self.ge_p
+        if self.random.random() < (self.ge_loss if self.bad else self.loss):
+            self.stats["lost"] += 1
+            return []
+        departure = now
+        if self.rate:
+            backlog = max(self.link_free - now, 0) * self.rate
+            if backlog + size > self.queue:
+                self.stats["queue_drops"] += 1
+                return []
+            self.link_free = max(self.link_free, now) + size / self.rate
+            departure = self.link_free
+        copies = 2 if self.duplicate and self.random.random() < self.duplicate else 1
+        if copies == 2:
+            self.stats["duplicated"] += 1
+        times = []
+        for _ in range(copies):
+            arrival = departure + self.delay
+            if self.jitter:
+                arrival = max(arrival + self.random.uniform(-self.jitter, self.jitter), self.last_arrival)
+            if self.reorder and self.random.random() < self.reorder:
+                self.stats["reordered"] += 1
+                times.append(arrival + self.reorder_delay)
+                continue
+            self.last_arrival = arrival
+            times.append(max(arrival, now))
+        return times
+
+
+class ImpairmentProxy:
+    '''
+    Relays datagrams between senders and one receiver through a forward and a reverse Link. Each sender address gets
+    its own socket towards the receiver, so that the replies find their way back.
+    '''
+    def __init__(self, listen_port: int, receiver_port: int, forward: Link, reverse: Link,
+                 host: str = "127.0.0.1") -> None:
+        self.receiver_address = (host, int(receiver_port))
+        self.forward = forward
+        self.reverse = reverse
+        self.front = self.open_socket((host, int(listen_port)))
+        self.back = {}  # sender address : socket towards the receiver
+        self.senders = {}  # back socket : sender address
+        self.pending = []  # heap of (delivery time, counter, socket, datagram, address)
+        self.counter = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def open_socket(self, address):
+        sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        set_buffer_sizes(sock, SOCKET_BUFFER, SOCKET_BUFFER)
+        sock.bind(address)
+        sock.setblocking(False)
+        return sock
+
+    def relay(self, link, sock, datagram, address, now):
+        for delivery in link.schedule(now, len(datagram)):
+            self.counter += 1
+            heapq.heappush(self.pending, (delivery, self.counter, sock, datagram, address))
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            timeout = 0.1
+            if self.pending:
+                timeout = min(max(self.pending[0][0] - time.monotonic(), 0), timeout)
+            readable, _, _ = select.select([self.front, *self.senders], [], [], timeout)
+            now = time.monotonic()
+            for sock in readable:
+                while True:  # drain the socket, one select per batch
+                    try:
+                        datagram, address = sock.recvfrom(BUFFERSIZE)
+                    except (BlockingIOError, ConnectionRefusedError):
+                        break
+                    if sock is self.front:
+                        back = self.back.get(address)
+                        if back is None:
+                            back = self.back[address] = self.open_socket((self.receiver_address[0], 0))
+                            self.senders[back] = address
+                        self.relay(self.forward, back, datagram, self.receiver_address, now)
+                    else:
+                        self.relay(self.reverse, self.front, datagram, self.senders[sock], now)
+            while self.pending and self.pending[0][0] <= now:
+                _, _, sock, datagram, address = heapq.heappop(self.pending)
+                try:
+                    sock.sendto(datagram, address)
+                except OSError as exc:  # the other side is gone, or its buffer is full
+                    logging.debug(f"proxy send failed: {exc}")
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        for sock in [self.front, *self.senders]:
+            sock.close()
+
+    def stats(self) -> dict:
+        return {"forward": dict(self.forward.stats), "reverse": dict(self.reverse.stats)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 impair.py listen_port receiver_port [--forward SPEC] [--reverse SPEC]")
+    parser.add_argument("listen_port", type=int, help="the port the sender sends to")
+    parser.add_argument("receiver_port", type=int)
+    parser.add_argument("--forward", default="", help="impairments of the sender -> receiver direction")
+    parser.add_argument("--reverse", default="", help="impairments of the receiver -> sender direction")
+    args = parser.parse_args()
+
+    proxy = ImpairmentProxy(args.listen_port, args.receiver_port, Link(**parse_link(args.forward)),
+                            Link(**parse_link(args.reverse)))
+    try:
+        proxy.run()
+    except KeyboardInterrupt:
+        pass
+    print(proxy.stats())
@@ -0,0 +1,120 @@
+# v2
+'''
+Transfer metrics of the sender and the receiver: counters, an RTT histogram, window occupancy and goodput.
+
+Counters are plain dict entries bumped on the hot path; snapshot() turns them into a JSON-ready dict, which can be
+dumped periodically to a file (written atomically, so it can be polled while the transfer runs) and is logged as a
+summary line at the end of the connection.
+'''
+import json
+import logging
+import os
+import threading
+import time
+
+METRICS_INTERVAL = 1  # seconds between two dumps of the metrics file
+# upper bounds of the RTT histogram buckets in seconds, the last bucket is open
+RTT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2)
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.counters = {"bytes_delivered": 0}  # name : value, bytes_delivered gives the goodput
+        self.rtt_buckets = [0] * (len(RTT_BUCKETS) + 1)
+        self.rtt_count = 0
+        self.rtt_sum = 0
+        self.rtt_min = None
+        self.rtt_max = 0
+        self.occupancy_count = 0
+        self.occupancy_sum = 0
+        self.occupancy_max = 0
+
+    def add(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe_rtt(self, rtt: float) -> None:
+        for index, bound in enumerate(RTT_BUCKETS):
+            if rtt <= bound:
+                break
+        else:
+            index = len(RTT_BUCKETS)
+        self.rtt_buckets[index] += 1
+        self.rtt_count += 1
+        self.rtt_sum += rtt
+        self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+        self.rtt_max = max(self.rtt_max, rtt)
+
+    def observe_occupancy(self, used: int, window: int) -> None:
+        '''
+        :param used: bytes of the window in use (in flight on the sender, buffered above the ACK on the receiver)
+        '''
+        occupancy = used / window if window > 0 else 1
+        self.occupancy_count += 1
+        self.occupancy_sum += occupancy
+        self.occupancy_max = max(self.occupancy_max, occupancy)
+
+    def finish(self) -> None:
+        # freeze the elapsed time, the goodput of a finished transfer does not decay
+        if self.end_time is None:
+            self.end_time = time.monotonic()
+
+    def snapshot(self) -> dict:
+        elapsed = (self.end_time or time.monotonic()) - self.start_time
+        counters = dict(self.counters)
+        histogram = {f"<={bound * 1000:g}ms": count for bound, count in zip(RTT_BUCKETS, self.rtt_buckets)}
+        histogram[f">{RTT_BUCKETS[-1] * 1000:g}ms"] = self.rtt_buckets[-1]
+        return {
+            "elapsed": round(elapsed, 3),
+            "counters": counters,
+            "goodput": round(counters["bytes_delivered"] / elapsed) if elapsed > 0 else 0,  # bytes per second
+            "rtt": {
+                "count": self.rtt_count,
+                "min": self.rtt_min,
+                "mean": self.rtt_sum / self.rtt_count if self.rtt_count else None,
+                "max": self.rtt_max if self.rtt_count else None,
+                "histogram": histogram,
+            },
+            "occupancy": {
+                "mean": round(self.occupancy_sum / self.occupancy_count, 4) if self.occupancy_count else None,
+                "max": round(self.occupancy_max, 4),
+            },
+        }
+
+
+def dump_json(snapshot: dict, filename: str) -> None:
+    # written next to the file and renamed, a reader never sees half of it
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as file:
+        json.dump(snapshot, file, indent=1)
+    os.replace(tmp, filename)
+
+
+class MetricsDumper:
+    '''
+    Dumps snapshot() of an owner to a JSON file every interval seconds from a daemon thread.
+    '''
+    def __init__(self, snapshot, filename: str, interval: float = METRICS_INTERVAL) -> None:
+        '''
+        :param snapshot: a callable returning the dict to dump
+        '''
+        self.snapshot = snapshot
+        self.filename = filename
+        self.interval = float(interval)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                dump_json(self.snapshot(), self.filename)
+            except (OSError, RuntimeError) as exc:  # RuntimeError: a dict changed size while copied
+                logging.debug(f"metrics dump failed: {exc}")
+
+    def stop(self) -> None:
+        # the last dump, after the transfer
+        self.stopped.set()
+        self.thread.join()
+        dump_json(self.snapshot(), self.filename)
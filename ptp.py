@@ -0,0 +1,222 @@
+# v2
+'''
+Wire format of the PTP segments, shared by the sender and the receiver.
+
+Every segment starts with type(2 bytes) + sequence number. The sequence number is 2 bytes and wraps at
+SEQ_MODULO (the original header), or 8 bytes and never wraps once the wide header has been negotiated
+in the SYN exchange. Both sides keep their bookkeeping in absolute sequence numbers / byte offsets and only
+narrow them on the wire.
+'''
+import socket
+import struct
+import zlib
+
+try:  # optional codecs, offered only when installed
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+SEQ_MODULO = 65535  # the narrow sequence space, kept as in the original header
+NARROW_SEQ_LEN = 2
+WIDE_SEQ_LEN = 8
+
+TYPE_DICT = {"DATA": 0, "ACK": 1, "SYN": 2, "FIN": 3, "RESET": 4, "PROBE": 5, "SIGREQ": 6, "SIG": 7, "COPY": 8,
+             "PARITY": 9, "FILE": 10}
+FLAG_COMPRESSED = 0x100  # in the type field of a DATA segment: the payload is compressed with the negotiated codec
+GET_TYPE_DICT = {0: "DATA", 1: "ACK", 2: "SYN", 3: "FIN", 4: "RESET", 5: "PROBE", 6: "SIGREQ", 7: "SIG", 8: "COPY",
+                 9: "PARITY", 10: "FILE"}
+# the largest DATA payload: a 65507 bytes IPv4 UDP datagram minus the wide header
+MAX_MSS = 65507 - 2 - WIDE_SEQ_LEN
+
+# SYN options, kind(1) + length(2) + value, echoed by the receiver in the SYN ACK when accepted
+OPT_WIDE_SEQ = 1  # 64-bit sequence numbers for DATA/ACK/FIN, no value
+OPT_FILE_SIZE = 2  # size of the file in bytes (8 bytes), announced by the sender and never echoed
+OPT_STRIPED = 3  # control flow of a striped transfer: transfer id(4) + stripe count(2), needs a server receiver
+OPT_STRIPE = 4  # one stripe: transfer id(4) + control port(2) + stripe index(2) + offset of the range(8)
+OPT_MSS = 5  # largest DATA payload (2 bytes), offered by the sender and echoed lowered to the receiver's limit
+OPT_RESUME = 6  # resume token: file identity(8) + file size(8), echoed followed by the [start, end) ranges already received
+RESUME_TOKEN_LEN = 16
+OPT_DELTA = 7  # delta sync, offered empty; echoed with block size(4) + size of the receiver's copy(8)
+OPT_COMPRESS = 8  # codec ids (1 byte each) in the sender's preference order, echoed with the one chosen
+OPT_FEC = 9  # XOR parity segments, group size k (1 byte), echoed when the receiver rebuilds lost segments
+OPT_RWND = 10  # receive window, no value: the data ACKs carry the free reassembly space (4 bytes) before the SACK blocks
+RWND_LEN = 4
+OPT_FILES = 11  # multi-file session: file count(4), the DATA stream is the files back to back, described by FILE segments
+STRIPED_FORMAT = ">IH"
+STRIPE_FORMAT = ">IHHQ"
+# PARITY payload: group size k + parity count m + parity index + mss, then the parity bytes (mss). The header carries
+# the sequence number of the first segment of the group; parity j covers the segments j, j + m, j + 2m ... of it
+PARITY_FORMAT = ">BBBH"
+# FILE payload: a key(8) echoed by the receiver, then records of stream offset + size + name length, each followed
+# by the name (utf-8, a relative path with / separators)
+FILE_RECORD_FORMAT = ">QQH"
+
+
+# codec id : (name, compress, decompress), each DATA segment is compressed on its own so that the receiver decodes
+# it whatever the order of arrival; decompress never returns more than max_length bytes
+CODECS = {1: ("zlib", lambda data: zlib.compress(data, 1),
+              lambda data, max_length: zlib.decompressobj().decompress(data, max_length))}
+if zstandard is not None:
+    CODECS[2] = ("zstd", lambda data: zstandard.ZstdCompressor(level=1).compress(data),
+                 lambda data, max_length: zstandard.ZstdDecompressor().decompress(data, max_output_size=max_length))
+if lz4 is not None:
+    CODECS[3] = ("lz4", lambda data: lz4.block.compress(data),
+                 lambda data, max_length: lz4.block.decompress(data))
+CODEC_IDS = {name: codec_id for codec_id, (name, _, _) in CODECS.items()}
+
+
+def xor_payloads(payloads, mss: int) -> int:
+    '''
+    :return: the XOR of the payloads zero-padded to mss bytes, as an integer of mss bytes
+    '''
+    parity = 0
+    for payload in payloads:
+        parity ^= int.from_bytes(payload, byteorder='big') << (8 * (mss - len(payload)))
+    return parity
+
+
+def seq_len(wide: bool) -> int:
+    return WIDE_SEQ_LEN if wide else NARROW_SEQ_LEN
+
+
+def pack_header(type_no: int, seq_no: int, wide: bool = False) -> bytes:
+    if not wide:
+        seq_no %= SEQ_MODULO
+    return type_no.to_bytes(2, byteorder='big', signed=False) + \
+           seq_no.to_bytes(seq_len(wide), byteorder='big', signed=False)
+
+
+def pack_header_into(buf: bytearray, type_no: int, seq_no: int, wide: bool = False) -> int:
+    '''
+    Write the header at the start of a reused buffer.
+    :return: the header length
+    '''
+    if wide:
+        struct.pack_into(">HQ", buf, 0, type_no, seq_no)
+        return 2 + WIDE_SEQ_LEN
+    struct.pack_into(">HH", buf, 0, type_no, seq_no % SEQ_MODULO)
+    return 2 + NARROW_SEQ_LEN
+
+
+def unpack_header(message: bytes, wide: bool = False):
+    '''
+    :return: (type_no, seq_no as on the wire, offset of the payload)
+    '''
+    end = 2 + seq_len(wide)
+    return int.from_bytes(message[:2], byteorder='big'), int.from_bytes(message[2:end], byteorder='big'), end
+
+
+def unwrap_seq(seq_no: int, ref_seq_no: int, wide: bool = False) -> int:
+    '''
+    Turn a sequence number read from the wire into the absolute one closest to ref_seq_no.
+    '''
+    if wide:
+        return seq_no
+    diff = (seq_no - ref_seq_no) % SEQ_MODULO
+    if diff > SEQ_MODULO // 2:
+        diff -= SEQ_MODULO
+    return ref_seq_no + diff
+
+
+def pack_sack(blocks, wide: bool = False) -> bytes:
+    '''
+    :param blocks: [start, end) absolute sequence ranges received above the cumulative ACK
+    '''
+    msg = b''
+    for start, end in blocks:
+        if not wide:
+            start, end = start % SEQ_MODULO, end % SEQ_MODULO
+        msg += start.to_bytes(seq_len(wide), byteorder='big', signed=False) + \
+               end.to_bytes(seq_len(wide), byteorder='big', signed=False)
+    return msg
+
+
+def unpack_sack(data: bytes, wide: bool = False):
+    '''
+    :return: [(start, end)] as on the wire, to be unwrapped by the caller
+    '''
+    size = seq_len(wide)
+    blocks = []
+    for i in range(0, len(data) - 2 * size + 1, 2 * size):
+        blocks.append((int.from_bytes(data[i:i + size], byteorder='big'),
+                       int.from_bytes(data[i + size:i + 2 * size], byteorder='big')))
+    return blocks
+
+
+def set_buffer_sizes(sock, sndbuf=None, rcvbuf=None):
+    '''
+    Size the kernel buffers of a socket, Linux doubles the value and caps it at net.core.wmem_max / rmem_max.
+    :return: (SO_SNDBUF, SO_RCVBUF) as granted
+    '''
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, int(sndbuf))
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(rcvbuf))
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+def effective_mss(mss: int, wide: bool) -> int:
+    '''
+    The segment size used with the negotiated header: 2-byte sequence numbers are unwrapped correctly only
+    if the window, hence one segment, spans less than half their space.
+    '''
+    return mss if wide else min(mss, SEQ_MODULO // 4)
+
+
+def pack_ranges(ranges) -> bytes:
+    '''
+    :param ranges: [start, end) byte offsets, 8 bytes each
+    '''
+    return b''.join(struct.pack(">QQ", start, end) for start, end in ranges)
+
+
+def unpack_ranges(data: bytes):
+    return [struct.unpack_from(">QQ", data, i) for i in range(0, len(data) - 15, 16)]
+
+
+def pack_files(files) -> bytes:
+    '''
+    :param files: [(stream offset, size, name)] records of a FILE segment
+    '''
+    msg = b''
+    for offset, size, name in files:
+        name = name.encode()
+        msg += struct.pack(FILE_RECORD_FORMAT, offset, size, len(name)) + name
+    return msg
+
+
+def unpack_files(data: bytes):
+    files = []
+    i = 0
+    record_len = struct.calcsize(FILE_RECORD_FORMAT)
+    while i + record_len <= len(data):
+        offset, size, name_len = struct.unpack_from(FILE_RECORD_FORMAT, data, i)
+        i += record_len
+        files.append((offset, size, bytes(data[i:i + name_len]).decode(errors="replace")))
+        i += name_len
+    return files
+
+
+def pack_options(options: dict) -> bytes:
+    '''
+    :param options: kind : value(bytes)
+    '''
+    msg = b''
+    for kind, value in options.items():
+        msg += kind.to_bytes(1, byteorder='big') + len(value).to_bytes(2, byteorder='big') + value
+    return msg
+
+
+def unpack_options(data: bytes) -> dict:
+    options = {}
+    i = 0
+    while i + 3 <= len(data):
+        kind = data[i]
+        length = int.from_bytes(data[i + 1:i + 3], byteorder='big')
+        options[kind] = bytes(data[i + 3:i + 3 + length])
+        i += 3 + length
+    return options
@@ -0,0 +1,224 @@
+# v2
+'''
+Per-packet trace of the sender and the receiver.
+
+Every snd/rcv/drop event and every change of the sender's congestion window is one fixed-size binary record (monotonic timestamp, event, segment type, session, sequence
+number, length) packed into preallocated chunks; a background thread appends the full chunks to the trace file. The
+text lines of Sender_log.txt / Receiver_log.txt are only produced on demand:
+
+    python3 ptptrace.py Sender_trace.bin [--merge Sender_log.txt] > Sender_trace.txt
+'''
+import argparse
+import heapq
+import logging
+import struct
+import sys
+import threading
+import time
+
+from ptp import GET_TYPE_DICT
+
+EVENT_START, EVENT_SND, EVENT_RCV, EVENT_DROP, EVENT_CWND = range(5)
+EVENT_NAMES = {EVENT_SND: "snd", EVENT_RCV: "rcv"}
+MAGIC = b"PTPT"
+VERSION = 1
+HEADER = struct.Struct("<4sBdQ")  # magic + version + wall clock and monotonic ns at the same instant
+RECORD = struct.Struct("<QBBHQI")  # monotonic ns + event + segment type + session + sequence number + length
+CHUNK_RECORDS = 4096  # records per chunk handed to the writer
+FLUSH_INTERVAL = 1  # seconds, a partly filled chunk is written after this long
+LOG_DATEFMT = '%Y-%m-%d:%H:%M:%S'
+TRACE_MODES = ("binary", "text", "off")
+
+
+def format_event(event: int, type_no: int, seq: int, length: int, time_diff) -> str:
+    '''
+    :return: the log line of one event, as written by logging.warning before the binary trace
+    '''
+    if event == EVENT_CWND:  # the window in bytes in the length field
+        return f"cwnd\t{time_diff}\t{length}"
+    name = GET_TYPE_DICT.get(type_no)
+    if event == EVENT_DROP:
+        return "ACKs packet dropped!" if name == "ACK" else f"{name} {seq} packet dropped!"
+    if name in ("DATA", "PARITY"):
+        return f"{EVENT_NAMES[event]}\t{time_diff}\t{name}{seq}\t{length}"
+    return f"{EVENT_NAMES[event]}\t{time_diff}\t{name}\t{seq}\t{length}"
+
+
+class NullTrace:
+    '''
+    Tracing turned off.
+    '''
+    def start(self, session: int = 0) -> None:
+        pass
+
+    def record(self, event: int, type_no: int, seq: int, length: int = 0, session: int = 0) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class TextTrace(NullTrace):
+    '''
+    The former behaviour: every event is formatted and logged at once.
+    '''
+    def __init__(self, sample: int = 1) -> None:
+        self.sample = max(int(sample), 1)
+        self.skipped = 0
+        self.start_times = {}  # session : monotonic start of the connection
+
+    def start(self, session: int = 0) -> None:
+        self.start_times[session] = time.monotonic()
+
+    def record(self, event: int, type_no: int, seq: int, length: int = 0, session: int = 0) -> None:
+        if self.sample > 1:
+            self.skipped += 1
+            if self.skipped < self.sample:
+                return
+            self.skipped = 0
+        time_diff = round((time.monotonic() - self.start_times.get(session, 0)) * 1000, 2)
+        logging.warning(format_event(event, type_no, seq, length, time_diff))
+
+
+class Trace(NullTrace):
+    '''
+    Binary trace: record() packs one RECORD into the current chunk, a writer thread appends the full chunks to the file.
+    '''
+    def __init__(self, filename: str, sample: int = 1) -> None:
+        '''
+        :param filename: the trace file, truncated.
+        :param sample: keep one event out of sample, the START events are always kept.
+        '''
+        self.sample = max(int(sample), 1)
+        self.skipped = 0
+        self.file = open(filename, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time(), time.monotonic_ns()))
+        self.lock = threading.Lock()
+        self.chunk = bytearray(CHUNK_RECORDS * RECORD.size)
+        self.pos = 0
+        self.full = []  # chunks waiting for the writer
+        self.free = [bytearray(CHUNK_RECORDS * RECORD.size)]  # chunks already written, reused
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def start(self, session: int = 0) -> None:
+        self.append(EVENT_START, 0, 0, 0, session)
+
+    def record(self, event: int, type_no: int, seq: int, length: int = 0, session: int = 0) -> None:
+        if self.sample > 1:
+            self.skipped += 1
+            if self.skipped < self.sample:
+                return
+            self.skipped = 0
+        self.append(event, type_no, seq, length, session)
+
+    def append(self, event, type_no, seq, length, session):
+        with self.lock:
+            RECORD.pack_into(self.chunk, self.pos, time.monotonic_ns(), event, type_no & 0xff, session & 0xffff,
+                             seq, length)
+            self.pos += RECORD.size
+            if self.pos == len(self.chunk):
+                self.full.append(self.chunk)
+                self.chunk = self.free.pop() if self.free else bytearray(len(self.chunk))
+                self.pos = 0
+                self.wakeup.set()
+
+    def write_loop(self):
+        while not self.closed:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            full, self.full = self.full, []
+            partial = bytes(self.chunk[:self.pos])
+            self.pos = 0
+        for chunk in full:
+            self.file.write(chunk)
+        self.file.write(partial)
+        self.file.flush()
+        with self.lock:
+            self.free.extend(full)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.writer.join()
+        self.flush()
+        self.file.close()
+
+
+def open_trace(mode: str, filename: str, sample: int = 1):
+    '''
+    :param mode: one of TRACE_MODES
+    '''
+    if mode == "binary":
+        return Trace(filename, sample)
+    if mode == "text":
+        return TextTrace(sample)
+    return NullTrace()
+
+
+def read_records(filename: str):
+    '''
+    :return: (wall clock of the monotonic origin in seconds, iterator of (monotonic ns, event, type, session, seq, length))
+    '''
+    with open(filename, "rb") as file:
+        data = file.read()
+    magic, version, wall, mono = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{filename} is not a PTP trace")
+    # a record cut by a crash is ignored
+    end = HEADER.size + (len(data) - HEADER.size) // RECORD.size * RECORD.size
+    return wall - mono / 1e9, RECORD.iter_unpack(memoryview(data)[HEADER.size:end])
+
+
+def render(filename: str):
+    '''
+    :return: iterator of (wall clock, log line) in the format of the text logs
+    '''
+    origin, records = read_records(filename)
+    start_times = {}  # session : monotonic ns of its start
+    for timestamp, event, type_no, session, seq, length in records:
+        if event == EVENT_START:
+            start_times[session] = timestamp
+            continue
+        wall = origin + timestamp / 1e9
+        time_diff = round((timestamp - start_times.get(session, timestamp)) / 1e6, 2)
+        prefix = time.strftime(LOG_DATEFMT, time.localtime(wall)) + f",{int(wall * 1000) % 1000:03d} WARNING  "
+        yield wall, prefix + format_event(event, type_no, seq, length, time_diff)
+
+
+def read_log(filename: str):
+    '''
+    :return: iterator of (wall clock, line) of a text log, continuation lines keep the time of the line before
+    '''
+    wall = 0
+    with open(filename) as file:
+        for line in file:
+            try:
+                wall = time.mktime(time.strptime(line[:19], LOG_DATEFMT)) + int(line[20:23]) / 1000
+            except ValueError:
+                pass
+            yield wall, line.rstrip("\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python3 ptptrace.py Sender_trace.bin [--merge Sender_log.txt]")
+    parser.add_argument("trace")
+    parser.add_argument("--merge", metavar="LOG", help="interleave the lines of this text log by time")
+    args = parser.parse_args()
+
+    lines = render(args.trace)
+    if args.merge:
+        lines = heapq.merge(read_log(args.merge), lines, key=lambda line: line[0])
+    try:
+        for _, line in lines:
+            sys.stdout.write(line + "\n")
+    except BrokenPipeError:
+        pass
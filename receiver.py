@@ -4,21 +4,83 @@ import logging, sys  # to write the log
 import socket  # Core lib, to send packet via UDP socket
 from threading import Thread  # (Optional)threading will make the timer easily implemented
 import random  # for flp and rlp function
-from collections import defaultdict
+import os
+import argparse
+import struct
+import json
+import mmap
+import multiprocessing, queue, signal  # worker processes of the server
+import heapq  # delayed ACK timers
+import bisect
+from ptp import (
+    TYPE_DICT, GET_TYPE_DICT, SEQ_MODULO, OPT_WIDE_SEQ, OPT_FILE_SIZE, OPT_MSS, MAX_MSS, OPT_RESUME,
+    RESUME_TOKEN_LEN, OPT_DELTA, OPT_COMPRESS, OPT_FEC, OPT_RWND, RWND_LEN, OPT_FILES, PARITY_FORMAT,
+    FLAG_COMPRESSED, CODECS, OPT_STRIPED, OPT_STRIPE, STRIPED_FORMAT, STRIPE_FORMAT, effective_mss,
+    set_buffer_sizes, xor_payloads, pack_ranges, unpack_files, pack_header, unpack_header, unwrap_seq, pack_sack,
+    pack_options, unpack_options)
+import delta
+from ptptrace import EVENT_SND, EVENT_RCV, EVENT_DROP, TRACE_MODES, open_trace
+from metrics import METRICS_INTERVAL, Metrics, MetricsDumper
 
-BUFFERSIZE = 1000000
+BUFFERSIZE = 1000000  # larger than any datagram, a GRO batch included, allocated once per receiver
+MAX_SACK_BLOCKS = 16  # received ranges above the cumulative ACK carried by one ACK segment
+WRITE_COALESCE = 256 * 1024  # complete bytes held in the reassembly ring before they are written to the file
+# Linux UDP generic receive offload, not exported by every Python build
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+GRO_ANCBUFSIZE = socket.CMSG_SPACE(4) if hasattr(socket, "CMSG_SPACE") else 0
+IDLE_TIMEOUT = 60  # seconds without a segment before a server session is expired
+STATS_INTERVAL = 5  # seconds between two stats reports of a server worker
+RESUME_SAVE_INTERVAL = 1  # seconds between two saves of the received ranges of a resumable transfer
+MAX_RESUME_RANGES = 2048  # received ranges offered back in one SYN ACK, the rest is sent again
+RCV_WINDOW = 8 * 1024 * 1024  # bytes above the cumulative ACK accepted, DATA beyond it is dropped
+MAX_OPEN_FILES = 256  # descriptors kept open by a multi-file session, the least recently opened is closed first
+ACK_DELAY = 0.002  # seconds an in-order segment waits for the next one before it is acked alone, kept below MIN_RTO
 
 
 
 class Receiver:
-    def __init__(self, receiver_port: int, sender_port: int, filename: str, flp: float, rlp: float) -> None:
+    def __init__(self, receiver_port: int, sender_port: int, filename: str, flp: float, rlp: float,
+                 preallocate: bool = False, gro: bool = False, server: bool = False,
+                 idle_timeout: float = IDLE_TIMEOUT, reuse_port: bool = False, stats_queue=None,
+                 worker_id: int = 0, max_mss: int = MAX_MSS, resume: bool = False, delta: bool = False,
+                 rcv_window: int = RCV_WINDOW, sndbuf=None, rcvbuf=None, trace: str = "binary", trace_sample: int = 1,
+                 trace_file: str = "Receiver_trace.bin", metrics_file=None,
+                 metrics_interval: float = METRICS_INTERVAL, ack_every: int = 1, ack_delay: float = ACK_DELAY) -> None:
         '''
         The server will be able to receive the file from the sender via UDP
         :param receiver_port: the UDP port number to be used by the receiver to receive PTP segments from the sender.
         :param sender_port: the UDP port number to be used by the sender to send PTP segments to the receiver.
-        :param filename: the name of the text file into which the text sent by the sender should be stored
+        :param filename: the name of the file into which the bytes sent by the sender should be stored. In server mode a
+            template, {host} {port} {session} are replaced per connection (appended before the extension if absent).
         :param flp: forward loss probability, which is the probability that any segment in the forward direction (Data, FIN, SYN) is lost.
         :param rlp: reverse loss probability, which is the probability of a segment in the reverse direction (i.e., ACKs) being lost.
+        :param preallocate: reserve the file size announced in the SYN on disk before the DATA arrives.
+        :param gro: let the kernel coalesce incoming datagrams (UDP_GRO) and split them here, falls back to one recvfrom per datagram.
+        :param server: keep running after a FIN/RESET and accept concurrent senders, one session per sender address.
+        :param idle_timeout: seconds without a segment before a server session is closed and dropped.
+        :param reuse_port: bind with SO_REUSEPORT so that several worker processes share the port, the kernel hashes
+            each sender address to one of them.
+        :param stats_queue: a multiprocessing queue to which the stats are reported every STATS_INTERVAL seconds.
+        :param worker_id: the index of this worker, sent along with its stats.
+        :param max_mss: the largest DATA payload accepted, an MSS offered above it is lowered in the SYN ACK.
+        :param resume: save the received ranges next to the output file ("<file>.resume") until the FIN, and offer
+            them back to a sender reconnecting with the same resume token.
+        :param delta: accept the delta sync when the output file already exists: its block signatures are sent to
+            the sender, the new version is built in "<file>.delta" from copied blocks and DATA, and renamed at the FIN.
+        :param rcv_window: the reassembly window in bytes above the cumulative ACK. DATA beyond it is dropped, and the
+            ACKs advertise what is left of it once the payloads held in memory are taken off.
+        :param sndbuf: SO_SNDBUF of the socket in bytes, the system default if None.
+        :param rcvbuf: SO_RCVBUF of the socket in bytes, the system default if None. Bursts larger than it are
+            dropped by the kernel before they are read.
+        :param trace: where the per-segment events go, one of ptptrace.TRACE_MODES: "binary" records in trace_file
+            (rendered by ptptrace.py, the session counter tells the sessions apart), "text" lines in the log, or "off".
+        :param trace_sample: keep one per-segment event out of trace_sample.
+        :param metrics_file: dump metrics_snapshot() as JSON to this file every metrics_interval seconds, None for no
+            dump. Each session logs its metrics as a summary line when it ends either way.
+        :param ack_every: delayed ACKs, one ACK for every ack_every in-order DATA segments or after ack_delay seconds.
+            Out-of-order DATA, duplicates and the segments filling a gap are acked at once. 1 acks every segment.
+        :param ack_delay: the longest an in-order segment waits for its ACK, in seconds.
         '''
         self.address = "127.0.0.1"  # change it to 0.0.0.0 or public ipv4 address if want to test it between different computers
         self.receiver_port = int(receiver_port)
@@ -27,129 +89,1137 @@ class Receiver:
         self.filename = filename
         self.flp = flp
         self.rlp = rlp
+        self.preallocate = preallocate
+        self.server = server
+        self.idle_timeout = float(idle_timeout)
+        self.max_mss = min(int(max_mss), MAX_MSS)
+        self.resume = resume
+        self.delta = delta
+        self.rcv_window = int(rcv_window)
+        self.trace = open_trace(trace, trace_file, trace_sample)
+        self.ack_every = max(int(ack_every), 1)
+        self.ack_delay = float(ack_delay)
+        self.ack_timers = []  # heap of (deadline, counter, session) of the delayed ACKs, stale entries skipped
+        self.ack_timer_counter = 0
+        self.armed_deadline = None  # the delayed ACK deadline the socket timeout is set for, None for the idle 1 s
 
         # init the UDP socket
         # define socket for the server side and bind address
         logging.debug(f"The sender is using the address {self.server_address} to receive message!")
         self.receiver_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        if reuse_port:
+            self.receiver_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.receiver_socket.bind(self.server_address)
-        self.type_dict = {"DATA": 0, "ACK": 1, "SYN": 2, "FIN": 3, "RESET": 4}
-        self.get_type_dict = {0: "DATA", 1: "ACK", 2: "SYN", 3: "FIN", 4: "RESET"}
-        self.buffer = defaultdict(str)  # rev_seq_no : content
-        self.start_time = time.time()
-        # self.expected_seq_no = 0
-        self.revno_expno_dict = {}  # rev_seq_no : next_expected_rev_seq_no
-        self.all_rev_seqno = set()
+        granted = set_buffer_sizes(self.receiver_socket, sndbuf, rcvbuf)
+        logging.debug(f"SO_SNDBUF {granted[0]}, SO_RCVBUF {granted[1]}")
+        if rcvbuf and granted[1] < int(rcvbuf):
+            logging.warning(f"SO_RCVBUF\t{granted[1]}\tgranted of {rcvbuf}, raise net.core.rmem_max")
+        self.gro = False
+        if gro:
+            try:
+                self.receiver_socket.setsockopt(SOL_UDP, UDP_GRO, 1)
+                self.gro = hasattr(self.receiver_socket, "recvmsg")
+            except OSError:
+                logging.debug("UDP_GRO is not supported, one datagram per recvfrom")
+        if self.server or self.ack_every > 1:
+            self.receiver_socket.settimeout(1)  # wake up to expire idle sessions, or for the delayed ACKs
+        self.recv_buf = bytearray(BUFFERSIZE)  # every datagram is received into it, the sessions copy what they keep
+        self.recv_view = memoryview(self.recv_buf)
+        self.sessions = {}  # sender_address : Session
+        self.session_counter = 0
+        self.last_expiry = time.time()
+
+        self.stats_queue = stats_queue
+        self.worker_id = worker_id
+        self.last_stats = time.time()
+        self.stats = {"segments": 0, "bytes": 0, "sessions": 0, "finished": 0, "reset": 0, "expired": 0,
+                      "repaired": 0}
+        self.metrics_dumper = MetricsDumper(self.metrics_snapshot, metrics_file, metrics_interval) \
+            if metrics_file else None
 
     def run(self) -> None:
-        counter = 0
+        try:
+            self.serve()
+        finally:
+            self.trace.close()
+            if self.metrics_dumper is not None:
+                self.metrics_dumper.stop()
+
+
+    def serve(self) -> None:
         while True:
+            if self.server and time.time() - self.last_expiry >= 1:
+                self.expire_sessions()
+            if self.stats_queue is not None and time.time() - self.last_stats >= STATS_INTERVAL:
+                self.report_stats()
+
+            if self.ack_every > 1:
+                self.send_delayed_acks()
 
             # try to receive any incoming message from the sender
             try:
-                incoming_message, sender_address = self.receiver_socket.recvfrom(BUFFERSIZE)
-                rev_type_no = int.from_bytes(incoming_message[:2], byteorder='big')
-                rev_seq_no = int.from_bytes(incoming_message[2:4], byteorder='big')
+                datagrams, sender_address = self.receive()
             except OSError:
+                if self.receiver_socket.fileno() == -1:  # closed after FIN/RESET
+                    break
                 continue
 
-            # rev SYN
-            if rev_type_no == 2:
-                # randomly drop SYN packets
-                if random.randint(1, 100) < float(self.flp) * 100:
-                    logging.warning("SYN packet dropped!")
-                    continue
-                counter += 1
-                if counter == 1:
-                    self.start_time = time.time()
-                    logging.warning(f"rcv\t0\t{self.get_type_dict[rev_type_no]}\t{rev_seq_no}\t0")
-
-                else:
-                    time_diff = round((time.time() - self.start_time) * 1000, 2)
-                    logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_seq_no}\t0")
-
-                syn_msg = self.type_dict["ACK"].to_bytes(2, byteorder='big', signed=False) + \
-                          (rev_seq_no + 1).to_bytes(2, byteorder='big', signed=False)
-                time_diff = round((time.time() - self.start_time) * 1000, 2)
-                logging.warning(f"snd\t{time_diff}\tACK\t{rev_seq_no + 1}\t0")
-
-                # randomly drop ACK packets
-                if random.randint(1, 100) < float(self.rlp) * 100:
-                    logging.warning("ACKs packet dropped!")
-                    continue
-                else:
-                    self.receiver_socket.sendto(syn_msg, sender_address)
-                    self.expected_seq_no = rev_seq_no + 1
-
-            # rev FIN
-            elif rev_type_no == 3:
-                # randomly drop FIN packets
-                if random.randint(1, 100) < float(self.flp) * 100:
-                    logging.warning("FIN packet dropped!")
-                    continue
-                time_diff = round((time.time() - self.start_time) * 1000, 2)
-                logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_seq_no}\t0")
+            for incoming_message in datagrams:
+                if self.receiver_socket.fileno() == -1:
+                    break
+                self.handle(incoming_message, sender_address)
 
-                syn_msg = self.type_dict["ACK"].to_bytes(2, byteorder='big', signed=False) + \
-                          (rev_seq_no + 1).to_bytes(2, byteorder='big', signed=False)
-                time_diff = round((time.time() - self.start_time) * 1000, 2)
-                logging.warning(f"snd\t{time_diff}\tACK\t{rev_seq_no + 1}\t0")
-                # randomly drop ACK packets
-                if random.randint(1, 100) < float(self.rlp) * 100:
-                    logging.warning("ACKs packet dropped!")
-                    continue
-                else:
-                    self.receiver_socket.sendto(syn_msg, sender_address)
-                    logging.debug("socket closed")
-                    self.receiver_socket.close()
-
-
-            # rev DATA
-            elif rev_type_no == 0:
-                # randomly drop data packets
-                if random.randint(1, 100) < float(self.flp) * 100:
-                    logging.warning(f"DATA {rev_seq_no} packet dropped!")
-                    continue
-
-                with open(self.filename, "a") as file:
-                    content = incoming_message[4:].decode()
-                    length = len(content)
-                    time_diff = round((time.time() - self.start_time) * 1000, 2)
-                    logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}{rev_seq_no}\t{length}")
-                    self.revno_expno_dict[rev_seq_no] = (rev_seq_no + length) % 65535
-
-                    if rev_seq_no not in self.all_rev_seqno:
-                        self.all_rev_seqno.add(rev_seq_no)
-                        self.buffer[rev_seq_no] = content
-                    while self.expected_seq_no in self.buffer:
-                        file.write(self.buffer[self.expected_seq_no])
-                        del self.buffer[self.expected_seq_no]
-                        self.expected_seq_no = self.revno_expno_dict[self.expected_seq_no]
-
-                # reply "ACK"
-                ack_seq_no = self.expected_seq_no
-                reply_message = self.type_dict["ACK"].to_bytes(2, byteorder='big', signed=False) + \
-                                ack_seq_no.to_bytes(2, byteorder='big', signed=False)
-                time_diff = round((time.time() - self.start_time) * 1000, 2)
-                logging.warning(f"snd\t{time_diff}\tACK\t{ack_seq_no}\t0")
 
-                # randomly drop ACK packets
-                if random.randint(1, 100) < float(self.rlp) * 100:
-                    logging.warning("ACKs packet dropped!")
-                    continue
-                else:
-                    self.receiver_socket.sendto(reply_message, sender_address)
+    def handle(self, incoming_message, sender_address) -> None:
+        # demultiplex by sender address, only a SYN opens a session
+        self.stats["segments"] += 1
+        session = self.sessions.get(sender_address)
+        is_syn = int.from_bytes(incoming_message[:2], byteorder='big') == TYPE_DICT["SYN"]
+        if session is None or (is_syn and session.finished):
+            if not is_syn:
+                return
+            self.session_counter += 1
+            self.stats["sessions"] += 1
+            session = Session(self, sender_address, self.session_filename(sender_address))
+            self.sessions[sender_address] = session
+        session.handle(incoming_message)
+
+
+    def schedule_ack(self, session):
+        # arm the delayed ACK timer of a session
+        session.ack_deadline = time.monotonic() + self.ack_delay
+        self.ack_timer_counter += 1
+        heapq.heappush(self.ack_timers, (session.ack_deadline, self.ack_timer_counter, session))
+
+
+    def send_delayed_acks(self):
+        # send the delayed ACKs that are due, and wait for the next one at most in the recvfrom
+        now = time.monotonic()
+        while self.ack_timers and self.ack_timers[0][0] <= now:
+            deadline, _, session = heapq.heappop(self.ack_timers)
+            if session.ack_deadline == deadline and session.output is not None:  # not acked since
+                session.metrics.add("acks_delayed")
+                session.send_ack()
+        if self.receiver_socket.fileno() == -1:  # closed after FIN/RESET
+            return
+        # settimeout only when the head of the heap changes, the ACK is late by at most the armed timeout
+        deadline = self.ack_timers[0][0] if self.ack_timers else None
+        if deadline == self.armed_deadline:
+            return
+        self.armed_deadline = deadline
+        timeout = min(deadline - now, 1) if deadline is not None else 1
+        self.receiver_socket.settimeout(max(timeout, 0.0001))
+
+
+    def session_filename(self, sender_address, session=None):
+        '''
+        :param session: the {session} value, the session counter if None (the transfer id of a striped transfer,
+            the same in every worker).
+        '''
+        if not self.server:
+            return self.filename
+        host, port = sender_address[:2]
+        if session is None:
+            session = self.session_counter
+        if "{" in self.filename:
+            return self.filename.format(host=host, port=port, session=session)
+        stem, ext = os.path.splitext(self.filename)
+        return f"{stem}_{host}_{port}_{session}{ext}"
+
+
+    def end_session(self, session, reset=False):
+        '''
+        Called by a session after its FIN/RESET. A single-file receiver closes its socket, a server keeps a finished
+        session until it expires so that a resent FIN is still acked.
+        '''
+        self.stats["reset" if reset else "finished"] += 1
+        if not self.server:
+            logging.debug("socket closed")
+            self.receiver_socket.close()
+        elif reset:
+            self.sessions.pop(session.sender_address, None)
+
+
+    def expire_sessions(self):
+        self.last_expiry = time.time()
+        for sender_address, session in list(self.sessions.items()):
+            if self.last_expiry - session.last_active > self.idle_timeout:
+                if not session.finished:
+                    logging.warning(f"session {sender_address} expired after {self.idle_timeout}s idle")
+                    self.stats["expired"] += 1
+                    session.save_resume()
+                    session.log_summary()
+                session.close_file()
+                session.finish_delta(False)
+                del self.sessions[sender_address]
+
+
+    def metrics_snapshot(self):
+        '''
+        :return: the server stats and the metrics of every session still kept, as a JSON-ready dict
+        '''
+        return {"stats": dict(self.stats),
+                "sessions": {str(session.session_id): session.metrics_snapshot()
+                             for session in list(self.sessions.values())}}
+
+
+    def report_stats(self):
+        self.last_stats = time.time()
+        self.stats_queue.put((self.worker_id, dict(self.stats, active=sum(not session.finished for session in self.sessions.values()))))
+
+
+    def close(self):
+        # flush the files of the open sessions, a worker being stopped
+        for session in self.sessions.values():
+            session.close_file()
+        self.sessions.clear()
+        if self.stats_queue is not None:
+            self.report_stats()
+        self.receiver_socket.close()
+
+
+    def receive(self):
+        '''
+        :return: the datagrams read by one recvmsg call (several when the kernel coalesced them with GRO), as memoryviews
+            of recv_buf valid until the next call, the sender address
+        '''
+        if not self.gro:
+            length, sender_address = self.receiver_socket.recvfrom_into(self.recv_buf)
+            return [self.recv_view[:length]], sender_address
+        length, ancdata, _, sender_address = self.receiver_socket.recvmsg_into([self.recv_buf], GRO_ANCBUFSIZE)
+        incoming_message = self.recv_view[:length]
+        segment_size = 0
+        for level, type, data in ancdata:
+            if level == SOL_UDP and type == UDP_GRO:
+                segment_size = struct.unpack("=i", data[:4])[0]
+        if segment_size <= 0 or segment_size >= len(incoming_message):
+            return [incoming_message], sender_address
+        return [incoming_message[i:i + segment_size] for i in range(0, length, segment_size)], sender_address
+
 
-            # rev RESET
-            elif rev_type_no == 4:
+class Session:
+    '''
+    The state of one connection, the receiver keeps one per sender address.
+    '''
+    def __init__(self, receiver: Receiver, sender_address, filename: str) -> None:
+        '''
+        :param receiver: the Receiver owning the socket, the loss simulation and the options.
+        :param sender_address: (host, port) of the sender, the key of the session.
+        :param filename: the name of the file into which the bytes of this connection are stored.
+        '''
+        self.receiver = receiver
+        self.sender_address = sender_address
+        self.session_id = receiver.session_counter  # tells the sessions apart in the trace and the metrics
+        self.metrics = Metrics()
+        self.highest_offset = 0  # end of the highest out-of-order segment, for the occupancy of the window
+        self.filename = filename
+        self.syn_counter = 0
+        self.buffer = {}  # offset : end offset, out-of-order segments already written at their offset
+        self.start_time = time.time()
+        self.last_active = time.time()
+        self.wide_seq = False  # 64-bit sequence numbers, negotiated in the SYN
+        self.data_isn = None  # sequence number of the first DATA byte, offset 0
+        self.expected_offset = 0
+        self.output = None  # OutputFile of the connection
+        self.finished = False  # FIN received
+        self.striped = None  # (transfer id, stripe count) if this is the control flow of a striped transfer
+        self.stripe = None  # (transfer id, control port, stripe index, offset) if this is one stripe
+        self.files = None  # file count of a multi-file session, the output is then a directory
+        self.resume_token = None  # offered in the SYN, the received ranges are saved under it
+        self.resume_option = None  # OPT_RESUME echoed in the SYN ACK, the same for a resent SYN
+        self.last_resume_save = time.time()
+        self.basis_map = None  # mmap of the existing copy in delta mode
+        self.basis_view = None
+        self.delta_block = None  # block size of the signatures
+        self.delta_option = None  # OPT_DELTA echoed in the SYN ACK
+        self.codec = None  # (name, compress, decompress) of compressed DATA segments
+        self.file_size = None  # announced in the SYN
+        self.fec_k = 0  # group size of the parity segments, 0 without FEC
+        self.fec_span = None  # bytes covered by one group, known from the first parity segment
+        self.fec_floor = 0  # groups below this offset are complete, their segments are no longer kept
+        self.fec_cache = {}  # offset : payload of the segments received in the groups not complete yet
+        self.fec_cache_bytes = 0
+        self.rwnd_ack = False  # the ACKs carry the receive window, negotiated in the SYN
+        self.fec_groups = {}  # offset of the group : (m, mss, {parity index : parity bytes})
+        self.ack_pending = 0  # in-order DATA segments received since the last ACK
+        self.ack_deadline = None  # monotonic time at which the delayed ACK is sent
+
+    def handle(self, incoming_message) -> None:
+        self.last_active = time.time()
+        rev_type_no = int.from_bytes(incoming_message[:2], byteorder='big')
+        # the SYN always carries the narrow header, the rest depends on the negotiation
+        rev_type_no, rev_seq_no, payload_start = unpack_header(incoming_message, self.wide_seq and rev_type_no != 2)
+        flags = rev_type_no & 0xff00
+        rev_type_no &= 0xff
+
+        # rev SYN
+        if rev_type_no == 2:
+            # randomly drop SYN packets
+            if random.randint(1, 100) < float(self.receiver.flp) * 100:
+                logging.warning("SYN packet dropped!")
+                self.metrics.add("drops_flp")
+                return
+            self.syn_counter += 1
+            if self.syn_counter == 1:
+                self.start_time = time.time()
+                self.receiver.trace.start(self.session_id)
+                logging.warning(f"rcv\t0\t{GET_TYPE_DICT[rev_type_no]}\t{rev_seq_no}\t0")
+
+            else:
                 time_diff = round((time.time() - self.start_time) * 1000, 2)
-                logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_seq_no}\t0")
+                logging.warning(f"rcv\t{time_diff}\t{GET_TYPE_DICT[rev_type_no]}\t{rev_seq_no}\t0")
+
+            # echo the accepted options
+            syn_options = unpack_options(incoming_message[payload_start:])
+            accepted_options = {}
+            if OPT_WIDE_SEQ in syn_options:
+                accepted_options[OPT_WIDE_SEQ] = b''
+            self.wide_seq = OPT_WIDE_SEQ in accepted_options
+            mss = None
+            if OPT_MSS in syn_options:
+                mss = min(int.from_bytes(syn_options[OPT_MSS], byteorder='big'), self.receiver.max_mss)
+                accepted_options[OPT_MSS] = mss.to_bytes(2, byteorder='big')
+            # striped transfers span several sessions, only a server keeps running for all of them
+            for kind, struct_format in ((OPT_STRIPED, STRIPED_FORMAT), (OPT_STRIPE, STRIPE_FORMAT)):
+                if self.receiver.server and len(syn_options.get(kind, b'')) == struct.calcsize(struct_format):
+                    accepted_options[kind] = syn_options[kind]
+            if len(syn_options.get(OPT_FILES, b'')) == 4 and \
+                    OPT_STRIPED not in accepted_options and OPT_STRIPE not in accepted_options:
+                accepted_options[OPT_FILES] = syn_options[OPT_FILES]
+            if self.data_isn != rev_seq_no + 1:  # a new connection, not a resent SYN
+                self.save_resume()  # the previous connection of this sender, interrupted
+                self.striped = struct.unpack(STRIPED_FORMAT, accepted_options[OPT_STRIPED]) \
+                    if OPT_STRIPED in accepted_options else None
+                self.stripe = struct.unpack(STRIPE_FORMAT, accepted_options[OPT_STRIPE]) \
+                    if OPT_STRIPE in accepted_options else None
+                self.files = int.from_bytes(accepted_options[OPT_FILES], byteorder='big') \
+                    if OPT_FILES in accepted_options else None
+                self.data_isn = rev_seq_no + 1
+                self.expected_offset = 0
+                self.buffer.clear()
+                self.file_size = int.from_bytes(syn_options[OPT_FILE_SIZE], byteorder='big') \
+                    if OPT_FILE_SIZE in syn_options else None
+                self.fec_span = None
+                self.fec_floor = 0
+                self.fec_cache.clear()
+                self.fec_cache_bytes = 0
+                self.fec_groups.clear()
+                resumed_ranges = self.load_resume(syn_options, mss)
+                self.finish_delta(False)
+                if resumed_ranges is None:
+                    self.open_basis(syn_options, mss)
+                self.open_file(self.file_size, truncate=resumed_ranges is None)
+                for start, end in resumed_ranges or []:
+                    self.mark_received(start, end)
+            if self.resume_option is not None:
+                accepted_options[OPT_RESUME] = self.resume_option
+            if self.delta_option is not None:
+                accepted_options[OPT_DELTA] = self.delta_option
+            # the first codec offered that is installed here
+            codec_ids = [codec_id for codec_id in syn_options.get(OPT_COMPRESS, b'') if codec_id in CODECS]
+            if codec_ids:
+                accepted_options[OPT_COMPRESS] = bytes(codec_ids[:1])
+            self.codec = CODECS[codec_ids[0]] if codec_ids else None
+            # lost segments are rebuilt from the parity, the size of the file gives the length of the last one
+            self.fec_k = syn_options.get(OPT_FEC, b'\0')[0] if self.file_size is not None else 0
+            if self.fec_k and not self.wide_seq and (mss is None or self.fec_k * effective_mss(mss, False) >= SEQ_MODULO // 2):
+                # the PARITY header carries the first sequence number of its group, unwrapped against expected_offset
+                self.fec_k = 0
+            if self.fec_k:
+                accepted_options[OPT_FEC] = bytes([self.fec_k])
+            self.rwnd_ack = OPT_RWND in syn_options
+            if self.rwnd_ack:
+                accepted_options[OPT_RWND] = b''
+
+            syn_msg = pack_header(TYPE_DICT["ACK"], rev_seq_no + 1) + pack_options(accepted_options)
+            time_diff = round((time.time() - self.start_time) * 1000, 2)
+            logging.warning(f"snd\t{time_diff}\tACK\t{rev_seq_no + 1}\t0")
+
+            # randomly drop ACK packets
+            if random.randint(1, 100) < float(self.receiver.rlp) * 100:
+                logging.warning("ACKs packet dropped!")
+                self.metrics.add("drops_rlp")
+                return
+            else:
+                self.receiver.receiver_socket.sendto(syn_msg, self.sender_address)
+
+        # rev FIN
+        elif rev_type_no == 3:
+            # randomly drop FIN packets
+            if random.randint(1, 100) < float(self.receiver.flp) * 100:
+                logging.warning("FIN packet dropped!")
+                self.metrics.add("drops_flp")
+                return
+            time_diff = round((time.time() - self.start_time) * 1000, 2)
+            logging.warning(f"rcv\t{time_diff}\t{GET_TYPE_DICT[rev_type_no]}\t{rev_seq_no}\t0")
+
+            syn_msg = pack_header(TYPE_DICT["ACK"], rev_seq_no + 1, self.wide_seq)
+            time_diff = round((time.time() - self.start_time) * 1000, 2)
+            logging.warning(f"snd\t{time_diff}\tACK\t{rev_seq_no + 1}\t0")
+            # randomly drop ACK packets
+            if random.randint(1, 100) < float(self.receiver.rlp) * 100:
+                logging.warning("ACKs packet dropped!")
+                self.metrics.add("drops_rlp")
+                return
+            else:
+                self.receiver.receiver_socket.sendto(syn_msg, self.sender_address)
+                self.close_file()
+                if self.resume_token is not None and not self.finished and os.path.exists(self.filename + ".resume"):
+                    os.remove(self.filename + ".resume")
+                if self.basis_map is not None:
+                    self.finish_delta(True)
+                if self.striped is not None and not self.finished:
+                    # the control flow is finished after every stripe, the file is complete
+                    os.replace(self.filename + ".part", self.filename)
+                    logging.warning(f"striped transfer {self.striped[0]:08x} of {self.striped[1]} stripes completed")
+                if self.files is not None and not self.finished:
+                    logging.warning(f"{self.files} files received into {self.filename}")
+                self.finished = True
+                self.log_summary()
+                self.receiver.end_session(self)
+
+
+        # rev DATA
+        elif rev_type_no == 0:
+            # randomly drop data packets
+            if random.randint(1, 100) < float(self.receiver.flp) * 100:
+                self.receiver.trace.record(EVENT_DROP, rev_type_no, rev_seq_no, 0, self.session_id)
+                self.metrics.add("drops_flp")
+                return
+
+            if self.data_isn is None or self.output is None:  # no SYN yet, or already finished
+                return
+
+            content = memoryview(incoming_message)[payload_start:]
+            if flags & FLAG_COMPRESSED:
+                if self.codec is None:
+                    return
+                content = memoryview(self.codec[2](content, MAX_MSS))
+            self.receiver.trace.record(EVENT_RCV, rev_type_no, rev_seq_no, len(content), self.session_id)
+            self.metrics.add("segments_received")
+            self.metrics.add("bytes_received", len(content))
+            offset = unwrap_seq(rev_seq_no, self.data_isn + self.expected_offset, self.wide_seq) - self.data_isn
+            # only the next segment, with no gap above it, may wait for its ACK; the last one of the file may not
+            in_order = offset == self.expected_offset and not self.buffer
+            if self.accept_data(offset, content):
+                in_order = in_order and not self.buffer and self.expected_offset == offset + len(content) != self.file_size
+            else:
+                in_order = False
+            self.metrics.observe_occupancy(max(self.highest_offset - self.expected_offset, 0), self.receiver.rcv_window)
+            if self.resume_token is not None and time.time() - self.last_resume_save >= RESUME_SAVE_INTERVAL:
+                self.save_resume()
+            if in_order and self.receiver.ack_every > 1:
+                self.delay_ack()
+            else:
+                self.send_ack()
+
+        # rev PROBE, echo the payload size. Not subject to flp/rlp: a lost probe is taken for a too large segment
+        elif rev_type_no == 5:
+            if self.data_isn is None:
+                return
+            length = len(incoming_message) - payload_start
+            time_diff = round((time.time() - self.start_time) * 1000, 2)
+            logging.warning(f"rcv\t{time_diff}\t{GET_TYPE_DICT[rev_type_no]}\t{rev_seq_no}\t{length}")
+            self.receiver.receiver_socket.sendto(pack_header(TYPE_DICT["PROBE"], length, self.wide_seq),
+                                                 self.sender_address)
+
+        # rev PARITY, rebuild the lost segment of the group if it is the only one, and report the losses to the sender
+        elif rev_type_no == 9:
+            if not self.fec_k or self.output is None:
+                return
+            if random.randint(1, 100) < float(self.receiver.flp) * 100:
+                self.receiver.trace.record(EVENT_DROP, rev_type_no, rev_seq_no, 0, self.session_id)
+                self.metrics.add("drops_flp")
+                return
+            k, m, index, mss = struct.unpack_from(PARITY_FORMAT, incoming_message, payload_start)
+            self.receiver.trace.record(EVENT_RCV, rev_type_no, rev_seq_no, mss, self.session_id)
+            first = unwrap_seq(rev_seq_no, self.data_isn + self.expected_offset, self.wide_seq) - self.data_isn
+            if k != self.fec_k or index >= m or not mss:
+                return
+            self.fec_span = k * mss
+            members = range(first + index * mss, min(first + self.fec_span, self.file_size), m * mss)
+            missing = 0
+            if first >= self.fec_floor:  # below, the whole group has been received
+                missing = sum(offset not in self.fec_cache for offset in members)
+                self.fec_groups.setdefault(first, (m, mss, {}))[2][index] = \
+                    bytes(incoming_message[payload_start + struct.calcsize(PARITY_FORMAT):])
+                if self.fec_repair(first, index):
+                    self.send_ack()
+
+            reply_message = pack_header(TYPE_DICT["PARITY"], rev_seq_no, self.wide_seq) + bytes([missing, len(members)])
+            if random.randint(1, 100) < float(self.receiver.rlp) * 100:
+                logging.warning("PARITY report dropped!")
+                self.metrics.add("drops_rlp")
+                return
+            self.receiver.receiver_socket.sendto(reply_message, self.sender_address)
+
+        # rev FILE, create the files of a multi-file session and echo the key
+        elif rev_type_no == 10:
+            if self.files is None or self.output is None:
+                return
+            if random.randint(1, 100) < float(self.receiver.flp) * 100:
+                logging.warning("FILE packet dropped!")
+                self.metrics.add("drops_flp")
+                return
+            key = bytes(incoming_message[payload_start:payload_start + 8])
+            records = unpack_files(incoming_message[payload_start + 8:])
+            time_diff = round((time.time() - self.start_time) * 1000, 2)
+            logging.warning(f"rcv\t{time_diff}\t{GET_TYPE_DICT[rev_type_no]}\t{int.from_bytes(key, byteorder='big')}\t{len(records)}")
+            for offset, size, name in records:
+                if self.output.add_file(offset, size, name):  # a resent FILE is only acked again
+                    self.metrics.add("files_announced")
+            if random.randint(1, 100) < float(self.receiver.rlp) * 100:
+                logging.warning("FILE ACK packet dropped!")
+                self.metrics.add("drops_rlp")
+                return
+            self.receiver.receiver_socket.sendto(pack_header(TYPE_DICT["FILE"], 0, self.wide_seq) + key,
+                                                 self.sender_address)
+
+        # rev SIGREQ, reply with the signatures of a batch of blocks of the existing copy
+        elif rev_type_no == 6:
+            if self.basis_view is None:
+                return
+            if random.randint(1, 100) < float(self.receiver.flp) * 100:
+                logging.warning("SIGREQ packet dropped!")
+                self.metrics.add("drops_flp")
+                return
+            key = bytes(incoming_message[payload_start:payload_start + 8])
+            first = int.from_bytes(key, byteorder='big')
+            time_diff = round((time.time() - self.start_time) * 1000, 2)
+            logging.warning(f"rcv\t{time_diff}\t{GET_TYPE_DICT[rev_type_no]}\t{first}\t0")
+            reply_message = pack_header(TYPE_DICT["SIG"], 0, self.wide_seq) + key + \
+                            delta.block_signatures(self.basis_view, self.delta_block, first, delta.SIG_BATCH)
+            if random.randint(1, 100) < float(self.receiver.rlp) * 100:
+                logging.warning("SIG packet dropped!")
+                self.metrics.add("drops_rlp")
+                return
+            self.receiver.receiver_socket.sendto(reply_message, self.sender_address)
+
+        # rev COPY, copy blocks of the existing copy into the new file and echo the key
+        elif rev_type_no == 8:
+            if self.basis_view is None or self.output is None:
+                return
+            if random.randint(1, 100) < float(self.receiver.flp) * 100:
+                logging.warning("COPY packet dropped!")
+                self.metrics.add("drops_flp")
+                return
+            key = bytes(incoming_message[payload_start:payload_start + 8])
+            copies = delta.unpack_copies(incoming_message[payload_start + 8:])
+            time_diff = round((time.time() - self.start_time) * 1000, 2)
+            logging.warning(f"rcv\t{time_diff}\t{GET_TYPE_DICT[rev_type_no]}\t{int.from_bytes(key, byteorder='big')}\t{len(copies)}")
+            for dst, src, length in copies:
+                if self.mark_received(dst, dst + length):  # a resent COPY is only acked again
+                    self.output.pwrite(self.basis_view[src:src + length], dst)
+                    self.metrics.add("bytes_copied", length)
+            if random.randint(1, 100) < float(self.receiver.rlp) * 100:
+                logging.warning("COPY ACK packet dropped!")
+                self.metrics.add("drops_rlp")
+                return
+            self.receiver.receiver_socket.sendto(pack_header(TYPE_DICT["COPY"], 0, self.wide_seq) + key,
+                                                 self.sender_address)
+
+        # rev RESET
+        elif rev_type_no == 4:
+            time_diff = round((time.time() - self.start_time) * 1000, 2)
+            logging.warning(f"rcv\t{time_diff}\t{GET_TYPE_DICT[rev_type_no]}\t{rev_seq_no}\t0")
+
+            self.save_resume()
+            self.close_file()
+            self.finish_delta(False)
+            self.log_summary()
+            self.receiver.end_session(self, reset=True)
+
+
+    def metrics_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        snapshot.update(sender=f"{self.sender_address[0]}:{self.sender_address[1]}", filename=self.filename,
+                        file_size=self.file_size, expected_offset=self.expected_offset,
+                        buffered_ranges=len(self.buffer), finished=self.finished)
+        return snapshot
+
+
+    def log_summary(self):
+        self.metrics.finish()
+        logging.warning(f"summary\t{json.dumps(self.metrics_snapshot())}")
+
+
+    def accept_data(self, offset, content):
+        '''
+        Write a received or rebuilt DATA payload and advance the cumulative ACK.
+        :return: True if the segment was not received yet
+        '''
+        length = len(content)
+        if offset == self.expected_offset:
+            self.output.store(offset, content)
+            self.expected_offset += length
+            # the following out-of-order segments are already held or on disk
+            while self.expected_offset in self.buffer:
+                self.expected_offset = self.buffer.pop(self.expected_offset)
+            self.output.advance(self.expected_offset)
+            self.metrics.add("bytes_delivered", self.expected_offset - offset)
+        elif self.expected_offset < offset and offset + length <= self.expected_offset + self.receiver.rcv_window \
+                and offset not in self.buffer:
+            self.output.store(offset, content)
+            self.buffer[offset] = offset + length
+            self.highest_offset = max(self.highest_offset, offset + length)
+            self.metrics.add("out_of_order")
+        else:
+            self.metrics.add("window_drops" if offset + length > self.expected_offset + self.receiver.rcv_window
+                             else "duplicates")
+            return False
+        self.receiver.stats["bytes"] += length
+        if self.fec_k:
+            self.fec_cache[offset] = bytes(content)
+            self.fec_cache_bytes += length
+            if self.fec_span:
+                first = offset - offset % self.fec_span
+                if first in self.fec_groups:  # the parity came first, this segment may be the last but one
+                    m, mss, _ = self.fec_groups[first]
+                    self.fec_repair(first, (offset - first) // mss % m)
+                if self.expected_offset - self.fec_floor >= self.fec_span:
+                    self.evict_groups()
+        return True
+
+
+    def fec_repair(self, first, index):
+        '''
+        Rebuild the segment of parity index of the group at offset first, if it is the only one missing.
+        :return: True if a segment has been rebuilt
+        '''
+        m, mss, parities = self.fec_groups[first]
+        if index not in parities:
+            return False
+        members = range(first + index * mss, min(first + self.fec_span, self.file_size), m * mss)
+        missing = [offset for offset in members if offset not in self.fec_cache]
+        if len(missing) > 1:
+            return False
+        parity = parities.pop(index)
+        if not missing:
+            return False
+        offset = missing[0]
+        parity = int.from_bytes(parity, byteorder='big') ^ \
+            xor_payloads((self.fec_cache[member] for member in members if member != offset), mss)
+        content = parity.to_bytes(mss, byteorder='big')[:min(mss, self.file_size - offset)]
+        time_diff = round((time.time() - self.start_time) * 1000, 2)
+        logging.warning(f"repaired\t{time_diff}\tDATA{self.data_isn + offset}\t{len(content)}")
+        self.receiver.stats["repaired"] += 1
+        self.metrics.add("repaired")
+        self.accept_data(offset, memoryview(content))
+        return True
+
+
+    def evict_groups(self):
+        # every segment below the cumulative ACK has arrived, the groups it has passed need no repair
+        self.fec_floor = self.expected_offset - self.expected_offset % self.fec_span
+        for offset in [offset for offset in self.fec_cache if offset < self.fec_floor]:
+            self.fec_cache_bytes -= len(self.fec_cache.pop(offset))
+        for first in [first for first in self.fec_groups if first < self.fec_floor]:
+            del self.fec_groups[first]
+
+
+    def delay_ack(self):
+        # one ACK for every ack_every in-order segments, the timer acks the rest
+        self.ack_pending += 1
+        if self.ack_pending >= self.receiver.ack_every:
+            self.send_ack()
+        elif self.ack_deadline is None:
+            self.receiver.schedule_ack(self)
+
+
+    def send_ack(self):
+        # reply "ACK" + SACK blocks, it acks the delayed segments too
+        self.ack_pending = 0
+        self.ack_deadline = None
+        ack_seq_no = self.data_isn + self.expected_offset
+        reply_message = pack_header(TYPE_DICT["ACK"], ack_seq_no, self.wide_seq)
+        if self.rwnd_ack:
+            reply_message += self.receive_window().to_bytes(RWND_LEN, byteorder='big')
+        reply_message += pack_sack(self.sack_blocks(), self.wide_seq)
+        if not self.wide_seq:
+            ack_seq_no %= SEQ_MODULO
+        self.receiver.trace.record(EVENT_SND, TYPE_DICT["ACK"], ack_seq_no, 0, self.session_id)
+        self.metrics.add("acks_sent")
+
+        # randomly drop ACK packets
+        if random.randint(1, 100) < float(self.receiver.rlp) * 100:
+            self.receiver.trace.record(EVENT_DROP, TYPE_DICT["ACK"], ack_seq_no, 0, self.session_id)
+            self.metrics.add("drops_rlp")
+            return
+        else:
+            self.receiver.receiver_socket.sendto(reply_message, self.sender_address)
+
+
+    def receive_window(self):
+        # the reassembly window minus the payloads held in memory: in-order bytes not written yet and FEC groups
+        held = self.output.complete - self.output.released if self.output is not None else 0
+        return min(max(self.receiver.rcv_window - held - self.fec_cache_bytes, 0), 2 ** (8 * RWND_LEN) - 1)
+
+
+    def sack_blocks(self):
+        '''
+        The out-of-order ranges held in the buffer, merged into [start, end) sequence blocks above the cumulative ACK.
+        '''
+        blocks = []
+        for offset in sorted(self.buffer):
+            if blocks and blocks[-1][1] == self.data_isn + offset:
+                blocks[-1][1] = self.data_isn + self.buffer[offset]
+            elif len(blocks) == MAX_SACK_BLOCKS:
+                break
+            else:
+                blocks.append([self.data_isn + offset, self.data_isn + self.buffer[offset]])
+        return blocks
+
+
+    def mark_received(self, start, end):
+        '''
+        Record a range written outside the DATA path (resumed or copied).
+        :return: True if the range was not received yet
+        '''
+        if start == self.expected_offset:
+            self.expected_offset = end
+            while self.expected_offset in self.buffer:
+                self.expected_offset = self.buffer.pop(self.expected_offset)
+            return True
+        if start > self.expected_offset and start not in self.buffer:
+            self.buffer[start] = end
+            return True
+        return False
+
+
+    def open_basis(self, syn_options, mss):
+        # delta mode: map the existing copy, the new version is written next to it
+        # the COPY runs are skipped by the DATA, the narrow sequence numbers cannot span such gaps
+        if not self.receiver.delta or OPT_DELTA not in syn_options or mss is None or not self.wide_seq or \
+                self.striped is not None or self.stripe is not None or self.files is not None:
+            return
+        try:
+            with open(self.filename, "rb") as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return
+                self.basis_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return
+        self.basis_view = memoryview(self.basis_map)
+        self.delta_block = max(delta.BLOCK_SIZE, effective_mss(mss, self.wide_seq))
+        self.delta_option = self.delta_block.to_bytes(4, byteorder='big') + len(self.basis_map).to_bytes(8, byteorder='big')
+        self.resume_token = None  # the .delta file is not resumable
+        self.resume_option = None
+
+
+    def finish_delta(self, complete):
+        # unmap the existing copy, replace it by the new version or drop an unfinished one
+        self.delta_option = None
+        if self.basis_map is None:
+            return
+        self.basis_view.release()
+        self.basis_map.close()
+        self.basis_view = None
+        self.basis_map = None
+        if complete:
+            os.replace(self.filename + ".delta", self.filename)
+        elif os.path.exists(self.filename + ".delta"):
+            self.close_file()
+            os.remove(self.filename + ".delta")
+
+
+    def received_ranges(self):
+        # every [start, end) offset range on disk, the in-order prefix included
+        ranges = [[0, self.expected_offset]] if self.expected_offset else []
+        for offset in sorted(self.buffer):
+            if ranges and ranges[-1][1] == offset:
+                ranges[-1][1] = self.buffer[offset]
+            else:
+                ranges.append([offset, self.buffer[offset]])
+        return ranges
+
+
+    def load_resume(self, syn_options, mss):
+        '''
+        Look up the ranges saved by an interrupted transfer of the same file and prepare the OPT_RESUME echo.
+        :param mss: the negotiated segment size, None if the sender did not offer one.
+        :return: the [start, end) offsets already on disk, cut to the segment boundaries of this connection, or None
+            to start from an empty file
+        '''
+        self.resume_token = None
+        self.resume_option = None
+        token = syn_options.get(OPT_RESUME, b'')
+        if not self.receiver.resume or len(token) != RESUME_TOKEN_LEN or mss is None or \
+                self.striped is not None or self.stripe is not None or self.files is not None:
+            return None
+        self.resume_token = token
+        self.resume_option = token
+        file_size = int.from_bytes(token[8:], byteorder='big')
+        try:
+            with open(self.filename + ".resume") as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if state.get("token") != token.hex() or not os.path.exists(self.filename):
+            return None
+        # segments are cut again with this connection's MSS, partially received ones are sent again
+        mss = effective_mss(mss, self.wide_seq)
+        ranges = []
+        for start, end in state.get("ranges", []):
+            start = -(-start // mss) * mss
+            if end != file_size:
+                end = end // mss * mss
+            if start < end:
+                ranges.append((start, end))
+        if not self.wide_seq:
+            # the sender skips the resumed ranges, the narrow sequence numbers cannot span a gap after the first hole
+            ranges = ranges[:1] if ranges and ranges[0][0] == 0 else []
+        ranges = ranges[:MAX_RESUME_RANGES]
+        self.resume_option = token + pack_ranges(ranges)
+        logging.warning(f"resume\t{sum(end - start for start, end in ranges)}\tbytes already received")
+        return ranges
+
+
+    def save_resume(self):
+        # written next to the output file, the data it describes is flushed first
+        if self.resume_token is None or self.output is None:
+            return
+        self.output.flush()
+        self.last_resume_save = time.time()
+        path = self.filename + ".resume"
+        with open(path + ".tmp", "w") as file:
+            json.dump({"token": self.resume_token.hex(), "ranges": self.received_ranges()}, file)
+        os.replace(path + ".tmp", path)
+
+
+    def open_file(self, file_size=None, truncate=True):
+        # one output file per connection, opened at the SYN
+        self.close_file()
+        # the window above the cumulative ACK plus the complete bytes not written yet, never more than the file
+        ring_size = self.receiver.rcv_window + WRITE_COALESCE
+        if file_size is not None:
+            ring_size = min(ring_size, file_size)
+        if self.striped is not None:
+            # the control flow creates the .part file shared by the stripes, renamed at its FIN
+            self.filename = self.receiver.session_filename(self.sender_address, f"{self.striped[0]:08x}")
+            self.output = OutputFile(self.filename + ".part", file_size, self.receiver.preallocate, ring_size=ring_size)
+        elif self.stripe is not None:
+            transfer_id, control_port, _, offset = self.stripe
+            self.filename = self.receiver.session_filename((self.sender_address[0], control_port), f"{transfer_id:08x}")
+            self.output = OutputFile(self.filename + ".part", truncate=False, base_offset=offset, ring_size=ring_size)
+        elif self.files is not None:
+            self.output = OutputFiles(self.filename, self.receiver.preallocate, ring_size=ring_size)
+        elif self.basis_map is not None:
+            self.output = OutputFile(self.filename + ".delta", file_size, self.receiver.preallocate, ring_size=ring_size)
+        else:
+            self.output = OutputFile(self.filename, file_size, self.receiver.preallocate, truncate=truncate,
+                                     ring_size=ring_size)
+
+
+    def close_file(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+
+def run_worker(worker_id: int, receiver_kwargs: dict, stats_queue) -> None:
+    '''
+    Entry point of a worker process: a server Receiver bound with SO_REUSEPORT, logging to its own file.
+    '''
+    logging.basicConfig(
+        filename=f"Receiver_log_{worker_id}.txt",
+        level=logging.WARNING,
+        format='%(asctime)s,%(msecs)03d %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d:%H:%M:%S',
+        force=True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor stops the workers
+    if receiver_kwargs.get("metrics_file"):
+        stem, ext = os.path.splitext(receiver_kwargs["metrics_file"])
+        receiver_kwargs = dict(receiver_kwargs, metrics_file=f"{stem}_{worker_id}{ext}")
+    receiver = Receiver(**receiver_kwargs, server=True, reuse_port=True, stats_queue=stats_queue, worker_id=worker_id,
+                        trace_file=f"Receiver_trace_{worker_id}.bin")
+    try:
+        receiver.run()
+    finally:
+        receiver.close()
+
+
+class Supervisor:
+    '''
+    Forks the server workers, all bound to the same port, and aggregates the stats they report.
+    Every session is owned by the worker the kernel hashes its sender address to.
+    '''
+    def __init__(self, workers: int, receiver_kwargs: dict) -> None:
+        '''
+        :param workers: the number of worker processes.
+        :param receiver_kwargs: the Receiver arguments shared by the workers.
+        '''
+        self.stats_queue = multiprocessing.Queue()
+        self.worker_stats = {}  # worker_id : last reported stats, cumulative
+        self.processes = [multiprocessing.Process(target=run_worker, args=(i, receiver_kwargs, self.stats_queue),
+                                                  daemon=True) for i in range(workers)]
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        for process in self.processes:
+            process.start()
+        last_report = time.time()
+        try:
+            while any(process.is_alive() for process in self.processes):
+                self.collect(1)
+                if time.time() - last_report >= STATS_INTERVAL and self.worker_stats:
+                    last_report = time.time()
+                    logging.warning(f"stats\t{self.format_stats()}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in self.processes:
+                process.terminate()
+            for process in self.processes:
+                process.join()
+            self.collect(0)
+            logging.warning(f"stats\t{self.format_stats()}")
+
+    def collect(self, timeout: float) -> None:
+        try:
+            while True:
+                worker_id, stats = self.stats_queue.get(timeout=timeout)
+                self.worker_stats[worker_id] = stats
+                timeout = 0
+        except queue.Empty:
+            pass
+
+    def total(self) -> dict:
+        total = {}
+        for stats in self.worker_stats.values():
+            for key, value in stats.items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    def format_stats(self) -> str:
+        per_worker = " ".join(f"w{worker_id}:{stats['sessions']}/{stats['bytes']}"
+                              for worker_id, stats in sorted(self.worker_stats.items()))
+        return "\t".join(f"{key}={value}" for key, value in self.total().items()) + f"\t{per_worker}"
+
+
+class ReassemblyRing:
+    '''
+    The preallocated reassembly buffer of a connection. DATA payloads are copied once into a bytearray at their offset
+    modulo its size and indexed as [start, end) runs, merged as they touch; runs are released to the writer as
+    memoryviews of the ring, so nothing is allocated per segment and the memory stays at the size of the ring.
+    '''
+    def __init__(self, size: int) -> None:
+        '''
+        :param size: bytes of the ring, allocated at the first payload.
+        '''
+        self.size = size
+        self.view = None
+        self.runs = {}  # start : end of the bytes held
+        self.run_ends = {}  # end : start
+        self.floor = None  # lowest offset held, the ring spans [floor, floor + size)
+        self.ceiling = None  # end of the highest bytes held
+        self.held = 0
+
+    def put(self, offset, content) -> bool:
+        '''
+        :return: False if the payload does not fit in the ring next to the bytes held, the caller writes it itself
+        '''
+        length = len(content)
+        floor = offset if self.floor is None else min(self.floor, offset)
+        ceiling = offset + length if self.ceiling is None else max(self.ceiling, offset + length)
+        if length == 0 or ceiling - floor > self.size:  # it would overwrite bytes held at the same positions
+            return False
+        if self.view is None:
+            self.view = memoryview(bytearray(self.size))
+        position = offset % self.size
+        first = min(length, self.size - position)
+        self.view[position:position + first] = content[:first]
+        if first < length:  # wraps around
+            self.view[:length - first] = content[first:]
+        start, end = self.run_ends.pop(offset, offset), offset + length
+        if end in self.runs:
+            end = self.runs.pop(end)
+        self.runs[start] = end
+        self.run_ends[end] = start
+        self.floor = floor
+        self.ceiling = ceiling
+        self.held += length
+        return True
+
+    def release(self, upto):
+        '''
+        Stop holding the bytes below upto.
+        :return: [(offset, memoryview)] of these bytes, valid until the next put
+        '''
+        parts = []
+        for start in sorted(start for start in self.runs if start < upto):
+            end = self.runs.pop(start)
+            del self.run_ends[end]
+            if end > upto:
+                self.runs[upto] = end
+                self.run_ends[end] = upto
+                end = upto
+            self.held -= end - start
+            position = start % self.size
+            first = min(end - start, self.size - position)
+            parts.append((start, self.view[position:position + first]))
+            if first < end - start:
+                parts.append((start + first, self.view[:end - start - first]))
+        self.floor = min(self.runs) if self.runs else None
+        self.ceiling = max(self.run_ends) if self.runs else None
+        return parts
+
+
+class OutputFile:
+    '''
+    The output file of one connection: one descriptor for the whole session, payloads held in a reassembly ring and
+    written in runs of at least WRITE_COALESCE complete bytes, or all at once by flush.
+    '''
+    def __init__(self, filename: str, file_size=None, preallocate: bool = False, truncate: bool = True,
+                 base_offset: int = 0, ring_size: int = RCV_WINDOW + WRITE_COALESCE) -> None:
+        '''
+        :param file_size: the size announced by the sender, reserved on disk when preallocate is set.
+        :param truncate: start from an empty file, False for a stripe writing into the file of its transfer.
+        :param base_offset: the file offset of the connection's offset 0.
+        :param ring_size: bytes of the reassembly ring, payloads that do not fit are written at once.
+        '''
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if truncate else 0) | getattr(os, "O_BINARY", 0)
+        self.fd = os.open(filename, flags, 0o644)
+        self.base_offset = base_offset
+        if preallocate and file_size:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(self.fd, 0, file_size)
+            else:
+                os.ftruncate(self.fd, file_size)
+        self.ring = ReassemblyRing(ring_size)
+        self.complete = 0  # every byte below has been received
+        self.released = 0  # every byte below complete has been written
+
+    def store(self, offset, content):
+        # a received payload, held until the bytes below it are complete
+        if not self.ring.put(offset, content):
+            self.pwrite(content, offset)
+
+    def advance(self, offset):
+        # the cumulative ACK moved to offset
+        self.complete = offset
+        if self.complete - self.released >= WRITE_COALESCE:
+            self.write_out(self.complete)
+
+    def write_out(self, upto):
+        for offset, view in self.ring.release(upto):
+            self.pwrite(view, offset)
+        self.released = max(self.released, min(upto, self.complete))
+
+    def flush(self):
+        # every byte held, out-of-order ones included
+        self.write_out(float("inf"))
+
+    def pwrite(self, content, offset):
+        offset += self.base_offset
+        if hasattr(os, "pwrite"):
+            os.pwrite(self.fd, content, offset)
+        else:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            os.write(self.fd, content)
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
+class OutputFiles(OutputFile):
+    '''
+    The output of a multi-file session, a directory: the DATA stream is the files back to back, each one created
+    when its FILE record arrives. Writes are cut at the file boundaries and go through one descriptor per file,
+    closed once the in-order bytes have passed its end.
+    '''
+    def __init__(self, directory: str, preallocate: bool = False, ring_size: int = RCV_WINDOW + WRITE_COALESCE) -> None:
+        '''
+        :param directory: where the files are created, under the names sent by the sender.
+        :param preallocate: reserve the size of every file on disk when it is created.
+        :param ring_size: bytes of the reassembly ring.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.preallocate = preallocate
+        self.base_offset = 0
+        self.paths = {}  # path : (stream offset, size) of the files created
+        self.starts = []  # sorted stream offsets of the non-empty files
+        self.entries = {}  # stream offset : (end offset, path)
+        self.fds = {}  # stream offset : descriptor of the files open, in the order they were opened
+        self.ring = ReassemblyRing(ring_size)
+        self.complete = 0
+        self.released = 0
+
+    def add_file(self, offset, size, name):
+        '''
+        Create an announced file.
+        :return: True if the file was not announced yet
+        '''
+        parts = [part for part in name.split("/") if part not in ("", ".")]
+        if not parts or ".." in parts:
+            logging.warning(f"file name {name!r} outside of the directory, its bytes are dropped")
+            return False
+        path = os.path.join(self.directory, *parts)
+        if path in self.paths:
+            if self.paths[path] != (offset, size):  # not a resent FILE: another file under the same name
+                logging.warning(f"file name {name!r} announced twice, at {self.paths[path][0]} and at {offset} of the "
+                                f"stream, the bytes of the second are dropped")
+            return False
+        self.paths[path] = (offset, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            if self.preallocate and size:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        if size:
+            bisect.insort(self.starts, offset)
+            self.entries[offset] = (offset + size, path)
+        return True
+
+    def pwrite(self, content, offset):
+        # cut at the file boundaries, bytes of files not announced are dropped
+        content = memoryview(content)
+        end = offset + len(content)
+        i = max(bisect.bisect_right(self.starts, offset) - 1, 0)
+        while offset < end and i < len(self.starts):
+            start = self.starts[i]
+            file_end = self.entries[start][0]
+            i += 1
+            if file_end <= offset:
+                continue
+            if start > offset:  # a range not announced
+                if start >= end:
+                    break
+                content = content[start - offset:]
+                offset = start
+            length = min(end, file_end) - offset
+            fd = self.open_file(start)
+            if hasattr(os, "pwrite"):
+                os.pwrite(fd, content[:length], offset - start)
+            else:
+                os.lseek(fd, offset - start, os.SEEK_SET)
+                os.write(fd, content[:length])
+            content = content[length:]
+            offset += length
 
-                logging.debug("Socket closed!")
-                self.receiver_socket.close()
+    def open_file(self, start):
+        fd = self.fds.get(start)
+        if fd is None:
+            if len(self.fds) >= MAX_OPEN_FILES:
+                os.close(self.fds.pop(next(iter(self.fds))))
+            fd = self.fds[start] = os.open(self.entries[start][1], os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        return fd
 
+    def write_out(self, upto):
+        super().write_out(upto)
+        # everything below released is on disk, these files are complete
+        for start in [start for start in self.fds if self.entries[start][0] <= self.released]:
+            os.close(self.fds.pop(start))
 
-        
+    def close(self):
+        self.flush()
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
 
 
 if __name__ == '__main__':
@@ -160,10 +1230,64 @@ if __name__ == '__main__':
         format='%(asctime)s,%(msecs)03d %(levelname)-8s %(message)s',
         datefmt='%Y-%m-%d:%H:%M:%S')
 
-    if len(sys.argv) != 6:
-        print(
-            "\n===== Error usage, python3 receiver.py receiver_port sender_port FileReceived.txt flp rlp ======\n")
-        exit(0)
+    parser = argparse.ArgumentParser(usage="python3 receiver.py receiver_port sender_port FileReceived.txt flp rlp [options]")
+    parser.add_argument("receiver_port", type=int)
+    parser.add_argument("sender_port", type=int)
+    parser.add_argument("filename")
+    parser.add_argument("flp", type=float)
+    parser.add_argument("rlp", type=float)
+    parser.add_argument("--gro", action="store_true",
+                        help="batch incoming datagrams with UDP_GRO when the kernel supports it")
+    parser.add_argument("--server", action="store_true",
+                        help="accept concurrent senders, one output file per connection (filename is a template)")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds without a segment before a server session is dropped")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="server worker processes sharing the port with SO_REUSEPORT (implies --server)")
+    parser.add_argument("--max-mss", type=int, default=MAX_MSS,
+                        help="largest DATA payload accepted in the MSS negotiation")
+    parser.add_argument("--resume", action="store_true",
+                        help="keep the received ranges of interrupted transfers and resume them")
+    parser.add_argument("--delta", action="store_true",
+                        help="send block signatures of an existing output file so that only changed blocks are sent")
+    parser.add_argument("--preallocate", action="store_true",
+                        help="reserve the file size announced in the SYN before the DATA arrives")
+    parser.add_argument("--rcv-window", type=int, default=RCV_WINDOW,
+                        help="bytes accepted above the cumulative ACK, advertised to the sender in the ACKs")
+    parser.add_argument("--sndbuf", type=int, help="SO_SNDBUF of the socket in bytes")
+    parser.add_argument("--rcvbuf", type=int, help="SO_RCVBUF of the socket in bytes")
+    parser.add_argument("--trace", choices=TRACE_MODES, default="binary",
+                        help="per-segment events: binary records in Receiver_trace.bin (render them with ptptrace.py), "
+                             "text lines in Receiver_log.txt, or off")
+    parser.add_argument("--trace-sample", type=int, default=1, metavar="N",
+                        help="keep one per-segment event out of N")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="dump the metrics of the sessions as JSON to this file every --metrics-interval seconds")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL)
+    parser.add_argument("--delayed-ack", type=int, default=1, metavar="N",
+                        help="ack every N in-order DATA segments (or after --ack-delay), out-of-order DATA at once")
+    parser.add_argument("--ack-delay", type=float, default=ACK_DELAY * 1000,
+                        help="milliseconds an in-order segment waits for its delayed ACK")
+    args = parser.parse_args()
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers needs SO_REUSEPORT")
 
-    receiver = Receiver(*sys.argv[1:])
-    receiver.run()
+    if args.workers > 1:
+        Supervisor(args.workers, dict(receiver_port=args.receiver_port, sender_port=args.sender_port,
+                                      filename=args.filename, flp=args.flp, rlp=args.rlp,
+                                      preallocate=args.preallocate, gro=args.gro,
+                                      idle_timeout=args.idle_timeout, max_mss=args.max_mss,
+                                      resume=args.resume, delta=args.delta, rcv_window=args.rcv_window,
+                                      sndbuf=args.sndbuf, rcvbuf=args.rcvbuf, trace=args.trace,
+                                      trace_sample=args.trace_sample, metrics_file=args.metrics,
+                                      metrics_interval=args.metrics_interval, ack_every=args.delayed_ack,
+                                      ack_delay=args.ack_delay / 1000)).run()
+    else:
+        receiver = Receiver(args.receiver_port, args.sender_port, args.filename, args.flp, args.rlp,
+                            preallocate=args.preallocate, gro=args.gro, server=args.server,
+                            idle_timeout=args.idle_timeout, max_mss=args.max_mss, resume=args.resume,
+                            delta=args.delta, rcv_window=args.rcv_window, sndbuf=args.sndbuf, rcvbuf=args.rcvbuf,
+                            trace=args.trace, trace_sample=args.trace_sample, metrics_file=args.metrics,
+                            metrics_interval=args.metrics_interval, ack_every=args.delayed_ack,
+                            ack_delay=args.ack_delay / 1000)
+        receiver.run()
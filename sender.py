@@ -3,379 +3,714 @@ import datetime, time  # to calculate the time delta of packet transmission
 import logging, sys  # to write the log
 import socket  # Core lib, to send packet via UDP socket
 import threading  # (Optional)threading will make the timer easily implemented
-from threading import Thread, Lock
+from threading import Thread, Condition
 import random
 import select
-from collections import defaultdict, deque
-BUFFERSIZE = 1024
+import argparse
+import mmap
+import struct
+import os
+import hashlib
+import json
+import math
+import bisect
+import multiprocessing
+from collections import deque
+from congestion import CONTROLLERS
+import delta
+from ptptrace import EVENT_SND, EVENT_RCV, EVENT_CWND, TRACE_MODES, open_trace
+from metrics import METRICS_INTERVAL, Metrics, MetricsDumper
+from ptp import (
+    TYPE_DICT, GET_TYPE_DICT, SEQ_MODULO, OPT_WIDE_SEQ, OPT_FILE_SIZE, OPT_MSS, MAX_MSS, OPT_RESUME, OPT_DELTA,
+    OPT_COMPRESS, OPT_FEC, OPT_RWND, RWND_LEN, OPT_FILES, PARITY_FORMAT, FLAG_COMPRESSED, CODECS, CODEC_IDS,
+    OPT_STRIPED, OPT_STRIPE, STRIPED_FORMAT, STRIPE_FORMAT, FILE_RECORD_FORMAT, effective_mss, set_buffer_sizes,
+    xor_payloads, unpack_ranges, pack_files, pack_header, pack_header_into, unpack_header, unwrap_seq, unpack_sack,
+    pack_options, unpack_options)
+BUFFERSIZE = 1024  # the sender only receives ACKs: header + up to 16 SACK blocks
+SYN_BUFFERSIZE = 65536  # the SYN ACK may carry the ranges of a resumed transfer
+SEGMENT_SIZE = 1000  # payload bytes of a DATA segment, unless a larger MSS is negotiated in the SYN
+PROBE_TRIES = 2  # unanswered PROBE segments before a size is taken as too large
+PROBE_RESOLUTION = 64  # bytes, the path MTU search stops within this range
+# Linux path MTU discovery, the probe sets DF so that a too large segment is dropped instead of fragmented
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+EXCHANGE_WINDOW = 32  # unanswered SIGREQ/COPY segments of the delta sync
+COMPRESS_MIN_SAVING = 0.1  # a segment compressed by less than this is sent raw
+COMPRESS_POOR_LIMIT = 16  # poorly compressible segments in a row before compression is paused
+COMPRESS_PAUSE = 256  # segments sent raw before compression is tried again
+FEC_MAX_PARITY = 4  # parity segments per group at the highest loss rate
+FEC_ADAPT_SEGMENTS = 256  # segments reported by the receiver between two adaptations of the parity count
+PACING_GAIN_SS = 2.0  # pacing rate in cwnd / srtt during slow start, so that the window can still double per RTT
+PACING_GAIN_CA = 1.25  # and in congestion avoidance
+PACING_BURST = 4  # segments sent back to back at most when pacing, or one GSO train
+DUP_ACK_THRESHOLD = 3  # duplicate cumulative ACKs that trigger a fast retransmit
+# Linux UDP generic segmentation offload, not exported by every Python build
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+GSO_MAX_SEGMENTS = 64  # UDP_MAX_SEGMENTS of the kernel
+GSO_MAX_BYTES = 65000  # a GSO super-datagram still has to fit in one IP packet
+MIN_RTO = 0.01  # seconds, lower bound of the retransmission timer
+MAX_RTO = 60
+CLOCK_GRANULARITY = 0.001
+GIVE_UP_TIME = 10  # seconds without an ACK before the connection is reset
 
 class Sender:
-    def __init__(self, sender_port: int, receiver_port: int, filename: str, max_win: int, rot: int) -> None:
+    def __init__(self, sender_port: int, receiver_port: int, filename: str, max_win: int, rot: int,
+                 give_up_time: float = GIVE_UP_TIME, wide_seq: bool = True, cc: str = "reno",
+                 gso: bool = False, file_range=None, striped=None, stripe=None, mss: int = SEGMENT_SIZE,
+                 pmtu_probe: bool = False, compress=None, fec: int = 0, pacing: bool = False, sndbuf=None,
+                 rcvbuf=None, trace: str = "binary", trace_sample: int = 1, trace_file: str = "Sender_trace.bin",
+                 metrics_file=None, metrics_interval: float = METRICS_INTERVAL, files=None) -> None:
         '''
         The Sender will be able to connect the Receiver via UDP
         :param sender_port: the UDP port number to be used by the sender to send PTP segments to the receiver
         :param receiver_port: the UDP port number on which receiver is expecting to receive PTP segments from the sender
-        :param filename: the name of the text file that must be transferred from sender to receiver using your reliable transport protocol.
-        :param max_win: the maximum window size in bytes for the sender window.
-        :param rot: the value of the retransmission timer in milliseconds. This should be an unsigned integer.
+        :param filename: the name of the file that must be transferred from sender to receiver using your reliable transport protocol, sent as bytes.
+        :param max_win: the maximum window size in bytes for the sender window, the upper limit of the congestion window.
+        :param rot: the initial value of the retransmission timer in milliseconds, adapted from the measured RTT afterwards.
+        :param give_up_time: seconds a segment may stay unacked (resent with backoff) before the connection is reset.
+        :param wide_seq: offer 64-bit sequence numbers in the SYN, used only if the receiver accepts them.
+        :param cc: congestion controller deciding the effective window, one of congestion.CONTROLLERS.
+        :param gso: hand trains of new segments to the kernel in one sendmsg (UDP_SEGMENT), falls back to one sendto per segment.
+        :param file_range: (start, end) bytes of the file sent by this connection, the whole file if None.
+        :param striped: (transfer id, stripe count), offered in the SYN of the control flow of a striped transfer.
+        :param stripe: (transfer id, control port, stripe index), offered in the SYN of one stripe.
+        :param mss: the DATA payload size offered in the SYN, the receiver may lower it; SEGMENT_SIZE if it does not answer.
+        :param pmtu_probe: after the SYN, search the largest segment between SEGMENT_SIZE and the negotiated MSS that
+            reaches the receiver with PROBE segments.
+        :param compress: the name of the codec offered in the SYN (zlib is offered after it as a fallback), None to
+            send raw payloads. Segments that do not compress are sent raw, and compression pauses on incompressible data.
+        :param fec: group size k offered in the SYN, 0 for none. After every k new segments 1 to FEC_MAX_PARITY XOR parity
+            segments are sent, the count follows the loss rate reported by the receiver.
+        :param pacing: spread the new segments over the RTT with a token bucket instead of sending each window as a burst.
+        :param sndbuf: SO_SNDBUF of the socket in bytes, the system default if None.
+        :param rcvbuf: SO_RCVBUF of the socket in bytes, the system default if None.
+        :param trace: where the per-segment events go, one of ptptrace.TRACE_MODES: "binary" records in trace_file
+            (rendered by ptptrace.py), "text" lines in the log, or "off".
+        :param trace_sample: keep one per-segment event out of trace_sample.
+        :param metrics_file: dump metrics_snapshot() as JSON to this file every metrics_interval seconds, None for no
+            dump. The snapshot is logged as a summary line at the end of the connection either way.
+        :param files: [(path, name)] sent back to back over this one connection (a multi-file session), each announced
+            to the receiver by its name relative to the receiver's directory; filename is then only a label.
         '''
         self.sender_port = int(sender_port)
         self.receiver_port = int(receiver_port)
         self.sender_address = ("127.0.0.1", self.sender_port)
+        self.trace = open_trace(trace, trace_file, trace_sample)
+        self.metrics = Metrics()
+        self.metrics_dumper = MetricsDumper(self.metrics_snapshot, metrics_file, metrics_interval) \
+            if metrics_file else None
         self.receiver_address = ("127.0.0.1", self.receiver_port)
         self.filename = filename
-        self.max_win = max_win
+        self.file_range = file_range
+        self.files = files
+        self.striped = striped
+        self.stripe = stripe
+        self.max_win = int(max_win)
         self.rot = rot
 
         # init the UDP socket
         logging.debug(f"The sender is using the address {self.sender_address}")
         self.sender_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
         self.sender_socket.bind(self.sender_address)
-        self.timeout = int(self.rot) / 1000
-        self.type_dict = {"DATA": 0, "ACK": 1, "SYN": 2, "FIN": 3, "RESET": 4}
-        self.get_type_dict = {0: "DATA", 1: "ACK", 2: "SYN", 3: "FIN", 4: "RESET"}
+        granted = set_buffer_sizes(self.sender_socket, sndbuf, rcvbuf)
+        logging.debug(f"SO_SNDBUF {granted[0]}, SO_RCVBUF {granted[1]}")
+        if sndbuf and granted[0] < int(sndbuf):
+            logging.warning(f"SO_SNDBUF\t{granted[0]}\tgranted of {sndbuf}, raise net.core.wmem_max")
+        self.gso = False
+        if gso:
+            try:
+                self.sender_socket.getsockopt(SOL_UDP, UDP_SEGMENT)
+                self.gso = hasattr(self.sender_socket, "sendmsg")
+            except OSError:
+                logging.debug("UDP_SEGMENT is not supported, one datagram per sendto")
+        self.timeout = int(self.rot) / 1000  # current RTO, the DATA timers back it off per segment
+        self.last_timeout = 0  # time of the last DATA timeout event
+        self.srtt = None
+        self.rttvar = None
+        self.give_up_time = float(give_up_time)
 
         self._is_active = True  # for the multi-threading
+        self.closed = False  # ptp_close has run
         self.SYN_acked = False
         self.FIN_acked = False
-        self.seq_content_dic = defaultdict(str)  # seq : file_content(str)
-        self.retrans_counter = defaultdict(int)  # seq : retrans_time
-        # self.seq_unacked_dic = defaultdict(tuple)  # seq : (msg, time.time()) msg is in b
-        self.seq_contlen_dic = {}  # seq : file_content_length
-        self.expected_ACK_dic = {}  # seq_no : expected_ACK_no
-        self.num_seqno_dic = {}  # 0/1/2/3 : seq_no ...
-        self.seqno_num_dic = {}  # seq_no : 0/1/2/3...
+        self.offer_wide_seq = wide_seq
+        self.wide_seq = False  # 64-bit sequence numbers, set once the receiver accepted them
+        self.syn_options = {}  # options echoed in the SYN ACK
+        self.data_isn = None  # sequence number of the first DATA byte, offset 0
+        self.offer_mss = min(max(int(mss), 1), MAX_MSS)
+        self.mss = min(SEGMENT_SIZE, self.offer_mss)  # the negotiated DATA payload size
+        self.pmtu_probe = pmtu_probe
+        self.offer_codecs = [] if compress is None else list(dict.fromkeys([CODEC_IDS[compress], CODEC_IDS["zlib"]]))
+        self.codec = None  # (name, compress, decompress) chosen by the receiver
+        self.poor_segments = 0  # poorly compressible segments in a row
+        self.compress_paused_until = 0  # num of the first segment compressed again
+        if int(fec) and not 2 <= int(fec) <= 255:
+            raise ValueError(f"FEC group size {fec}, 2 to 255 or 0 for none")
+        self.offer_fec = int(fec)
+        self.fec_k = 0  # group size accepted by the receiver, 0 without parity segments
+        self.fec_m = 1  # parity segments per group
+        self.fec_lost = 0  # segments reported missing by the receiver when the parity arrived
+        self.fec_observed = 0  # segments covered by those reports
+        self.parity_marks = {}  # first num of a group : next_num after its parity was sent, -1 once reported
+        self.deferred_num = None  # fast retransmit held back while the parity may rebuild the segment
+        self.rwnd_ack = False  # the ACKs carry the receiver's window, negotiated in the SYN
+        self.rwnd_edge = None  # offset past which the receiver has no room, from the latest ACK
+        self.rwnd_ack_offset = 0  # cumulative ACK of rwnd_edge
+        self.pacing = pacing
+        self.tokens = 0  # bytes the token bucket lets out now
+        self.tokens_time = time.time()
+        self.resume_token = None  # offered in the SYN, identifies the file to a receiver keeping interrupted transfers
+        self.resumed = {}  # first num : end num, segments the receiver already has from an interrupted transfer
+        # the file is memory-mapped and cut lazily: segment num covers [num * mss, +mss) of file_range
+        self.file_size = 0
+        self.file_map = None
+        self.file_view = None  # memoryview over file_map, DATA payloads are slices of it
+        self.header_buf = bytearray(2 + 8)  # reused for every DATA header, the payload is never copied
+        self.train_headers = [bytearray(2 + 8) for _ in range(GSO_MAX_SEGMENTS)]  # headers of one GSO train
         self.data_acked = False
-        #self.seq_ack_times = {}
 
-        self.acked_seq = set()  # result shared for all sub-thread
+        # sliding window, shared by the sending loop and the ACK dispatcher
+        self.send_base = 0  # num of the oldest unacked segment
+        self.next_num = 0  # num of the next segment to be sent
+        self.bytes_in_flight = 0
+        self.cc_name = cc
+        self.cc = CONTROLLERS[cc](self.mss, self.max_win)
+        self.dup_acks = 0  # duplicates of the cumulative ACK at send_base
+        self.recover_num = None  # next_num when fast recovery started, None outside of fast recovery
+        self.logged_cwnd = None
+        self.in_flight = {}  # num : [send_time, send_times, first_send_time]
+        self.sacked_num = set()  # num of in-flight segments reported in the receiver's SACK blocks
+        self.window_cond = Condition()
 
         self.send_counter = 0
 
 
-        self.sent_queue = deque()
-
-        self.lock = Lock()
-
-
 
     def ptp_open_and_send(self):
-
-        self.sender_socket.settimeout(self.timeout)
-        dup = 3
-        # sequence_number = 1000
-        sequence_number = random.randint(0, 65535)
-
-        self.start_time = time.time()
-
         # SYN
-        while dup > 0:
-            msg = self.type_dict["SYN"].to_bytes(2, byteorder='big', signed=False) + \
-                  sequence_number.to_bytes(2, byteorder='big', signed=False)
-            self.sender_socket.sendto(msg, self.receiver_address)
-            self.send_counter += 1
-            time_diff = round((time.time() - self.start_time) * 1000, 2)
-            if dup == 3:
-                logging.warning(f"snd\t0\tSYN\t{sequence_number}\t0")
-            else:
-                logging.warning(f"snd\t{time_diff}\tSYN\t{sequence_number}\t0")
-            self.listen(sequence_number)
-            if self.SYN_acked:
-                break
-            else:
-                dup -= 1
-                logging.warning(f"Timeout! Resend the SYN, resent chances left:{dup}")
-        if dup == 0:
-            type = 4
-            no = 0
-            logging.warning("connected failed! Reset the connection.")
-            reset_msg = type.to_bytes(2, byteorder='big', signed=False) + no.to_bytes(2, byteorder='big', signed=False)
-            self.sender_socket.sendto(reset_msg, self.receiver_address)
-            self.send_counter += 1
-            time_diff = round((time.time() - self.start_time) * 1000, 2)
-            logging.warning(f"snd\t{time_diff}\tRESET\t\t0\t0")
+        if not self.ptp_open():
+            self.send_RESET()
             self.ptp_close()
             logging.warning("returned to the CLOSED state")
 
         # DATA
         else:
-            sequence_number += 1
-            with open(self.filename, "r") as file:
-                packets_num = 0
-                while True:
-                    content = file.read(1000)
-                    if content:
-                        self.seq_content_dic[sequence_number] = content
-                        length = len(content)
-                        self.seq_contlen_dic[sequence_number] = length
-                        self.num_seqno_dic[packets_num] = sequence_number
-                        self.seqno_num_dic[sequence_number] = packets_num
-                        self.expected_ACK_dic[sequence_number] = (sequence_number + length) % 65535
-                        sequence_number = (sequence_number + length) % 65535
-                        packets_num += 1
-                    else:
-                        break
-            self.fin_seq = sequence_number
-
-            win_seq = 0
-            win_size_num = int(int(self.max_win) / 1000)
-
-            # without sliding window
-            if win_size_num == 1:
-                for i in range(packets_num):
-                    self.thread_send_and_listen(self.num_seqno_dic[i])
-                    self.data_acked = False
-                self.send_FIN()
-
-            else:
-                window = deque(maxlen=win_size_num)
-                unacked_data = {}  # seq_no : num
-                num_list = []
-                for i in range(len(self.num_seqno_dic)):
-                    num_list.append(i)
-
-                win_step = []
-                for i in range(0, len(num_list), win_size_num):
-                    win_step.append(num_list[i:i + win_size_num])
-                # logging.debug(f"win_step = {win_step}")
-
-                try:
-                    for j in range(len(win_step)):
-                        threads = []
-                        for i in range(len(win_step[j])):
-                            sequence_number = self.num_seqno_dic[i + j * win_size_num]
-                            self.retrans_counter[sequence_number] = 0
-                            t = Thread(target=self.thread_send_and_listen, args=(sequence_number,))
-                            t.start()
-                            threads.append(t)
-                        for t in threads:
-                            t.join()
-                        self.data_acked = False
-                except OSError:
-                    self.ptp_close()
+            try:
+                self.send_window()
+            except OSError:
+                self.ptp_close()
 
+            if self._is_active:
                 self.send_FIN()
 
 
+    def ptp_open(self):
+        '''
+        Map the file and run the SYN handshake.
+        :return: True if the SYN has been acked
+        '''
+        self.sender_socket.settimeout(self.timeout)
+        # sequence_number = 1000
+        sequence_number = random.randint(0, SEQ_MODULO - 1)
 
-    def thread_send_and_listen_2(self, sequence_number):
-
-        global send_time
-        while not self.data_acked:
-            msg = self.type_dict["DATA"].to_bytes(2, byteorder='big', signed=False) + \
-                  sequence_number.to_bytes(2, byteorder='big', signed=False) + \
-                  self.seq_content_dic[sequence_number].encode()
-            if self.retrans_counter[sequence_number] == 0:
-                send_time = time.time()
-
-            while self.retrans_counter[sequence_number] < 3 and not self.data_acked:
+        self.start_time = time.time()
+        self.trace.start()
 
-                if self.retrans_counter[sequence_number] == 0 or (time.time() - send_time) > self.timeout:
-                    self.lock.acquire()
-                    self.sender_socket.sendto(msg, self.receiver_address)
-                    self.lock.release()
-                    self.send_counter += 1
-                    time_diff = round((send_time - self.start_time) * 1000, 2)
-                    logging.warning(f"snd\t{time_diff}\tDATA{sequence_number}\t{self.seq_contlen_dic[sequence_number]}")
-                    self.retrans_counter[sequence_number] += 1
-
-                try:
-                    self.lock.acquire()
-                    incoming_message, _ = self.sender_socket.recvfrom(BUFFERSIZE)
-                    self.lock.release()
-                    rev_type_no = int.from_bytes(incoming_message[:2], byteorder='big')
-                    rev_ack_no = int.from_bytes(incoming_message[2:4], byteorder='big')
-                    # self.seq_ack_times[rev_ack_no] += 1
-                    if (rev_ack_no + 1) % 65535 == self.fin_seq + 1:
-                        time_diff = round((time.time() - self.start_time) * 1000, 2)
-                        logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                        self.data_acked = True
-                        break
-                    if rev_ack_no == self.expected_ACK_dic[sequence_number]:
-                        time_diff = round((time.time() - self.start_time) * 1000, 2)
-                        logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                        self.data_acked = True
-                        break
-                    if self.seqno_num_dic[rev_ack_no] > self.seqno_num_dic[self.expected_ACK_dic[sequence_number]]:
-                        self.data_acked = True
+        if self.files is not None:
+            # the files back to back form the DATA stream, a segment may span the end of one and the start of the next
+            self.file_map = self.file_view = FileChain([path for path, _ in self.files])
+            self.total_size = self.file_size = len(self.file_view)
+        else:
+            self.map_file()
+
+        if not self.handshake("SYN", sequence_number):
+            return False
+        if self.files is not None and OPT_FILES not in self.syn_options:
+            logging.warning("the receiver does not accept multi-file sessions")
+            return False
+        self.wide_seq = OPT_WIDE_SEQ in self.syn_options
+        self.rwnd_ack = OPT_RWND in self.syn_options
+        self.data_isn = sequence_number + 1
+        if self.syn_options.get(OPT_COMPRESS, b'')[:1] and self.syn_options[OPT_COMPRESS][0] in self.offer_codecs:
+            self.codec = CODECS[self.syn_options[OPT_COMPRESS][0]]
+        if OPT_MSS in self.syn_options:
+            self.mss = min(int.from_bytes(self.syn_options[OPT_MSS], byteorder='big'), self.offer_mss)
+        max_win = self.max_win
+        self.mss = effective_mss(self.mss, self.wide_seq)
+        if not self.wide_seq:
+            # 2-byte sequence numbers are unwrapped correctly only if the window spans less than half their space
+            max_win = min(max_win, SEQ_MODULO // 2 - self.mss)
+        resumed_ranges = []
+        if self.resume_token is not None and self.syn_options.get(OPT_RESUME, b'')[:16] == self.resume_token:
+            # the receiver cut the ranges to the boundaries of the negotiated segments
+            resumed_ranges = unpack_ranges(self.syn_options[OPT_RESUME][16:])
+            logging.warning(f"resume\t{sum(end - start for start, end in resumed_ranges)}\tbytes already received")
+        if self.pmtu_probe and self.mss > SEGMENT_SIZE and not resumed_ranges:
+            self.mss = self.probe_mss()
+        if not resumed_ranges and OPT_DELTA in self.syn_options and self.file_size > 0:
+            copies = self.delta_sync(self.syn_options[OPT_DELTA])
+            if copies is None:
+                return False
+            resumed_ranges = [(dst, dst + length) for dst, _, length in copies]
+        if self.files is not None and not self.announce_files():
+            return False
+        if OPT_FEC in self.syn_options and not resumed_ranges and \
+                2 + 8 + struct.calcsize(PARITY_FORMAT) + self.mss <= 65507:
+            # the parity covers the whole group, segments skipped by a resume or a delta sync would spoil it
+            self.fec_k = self.syn_options[OPT_FEC][0]
+        self.cc = CONTROLLERS[self.cc_name](self.mss, max_win)
+        packets_num = -(-self.file_size // self.mss)
+        self.fin_seq = self.data_isn + self.file_size
+        self.packets_num = packets_num
+        if packets_num == 0:
+            self.data_acked = True
+        for start, end in resumed_ranges:
+            self.resumed[start // self.mss] = -(-end // self.mss)
+        return True
+
+
+    def map_file(self):
+        # the range of the file sent by this connection, mapped read-only
+        with open(self.filename, "rb") as file:
+            stat = os.fstat(file.fileno())
+            self.total_size = stat.st_size
+            if self.file_range is None and self.striped is None:
+                identity = f"{os.path.basename(self.filename)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+                self.resume_token = hashlib.sha1(identity).digest()[:8] + stat.st_size.to_bytes(8, byteorder='big')
+            start, end = self.file_range or (0, self.total_size)
+            self.file_size = end - start
+            if self.file_size > 0:  # an empty file cannot be mapped
+                self.file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.file_view = memoryview(self.file_map)[start:end]
+
+
+    def send_window(self):
+        '''
+        Sliding window engine: keeps up to max_win bytes of DATA in flight and slides the window forward
+        on every cumulative ACK. ACKs are read by a single dispatcher thread (ack_dispatcher), which
+        updates the shared in-flight table and wakes this loop up.
+        '''
+        dispatcher = Thread(target=self.ack_dispatcher, daemon=True)
+        dispatcher.start()
+
+        with self.window_cond:
+            while self._is_active and not self.data_acked:
+                # fill the congestion window, at least one segment is always allowed in flight
+                train = []
+                pace_deadline = None
+                while self.next_num < self.packets_num:
+                    if self.next_num in self.resumed:  # already received before the interruption, never sent
+                        end_num = self.resumed.pop(self.next_num)
+                        self.metrics.add("bytes_skipped", min(end_num * self.mss, self.file_size) - self.next_num * self.mss)
+                        if self.send_base == self.next_num:
+                            self.send_base = end_num
+                        self.next_num = end_num
+                        continue
+                    length = self.segment_length(self.next_num)
+                    if self.bytes_in_flight > 0 and self.bytes_in_flight + length > self.cc.window:
                         break
-                    if self.seqno_num_dic[rev_ack_no] < self.seqno_num_dic[self.expected_ACK_dic[sequence_number]]:
-                        time_diff = round((time.time() - self.start_time) * 1000, 2)
-                        logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                except socket.timeout:
-                    logging.warning(f"Timeout! Resend the DATA seq={sequence_number}, resent chances left:{3 - self.retrans_counter[sequence_number]}")
-                    continue
-
-            if self.retrans_counter[sequence_number] == 3:
-                type = 4
-                no = 0
-                logging.warning("connected failed! Reset the connection.")
-                reset_msg = type.to_bytes(2, byteorder='big', signed=False) + no.to_bytes(2, byteorder='big', signed=False)
-                self.sender_socket.sendto(reset_msg, self.receiver_address)
-                self.send_counter += 1
-                time_diff = round((time.time() - self.start_time) * 1000, 2)
-                logging.warning(f"snd\t{time_diff}\tRESET\t\t0\t0")
-                self._is_active = False  # close the sub-thread
-                self.sender_socket.close()
-                logging.warning("returned to the CLOSED state")
-
-
-
-    def thread_send_and_listen(self, sequence_number):
-
-        while not self.data_acked:
-            msg = self.type_dict["DATA"].to_bytes(2, byteorder='big', signed=False) + \
-                  sequence_number.to_bytes(2, byteorder='big', signed=False) + \
-                  self.seq_content_dic[sequence_number].encode()
-            # 1st send
-            if self.retrans_counter[sequence_number] == 0:
-                send_time = time.time()
-
-                try:
-                    self.sender_socket.sendto(msg, self.receiver_address)
-                except OSError:
+                    if self.bytes_in_flight > 0 and self.rwnd_edge is not None and \
+                            self.next_num * self.mss + length > self.rwnd_edge:
+                        self.metrics.add("rwnd_limited")
+                        break  # with nothing in flight one segment goes anyway and probes a closed receive window
+                    if self.pacing and self.srtt:
+                        pace_deadline = self.take_tokens(length)
+                        if pace_deadline is not None:
+                            break
+                    now = time.time()
+                    self.in_flight[self.next_num] = [now, 0, now]  # num : [send_time, send_times, first_send_time]
+                    self.bytes_in_flight += length
+                    train.append(self.next_num)
+                    self.next_num += 1
+                    if len(train) == self.train_size:
+                        self.send_train(train)
+                        self.send_parity(train)
+                        train = []
+                if train:
+                    self.send_train(train)
+                    self.send_parity(train)
+                if self.send_base == self.packets_num:
+                    self.data_acked = True
                     break
 
-                self.send_counter += 1
-                time_diff = round((send_time - self.start_time) * 1000, 2)
-                logging.warning(f"snd\t{time_diff}\tDATA{sequence_number}\t{self.seq_contlen_dic[sequence_number]}")
-                self.retrans_counter[sequence_number] += 1
-                try:
-
-                    incoming_message, _ = self.sender_socket.recvfrom(BUFFERSIZE)
-
-                    rev_type_no = int.from_bytes(incoming_message[:2], byteorder='big')
-                    rev_ack_no = int.from_bytes(incoming_message[2:4], byteorder='big')
-
-                    if (rev_ack_no + 1) % 65535 == self.fin_seq + 1:
-                        time_diff = round((time.time() - self.start_time) * 1000, 2)
-                        logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                        self.data_acked = True
-                        return
-
-                    if rev_ack_no == self.expected_ACK_dic[sequence_number]:
-                        time_diff = round((time.time() - self.start_time) * 1000, 2)
-                        logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                        self.data_acked = True
-
-                        self.acked_seq.add(sequence_number)
-
-                    try:
-                        if self.seqno_num_dic[rev_ack_no] > self.seqno_num_dic[self.expected_ACK_dic[sequence_number]]:
-                            time_diff = round((time.time() - self.start_time) * 1000, 2)
-                            logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                            self.data_acked = True
-
-                            self.acked_seq.add(sequence_number)
-                    except KeyError:
+                # retransmit every segment whose timer expired, each timer backed off by its own retransmissions
+                now = time.time()
+                deadline = now + self.timeout
+                expired = False
+                new_loss = False  # an expired segment was sent after the last timeout event
+                for num, (send_time, send_times, first_send_time) in list(self.in_flight.items()):
+                    if num in self.sacked_num:
                         continue
+                    rto = self.segment_rto(send_times)
+                    if now - send_time < rto:
+                        deadline = min(deadline, send_time + rto)
+                        continue
+                    sequence_number = self.wire_seq(num * self.mss)
+                    time_left = self.give_up_time - (now - first_send_time)
+                    if time_left <= 0:
+                        self.send_RESET()
+                        self._is_active = False  # stop the dispatcher
+                        logging.warning("returned to the CLOSED state")
+                        break
+                    logging.warning(f"Timeout! Resend the DATA seq={sequence_number}, time left:{round(time_left, 2)}s")
+                    self.metrics.add("retransmits_timeout")
+                    new_loss = new_loss or send_time >= self.last_timeout
+                    self.in_flight[num][0] = now
+                    self.send_DATA(num)
+                    deadline = min(deadline, now + self.segment_rto(send_times + 1))
+                    expired = True
+                if expired and new_loss:
+                    # segments of a window lost together expire one after the other: one congestion event
+                    self.metrics.add("timeouts")
+                    self.last_timeout = now
+                    self.cc.on_timeout(self.bytes_in_flight, now)
+                    self.recover_num = None
+                    self.dup_acks = 0
+                    self.log_cwnd()
+                if pace_deadline is not None:
+                    deadline = min(deadline, pace_deadline)
+
+                if self._is_active and not self.data_acked:
+                    self.window_cond.wait(max(0, deadline - time.time()))
+
+        dispatcher.join()
+
+
+    def take_tokens(self, length):
+        '''
+        Token bucket pacing: the bucket fills at PACING_GAIN * cwnd / srtt bytes per second and holds PACING_BURST
+        segments (or one GSO train), so a window goes out spread over the RTT rather than in one burst.
+        :return: None if the segment may be sent now, else the time at which the bucket will hold enough tokens
+        '''
+        # caller holds window_cond
+        now = time.time()
+        gain = PACING_GAIN_SS if self.cc.cwnd < self.cc.ssthresh else PACING_GAIN_CA
+        rate = gain * self.cc.window / max(self.srtt, CLOCK_GRANULARITY)
+        self.tokens = min(self.tokens + (now - self.tokens_time) * rate, max(PACING_BURST, self.train_size) * self.mss)
+        self.tokens_time = now
+        if self.tokens < length:
+            return now + (length - self.tokens) / rate
+        self.tokens -= length
+        return None
+
+
+    def wire_seq(self, offset):
+        # the sequence number of a file offset as it is written in the header
+        if self.wide_seq:
+            return self.data_isn + offset
+        return (self.data_isn + offset) % SEQ_MODULO
+
+
+    def segment_length(self, num):
+        return min(self.mss, self.file_size - num * self.mss)
+
+
+    def segment_num(self, offset):
+        # num of the segment starting at offset, None if offset is not a segment boundary
+        if offset % self.mss == 0 or offset == self.file_size:
+            return -(-offset // self.mss)
+        return None
+
+
+    def send_DATA(self, num):
+        # caller holds window_cond
+        offset = num * self.mss
+        length = self.segment_length(num)
+        type_no, payload = TYPE_DICT["DATA"], self.file_view[offset:offset + length]
+        if self.codec is not None:
+            type_no, payload = self.compress(num, payload)
+        header_len = pack_header_into(self.header_buf, type_no, self.data_isn + offset, self.wide_seq)
+        # scatter-gather: the header buffer and a slice of the mapped file go out in one datagram
+        if hasattr(self.sender_socket, "sendmsg"):
+            self.sender_socket.sendmsg([memoryview(self.header_buf)[:header_len], payload],
+                                       [], 0, self.receiver_address)
+        else:
+            self.sender_socket.sendto(bytes(self.header_buf[:header_len]) + payload, self.receiver_address)
+        self.in_flight[num][1] += 1
+        self.send_counter += 1
+        self.metrics.add("segments_sent")
+        self.metrics.add("bytes_sent", length)
+        if type_no != TYPE_DICT["DATA"]:
+            self.metrics.add("bytes_compressed", length - len(payload))
+        self.trace.record(EVENT_SND, TYPE_DICT["DATA"], self.wire_seq(offset), length)
 
-                    if self.seqno_num_dic[rev_ack_no] < self.seqno_num_dic[self.expected_ACK_dic[sequence_number]]:
-                        time_diff = round((time.time() - self.start_time) * 1000, 2)
-                        logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                except socket.timeout:
-                    # 2nd
-                    logging.warning(f"Timeout! Resend the DATA seq={sequence_number}, resent chances left:{3 - self.retrans_counter[sequence_number]}")
-
-                    self.sender_socket.sendto(msg, self.receiver_address)
-
-                    self.send_counter += 1
-                    time_diff = round((time.time() - self.start_time) * 1000, 2)
-                    logging.warning(f"snd\t{time_diff}\tDATA{sequence_number}\t{self.seq_contlen_dic[sequence_number]}")
-                    self.retrans_counter[sequence_number] += 1
-                    try:
-
-                        incoming_message, _ = self.sender_socket.recvfrom(BUFFERSIZE)
-
-                        rev_type_no = int.from_bytes(incoming_message[:2], byteorder='big')
-                        rev_ack_no = int.from_bytes(incoming_message[2:4], byteorder='big')
-                       # self.seq_ack_times[rev_ack_no] += 1
-                        if (rev_ack_no + 1) % 65535 == self.fin_seq + 1:
-                            time_diff = round((time.time() - self.start_time) * 1000, 2)
-                            logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                            self.data_acked = True
-                            return
-                       # self.seq_ack_times[rev_ack_no] += 1
-
-                        if rev_ack_no == self.expected_ACK_dic[sequence_number]:
-                            time_diff = round((time.time() - self.start_time) * 1000, 2)
-                            logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                            self.data_acked = True
-
-                            self.acked_seq.add(sequence_number)
-
-                        if self.seqno_num_dic[rev_ack_no] > self.seqno_num_dic[self.expected_ACK_dic[sequence_number]]:
-                            self.data_acked = True
-
-                            self.acked_seq.add(sequence_number)
-
-                        if self.seqno_num_dic[rev_ack_no] < self.seqno_num_dic[self.expected_ACK_dic[sequence_number]]:
-                            time_diff = round((time.time() - self.start_time) * 1000, 2)
-                            logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                    except socket.timeout:
-                        # 3rd
-                        logging.warning(
-                            f"Timeout! Resend the DATA seq={sequence_number}, resent chances left:{3 - self.retrans_counter[sequence_number]}")
-
-                        self.sender_socket.sendto(msg, self.receiver_address)
-
-                        self.send_counter += 1
-                        time_diff = round((time.time() - self.start_time) * 1000, 2)
-                        logging.warning(
-                            f"snd\t{time_diff}\tDATA{sequence_number}\t{self.seq_contlen_dic[sequence_number]}")
-                        self.retrans_counter[sequence_number] += 1
-                        try:
-
-                            try:
-                                incoming_message, _ = self.sender_socket.recvfrom(BUFFERSIZE)
-                            except OSError:
-                                break
-
-                            rev_type_no = int.from_bytes(incoming_message[:2], byteorder='big')
-                            rev_ack_no = int.from_bytes(incoming_message[2:4], byteorder='big')
-                            # self.seq_ack_times[rev_ack_no] += 1
-                            if (rev_ack_no + 1) % 65535 == self.fin_seq + 1:
-                                time_diff = round((time.time() - self.start_time) * 1000, 2)
-                                logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                                self.data_acked = True
-                                return
-                          #  self.seq_ack_times[rev_ack_no] += 1
-
-                            if rev_ack_no == self.expected_ACK_dic[sequence_number]:
-                                time_diff = round((time.time() - self.start_time) * 1000, 2)
-                                logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                                self.data_acked = True
-
-
-                                self.acked_seq.add(sequence_number)
-                            try:
-                                if self.seqno_num_dic[rev_ack_no] > self.seqno_num_dic[
-                                    self.expected_ACK_dic[sequence_number]]:
-                                    self.data_acked = True
-
-                                    self.acked_seq.add(sequence_number)
-                            except KeyError:
-                                continue
-
-                            if self.seqno_num_dic[rev_ack_no] < self.seqno_num_dic[
-                                self.expected_ACK_dic[sequence_number]]:
-                                time_diff = round((time.time() - self.start_time) * 1000, 2)
-                                logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                        except socket.timeout:
-                            type = 4
-                            no = 0
-                            logging.warning("connected failed! Reset the connection.")
-                            reset_msg = type.to_bytes(2, byteorder='big', signed=False) + no.to_bytes(2, byteorder='big', signed=False)
-                            self.sender_socket.sendto(reset_msg, self.receiver_address)
-                            self.send_counter += 1
-                            time_diff = round((time.time() - self.start_time) * 1000, 2)
-                            logging.warning(f"snd\t{time_diff}\tRESET\t\t0\t0")
-                            self._is_active = False  # close the sub-thread
-                            self.sender_socket.close()
-                            logging.warning("returned to the CLOSED state")
 
+    def compress(self, num, payload):
+        '''
+        Compress one segment with the negotiated codec, unless it does not pay off.
+        :return: (type_no, payload)
+        '''
+        if num < self.compress_paused_until:
+            return TYPE_DICT["DATA"], payload
+        compressed = self.codec[1](payload)
+        if len(compressed) > len(payload) * (1 - COMPRESS_MIN_SAVING):
+            self.poor_segments += 1
+            if self.poor_segments >= COMPRESS_POOR_LIMIT:
+                # incompressible data, stop spending CPU on it for a while
+                self.poor_segments = 0
+                self.compress_paused_until = num + COMPRESS_PAUSE
+                logging.warning(f"compression paused until DATA{self.wire_seq(self.compress_paused_until * self.mss)}")
+            return TYPE_DICT["DATA"], payload
+        self.poor_segments = 0
+        return TYPE_DICT["DATA"] | FLAG_COMPRESSED, compressed
+
+
+    @property
+    def train_size(self):
+        # new segments handed to the kernel in one call, GSO needs equal sizes so never with compression
+        if not self.gso or self.codec is not None:
+            return 1
+        return min(GSO_MAX_SEGMENTS, max(GSO_MAX_BYTES // (2 + 8 + self.mss), 1))
+
+
+    def send_train(self, nums):
+        '''
+        Send consecutive new segments. With GSO they go out in one sendmsg: the iovec alternates the headers and
+        the payload slices and the kernel cuts it every header_len + mss bytes (only the last segment
+        of the file may be shorter).
+        '''
+        # caller holds window_cond
+        if not self.gso or len(nums) == 1:
+            for num in nums:
+                self.send_DATA(num)
+            return
+        buffers = []
+        header_len = 0
+        for i, num in enumerate(nums):
+            offset = num * self.mss
+            header_len = pack_header_into(self.train_headers[i], TYPE_DICT["DATA"], self.data_isn + offset, self.wide_seq)
+            buffers.append(memoryview(self.train_headers[i])[:header_len])
+            buffers.append(self.file_view[offset:offset + self.segment_length(num)])
+        try:
+            self.sender_socket.sendmsg(buffers, [(SOL_UDP, UDP_SEGMENT, struct.pack("=H", header_len + self.mss))],
+                                       0, self.receiver_address)
+        except OSError:
+            logging.debug("UDP_SEGMENT send failed, back to one datagram per sendto")
+            self.gso = False
+            self.send_train(nums)
+            return
+        for num in nums:
+            self.in_flight[num][1] += 1
+            self.send_counter += 1
+            self.metrics.add("segments_sent")
+            self.metrics.add("bytes_sent", self.segment_length(num))
+            self.trace.record(EVENT_SND, TYPE_DICT["DATA"], self.wire_seq(num * self.mss), self.segment_length(num))
+        self.metrics.add("gso_trains")
 
 
+    def send_parity(self, nums):
+        '''
+        Send the parity segments of the groups completed by these new segments. Parity j of a group is the XOR of its
+        segments j, j + m, j + 2m ..., so a burst of up to m lost segments can be rebuilt by the receiver. Parity
+        segments are never resent and are not counted in the window.
+        '''
+        # caller holds window_cond
+        if not self.fec_k:
+            return
+        for num in nums:
+            if (num + 1) % self.fec_k and num != self.packets_num - 1:
+                continue
+            first = num - num % self.fec_k
+            group = range(first, num + 1)
+            for index in range(self.fec_m):
+                members = group[index::self.fec_m]
+                if not members:
+                    break
+                parity = xor_payloads((self.file_view[n * self.mss:n * self.mss + self.segment_length(n)]
+                                       for n in members), self.mss)
+                self.sender_socket.sendto(pack_header(TYPE_DICT["PARITY"], self.data_isn + first * self.mss,
+                                                      self.wide_seq) +
+                                          struct.pack(PARITY_FORMAT, self.fec_k, self.fec_m, index, self.mss) +
+                                          parity.to_bytes(self.mss, byteorder='big'), self.receiver_address)
+                self.trace.record(EVENT_SND, TYPE_DICT["PARITY"], self.wire_seq(first * self.mss), self.mss)
+                self.metrics.add("parity_sent")
+            self.parity_marks[first] = self.next_num
+
+
+    def fec_pending(self, num):
+        '''
+        :return: True while the parity of the group of num may still rebuild it at the receiver
+        '''
+        # caller holds window_cond
+        first = num - num % self.fec_k
+        mark = self.parity_marks.get(first)
+        if mark is None:
+            # the group is not complete, its parity goes out only if the rest of the group fits in the window
+            return (min(first + self.fec_k, self.packets_num) - self.send_base) * self.mss <= self.cc.window
+        if mark < 0:
+            return False  # the receiver reported the parity after acking what it could rebuild
+        # segments sent after the parity arrived while num is still missing: the parity is lost or not enough
+        return sum(sacked >= mark for sacked in self.sacked_num) < DUP_ACK_THRESHOLD
+
+
+    def fec_report(self, offset, missing, covered):
+        '''
+        The receiver's report of one parity segment. The parity count follows the loss rate seen by the receiver:
+        about two parity segments per expected loss in a group.
+        :param offset: the first offset of the group
+        :param missing: segments of the parity that had not arrived with it, rebuilt or not
+        :param covered: segments covered by the parity
+        '''
+        # caller holds window_cond
+        first = offset // self.mss
+        if first + self.fec_k > self.send_base:
+            self.parity_marks[first] = -1
+            if self.deferred_num is not None and self.deferred_num - self.deferred_num % self.fec_k == first:
+                self.fast_retransmit(self.deferred_num)
+        self.fec_lost += missing
+        self.fec_observed += covered
+        if self.fec_observed < FEC_ADAPT_SEGMENTS:
+            return
+        loss_rate = self.fec_lost / self.fec_observed
+        self.fec_lost = self.fec_observed = 0
+        fec_m = min(max(math.ceil(2 * loss_rate * self.fec_k), 1), FEC_MAX_PARITY, self.fec_k)
+        if fec_m != self.fec_m:
+            self.fec_m = fec_m
+            logging.warning(f"fec\t{round(loss_rate, 4)}\tloss rate, {fec_m} parity per {self.fec_k} segments")
+
+
+    def ack_dispatcher(self):
+        '''
+        The only reader of the socket during the DATA phase: every ACK is applied to the shared in-flight table.
+        '''
+        while self._is_active and not self.data_acked:
+            try:
+                incoming_message, _ = self.sender_socket.recvfrom(BUFFERSIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            rev_type_no, rev_ack_no, payload_start = unpack_header(incoming_message, self.wide_seq)
+            self.trace.record(EVENT_RCV, rev_type_no, rev_ack_no)
+            if rev_type_no == TYPE_DICT["PARITY"] and len(incoming_message) >= payload_start + 2:
+                # the loss report of one parity segment
+                with self.window_cond:
+                    base_seq = self.data_isn + self.send_base * self.mss
+                    self.fec_report(unwrap_seq(rev_ack_no, base_seq, self.wide_seq) - self.data_isn,
+                                    incoming_message[payload_start], incoming_message[payload_start + 1])
+                continue
+            if rev_type_no != TYPE_DICT["ACK"]:
+                continue
+            self.metrics.add("acks_received")
+            rwnd = None
+            if self.rwnd_ack:
+                rwnd = int.from_bytes(incoming_message[payload_start:payload_start + RWND_LEN], byteorder='big')
+                payload_start += RWND_LEN
+            # SACK blocks: [start, end) pairs of segments buffered by the receiver above the cumulative ACK
+            sack_blocks = unpack_sack(incoming_message[payload_start:], self.wide_seq)
+            with self.window_cond:
+                # unwrap against the window base, the only reference both sides agree on
+                base_seq = self.data_isn + self.send_base * self.mss
+                ack_offset = unwrap_seq(rev_ack_no, base_seq, self.wide_seq) - self.data_isn
+                if rwnd is not None and ack_offset >= self.rwnd_ack_offset:  # not from a reordered older ACK
+                    self.rwnd_ack_offset = ack_offset
+                    self.rwnd_edge = ack_offset + rwnd
+                self.ack_window(ack_offset)
+                if sack_blocks:
+                    self.sack_window([(unwrap_seq(start, base_seq, self.wide_seq) - self.data_isn,
+                                       unwrap_seq(end, base_seq, self.wide_seq) - self.data_isn)
+                                      for start, end in sack_blocks])
+                self.window_cond.notify()
+
+
+    def ack_window(self, ack_offset):
+        # caller holds window_cond
+        # the ACK is cumulative: everything below ack_offset has been received
+        num = self.segment_num(ack_offset)
+        if num is None:
+            return
+        if num == self.send_base and self.in_flight:
+            self.dup_ack()
+            return
+        num -= 1  # the newest acked segment
+        if num < self.send_base or num >= self.next_num:
+            return  # old or out of the window
+        now = time.time()
+        # Karn's rule: skip samples from resent segments, and from an ACK that waited for a resent hole below num
+        # or for the arrival of segments other than num (already selectively acked)
+        sample = num in self.in_flight and num not in self.sacked_num
+        acked_bytes = 0
+        for acked_num in range(self.send_base, num + 1):
+            if acked_num in self.in_flight:
+                sample = sample and self.in_flight[acked_num][1] == 1
+                acked_bytes += self.segment_length(acked_num)
+                if acked_num == num and sample:
+                    self.update_rto(now - self.in_flight[num][0])
+                del self.in_flight[acked_num]
+            self.sacked_num.discard(acked_num)
+        self.metrics.add("bytes_delivered", acked_bytes)
+        self.metrics.observe_occupancy(self.bytes_in_flight, self.cc.window)
+        self.bytes_in_flight -= acked_bytes
+        self.send_base = num + 1
+        self.dup_acks = 0
+        self.deferred_num = None
+        for first in [first for first in self.parity_marks if first + self.fec_k <= self.send_base]:
+            del self.parity_marks[first]
+        if self.recover_num is None:
+            self.cc.on_ack(acked_bytes, now, self.srtt)
+        elif self.send_base >= self.recover_num:
+            # full ACK, everything sent before the loss is acked
+            self.recover_num = None
+            self.cc.exit_recovery()
+        elif self.send_base < self.next_num:
+            # partial ACK (NewReno): the next hole is lost too, repair it without waiting for the timer
+            self.cc.on_partial_ack(acked_bytes)
+            self.fast_retransmit(self.send_base)
+        self.log_cwnd()
+        if self.send_base == self.packets_num:
+            self.data_acked = True
+
+
+    def dup_ack(self):
+        # caller holds window_cond
+        self.dup_acks += 1
+        self.metrics.add("dup_acks")
+        if self.recover_num is not None:
+            # every duplicate means one more segment has left the network, keep the pipe full
+            self.cc.on_dup_ack()
+            if self.deferred_num == self.send_base:
+                self.fast_retransmit(self.send_base)
+        elif self.dup_acks == DUP_ACK_THRESHOLD:
+            self.recover_num = self.next_num
+            self.cc.on_fast_loss(self.bytes_in_flight, time.time())
+            self.fast_retransmit(self.send_base)
+        self.log_cwnd()
+
+
+    def fast_retransmit(self, num):
+        # caller holds window_cond
+        if num in self.sacked_num:
+            return
+        if self.fec_k and self.fec_pending(num):
+            self.deferred_num = num
+            return
+        self.deferred_num = None
+        self.metrics.add("retransmits_fast")
+        logging.warning(f"Fast retransmit! Resend the DATA seq={self.wire_seq(num * self.mss)}, dup ACKs:{self.dup_acks}")
+        self.in_flight[num][0] = time.time()
+        self.send_DATA(num)
+
+
+    def log_cwnd(self):
+        # cwnd over time, one trace event per change of the effective window
+        window = self.cc.window
+        if window != self.logged_cwnd:
+            self.logged_cwnd = window
+            self.trace.record(EVENT_CWND, 0, 0, window)
+
+
+    def sack_window(self, sack_blocks):
+        # caller holds window_cond
+        # a selectively acked segment stays in the window until the cumulative ACK passes it but is never resent
+        for num in range(self.send_base, self.next_num):
+            if num in self.sacked_num:
+                continue
+            offset = num * self.mss
+            for start, end in sack_blocks:
+                if start <= offset < end:
+                    self.sacked_num.add(num)
+                    break
 
 
     def listen(self, sequence_number):
@@ -384,14 +719,14 @@ class Sender:
 
             try:
                 if data:
-                    incoming_message, _ = self.sender_socket.recvfrom(BUFFERSIZE)
-                    rev_type_no = int.from_bytes(incoming_message[:2], byteorder='big')
-                    rev_ack_no = int.from_bytes(incoming_message[2:4], byteorder='big')
+                    incoming_message, _ = self.sender_socket.recvfrom(SYN_BUFFERSIZE)
+                    rev_type_no, rev_ack_no, payload_start = unpack_header(incoming_message, self.wide_seq)
                     time_diff = round((time.time() - self.start_time) * 1000, 2)
-                    logging.warning(f"rcv\t{time_diff}\t{self.get_type_dict[rev_type_no]}\t{rev_ack_no}\t0")
-                    if rev_ack_no == sequence_number + 1:
+                    logging.warning(f"rcv\t{time_diff}\t{GET_TYPE_DICT[rev_type_no]}\t{rev_ack_no}\t0")
+                    if unwrap_seq(rev_ack_no, sequence_number + 1, self.wide_seq) == sequence_number + 1:
                         if not self.SYN_acked:
                             self.SYN_acked = True
+                            self.syn_options = unpack_options(incoming_message[payload_start:])
                             break
                         if self.SYN_acked and not self.FIN_acked:
                             self.FIN_acked = True
@@ -402,44 +737,285 @@ class Sender:
                 continue
 
 
-    # FIN
-    def send_FIN(self):
+    def handshake(self, type_name, sequence_number):
+        '''
+        Send a SYN/FIN and wait for its ACK, resending with a backed-off RTO until give_up_time runs out.
+        :return: True if the segment has been acked
+        '''
+        first_send_time = time.time()
+        send_times = 0
+        while True:
+            msg = pack_header(TYPE_DICT[type_name], sequence_number, self.wide_seq)
+            if type_name == "SYN":
+                msg += pack_options(self.syn_offer())
+            send_time = time.time()
+            self.sender_socket.sendto(msg, self.receiver_address)
+            self.send_counter += 1
+            send_times += 1
+            time_diff = round((send_time - self.start_time) * 1000, 2)
+            wire_seq_no = sequence_number if self.wide_seq else sequence_number % SEQ_MODULO
+            if type_name == "SYN" and send_times == 1:
+                logging.warning(f"snd\t0\tSYN\t{wire_seq_no}\t0")
+            else:
+                logging.warning(f"snd\t{time_diff}\t{type_name}\t{wire_seq_no}\t0")
+            self.listen(sequence_number)
+            if (self.FIN_acked if type_name == "FIN" else self.SYN_acked):
+                if send_times == 1:  # Karn's rule, an ACK of a resent segment is ambiguous
+                    self.update_rto(time.time() - send_time)
+                return True
+            self.backoff_rto()
+            time_left = self.give_up_time - (time.time() - first_send_time)
+            if time_left <= 0:
+                return False
+            logging.warning(f"Timeout! Resend the {type_name}, time left:{round(time_left, 2)}s")
+            self.metrics.add("handshake_retransmits")
+
+
+    def syn_offer(self):
+        # the SYN options proposed to the receiver
+        options = {OPT_FILE_SIZE: self.file_size.to_bytes(8, byteorder='big'),
+                   OPT_MSS: self.offer_mss.to_bytes(2, byteorder='big')}
+        if self.offer_wide_seq:
+            options[OPT_WIDE_SEQ] = b''
+        if self.offer_codecs:
+            options[OPT_COMPRESS] = bytes(self.offer_codecs)
+        if self.offer_fec:
+            options[OPT_FEC] = bytes([self.offer_fec])
+        options[OPT_RWND] = b''
+        if self.resume_token is not None:  # whole-file transfers only, like the delta sync
+            options[OPT_RESUME] = self.resume_token
+            options[OPT_DELTA] = b''
+        if self.files is not None:
+            options[OPT_FILES] = len(self.files).to_bytes(4, byteorder='big')
+        if self.striped is not None:
+            options[OPT_STRIPED] = struct.pack(STRIPED_FORMAT, *self.striped)
+        if self.stripe is not None:
+            options[OPT_STRIPE] = struct.pack(STRIPE_FORMAT, *self.stripe, self.file_range[0])
+        return options
+
+
+    def announce_files(self):
+        '''
+        Multi-file session: send the name, size and stream offset of every file in FILE segments, as many records as
+        fit in SEGMENT_SIZE bytes each, before the DATA stream starts.
+        :return: True if the receiver acked every FILE segment
+        '''
+        batches = {}
+        batch = []
+        batch_len = 8  # the key
+        offset = 0
+        for (_, name), size in zip(self.files, self.file_view.sizes):
+            record_len = struct.calcsize(FILE_RECORD_FORMAT) + len(name.encode())
+            if batch and batch_len + record_len > SEGMENT_SIZE:
+                batches[len(batches)] = pack_files(batch)
+                batch = []
+                batch_len = 8
+            batch.append((offset, size, name))
+            batch_len += record_len
+            offset += size
+        if batch:
+            batches[len(batches)] = pack_files(batch)
+        if self.exchange("FILE", "FILE", batches) is None:
+            return False
+        time_diff = round((time.time() - self.start_time) * 1000, 2)
+        logging.warning(f"files\t{time_diff}\t{len(self.files)}\tfiles\t{self.file_size}\tbytes announced")
+        return True
+
+
+    def probe_mss(self):
+        '''
+        Path MTU probe: the largest payload between SEGMENT_SIZE and the negotiated MSS that reaches the receiver
+        unfragmented, the negotiated MSS first, then a binary search.
+        '''
+        pmtu_discover = None
+        try:
+            pmtu_discover = self.sender_socket.getsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER)
+            self.sender_socket.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        except OSError:
+            logging.debug("IP_MTU_DISCOVER is not supported, probing with fragmentation allowed")
+        low, high = SEGMENT_SIZE, self.mss
         try:
-            dup = 3
-            while dup > 0:
-                msg = self.type_dict["FIN"].to_bytes(2, byteorder='big', signed=False) + \
-                      self.fin_seq.to_bytes(2, byteorder='big', signed=False)
+            if self.probe(high):
+                low = high
+            while high - low > PROBE_RESOLUTION:
+                size = (low + high) // 2
+                if self.probe(size):
+                    low = size
+                else:
+                    high = size - 1
+        finally:
+            if pmtu_discover is not None:
+                self.sender_socket.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, pmtu_discover)
+        time_diff = round((time.time() - self.start_time) * 1000, 2)
+        logging.warning(f"mss\t{time_diff}\t{low}")
+        return low
+
+
+    def probe(self, size):
+        '''
+        Send a PROBE segment with a payload of size bytes.
+        :return: True if the receiver echoed its size
+        '''
+        msg = pack_header(TYPE_DICT["PROBE"], size, self.wide_seq) + bytes(size)
+        for _ in range(PROBE_TRIES):
+            try:
                 self.sender_socket.sendto(msg, self.receiver_address)
-                self.send_counter += 1
-                time_diff = round((time.time() - self.start_time) * 1000, 2)
-                logging.warning(f"snd\t{time_diff}\tFIN\t{self.fin_seq}\t0")
-                self.listen(self.fin_seq)
-                if self.FIN_acked:
-                    self.ptp_close()
-                    logging.debug("socket closed")
+            except OSError:  # EMSGSIZE, larger than the path MTU known to the kernel
+                return False
+            self.send_counter += 1
+            deadline = time.time() + self.timeout
+            while time.time() < deadline:
+                data, _, _ = select.select([self.sender_socket], [], [], max(0, deadline - time.time()))
+                if not data:
                     break
-                else:
-                    dup -= 1
-                    logging.warning(f"Timeout! Resend the FIN, resent chances left:{dup}")
-            if dup == 0:
-                type = 4
-                no = 0
-                logging.warning("connected failed! Reset the connection.")
-                reset_msg = type.to_bytes(2, byteorder='big', signed=False) + no.to_bytes(2, byteorder='big', signed=False)
-                self.sender_socket.sendto(reset_msg, self.receiver_address)
-                self.send_counter += 1
-                time_diff = round((time.time() - self.start_time) * 1000, 2)
-                logging.warning(f"snd\t{time_diff}\tRESET\t\t0\t0")
+                incoming_message, _ = self.sender_socket.recvfrom(BUFFERSIZE)
+                rev_type_no, rev_seq_no, _ = unpack_header(incoming_message, self.wide_seq)
+                if rev_type_no == TYPE_DICT["PROBE"] and rev_seq_no == size:
+                    return True
+        return False
+
+
+    def delta_sync(self, option):
+        '''
+        Delta mode: fetch the block signatures of the receiver's copy, find its blocks in the file and send COPY
+        instructions for them. The receiver copies these ranges into the new file itself.
+        :param option: the OPT_DELTA echo, block size + size of the receiver's copy
+        :return: [(dst offset, src offset, length)] copies applied by the receiver, None if it stopped answering
+        '''
+        block_size = int.from_bytes(option[:4], byteorder='big')
+        basis_size = int.from_bytes(option[4:12], byteorder='big')
+        first_blocks = range(0, -(-basis_size // block_size), delta.SIG_BATCH)
+        replies = self.exchange("SIGREQ", "SIG", {first: b'' for first in first_blocks})
+        if replies is None:
+            return None
+        signatures = []
+        for first in first_blocks:
+            signatures += delta.unpack_signatures(replies[first])
+        copies = delta.match_blocks(self.file_view, block_size, signatures, basis_size, self.mss)
+        batches = {i: delta.pack_copies(copies[i:i + delta.COPY_BATCH]) for i in range(0, len(copies), delta.COPY_BATCH)}
+        if self.exchange("COPY", "COPY", batches) is None:
+            return None
+        time_diff = round((time.time() - self.start_time) * 1000, 2)
+        logging.warning(f"delta\t{time_diff}\t{sum(length for _, _, length in copies)}\tof\t{self.file_size}\tbytes copied by the receiver")
+        return copies
+
+
+    def exchange(self, type_name, reply_type_name, requests):
+        '''
+        Request/reply segments of the delta sync: the payload starts with an 8-byte key echoed by the reply. At most
+        EXCHANGE_WINDOW requests are unanswered at once, each one is resent after an RTO.
+        :param requests: key : payload following the key
+        :return: key : reply payload following the key, None if give_up_time passed without a reply
+        '''
+        pending = deque(requests)
+        sent = {}  # key : send_time
+        replies = {}
+        last_reply = time.time()
+        while pending or sent:
+            now = time.time()
+            while pending and len(sent) < EXCHANGE_WINDOW:
+                key = pending.popleft()
+                sent[key] = 0
+            expired = False
+            for key, send_time in sent.items():
+                if now - send_time >= self.timeout:
+                    expired = expired or send_time > 0
+                    sent[key] = now
+                    self.sender_socket.sendto(pack_header(TYPE_DICT[type_name], 0, self.wide_seq) +
+                                              key.to_bytes(8, byteorder='big') + requests[key], self.receiver_address)
+                    self.send_counter += 1
+            if expired:
+                self.backoff_rto()
+            if now - last_reply > self.give_up_time:
+                logging.warning(f"no {reply_type_name} within {self.give_up_time}s")
+                return None
+            deadline = min(sent.values()) + self.timeout
+            data, _, _ = select.select([self.sender_socket], [], [], max(0, deadline - time.time()))
+            while data:
+                incoming_message, _ = self.sender_socket.recvfrom(SYN_BUFFERSIZE)
+                rev_type_no, _, payload_start = unpack_header(incoming_message, self.wide_seq)
+                key = int.from_bytes(incoming_message[payload_start:payload_start + 8], byteorder='big')
+                if rev_type_no == TYPE_DICT[reply_type_name] and key in sent:
+                    del sent[key]
+                    replies[key] = incoming_message[payload_start + 8:]
+                    last_reply = time.time()
+                data, _, _ = select.select([self.sender_socket], [], [], 0)
+        return replies
+
+
+    def update_rto(self, rtt):
+        '''
+        RFC 6298 estimator: SRTT/RTTVAR smoothing, RTO = SRTT + max(G, 4 * RTTVAR), clamped to [MIN_RTO, MAX_RTO].
+        '''
+        self.metrics.observe_rtt(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(max(self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar), MIN_RTO), MAX_RTO)
+
+
+    def segment_rto(self, send_times):
+        # the timer of a segment sent send_times times, doubled by each of its retransmissions (RFC 6298 5.5)
+        return min(self.timeout * 2 ** max(send_times - 1, 0), MAX_RTO)
+
+
+    def backoff_rto(self):
+        # exponential backoff, kept until the next valid RTT sample
+        self.timeout = min(self.timeout * 2, MAX_RTO)
+
+
+    # FIN
+    def send_FIN(self):
+        try:
+            if self.handshake("FIN", self.fin_seq):
+                self.ptp_close()
+                logging.debug("socket closed")
+            else:
+                self.send_RESET()
                 self.ptp_close()
                 logging.warning("returned to the CLOSED state")
         except OSError:
             self.ptp_close()
 
 
+    def send_RESET(self):
+        logging.warning("connected failed! Reset the connection.")
+        reset_msg = pack_header(TYPE_DICT["RESET"], 0, self.wide_seq)
+        self.sender_socket.sendto(reset_msg, self.receiver_address)
+        self.send_counter += 1
+        time_diff = round((time.time() - self.start_time) * 1000, 2)
+        logging.warning(f"snd\t{time_diff}\tRESET\t\t0\t0")
+
+
+    def metrics_snapshot(self):
+        '''
+        :return: the metrics of the connection and the current state of its window, as a JSON-ready dict
+        '''
+        snapshot = self.metrics.snapshot()
+        snapshot.update(cwnd=self.cc.window, srtt=self.srtt, rto=self.timeout, mss=self.mss,
+                        bytes_in_flight=self.bytes_in_flight, file_size=self.file_size, data_acked=self.data_acked, fin_acked=self.FIN_acked)
+        return snapshot
+
+
     def ptp_close(self):
-        time.sleep(2)
+        # called on every way out of the connection, only the first call closes
+        if self.closed:
+            return
+        self.closed = True
+        self.metrics.finish()
+        logging.warning(f"summary\t{json.dumps(self.metrics_snapshot())}")
+        if self.metrics_dumper is not None:
+            self.metrics_dumper.stop()
         self._is_active = False  # close the sub-thread
         self.sender_socket.close()
+        if self.file_map is not None:
+            self.file_view.release()
+            self.file_map.close()
+            self.file_map = None
+        self.trace.close()
         # logging.debug(f"send_counter = {self.send_counter}")
 
 
@@ -450,6 +1026,159 @@ class Sender:
         self.ptp_close()
 
 
+class FileChain:
+    '''
+    The files of a multi-file session as one read-only stream, sliced like the memoryview of a single file: a slice
+    inside one file is a memoryview of its map, only a slice across two files is copied.
+    '''
+    def __init__(self, filenames) -> None:
+        self.sizes = []  # of every file, in order
+        self.starts = []  # stream offset of every non-empty file, for the bisection
+        self.maps = []
+        self.views = []
+        self.size = 0
+        for filename in filenames:
+            with open(filename, "rb") as file:
+                size = os.fstat(file.fileno()).st_size
+                if size > 0:  # an empty file cannot be mapped
+                    self.starts.append(self.size)
+                    self.maps.append(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+                    self.views.append(memoryview(self.maps[-1]))
+            self.sizes.append(size)
+            self.size += size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, item: slice):
+        start, stop, _ = item.indices(self.size)
+        parts = []
+        i = bisect.bisect_right(self.starts, start) - 1
+        while start < stop:
+            part = self.views[i][start - self.starts[i]:stop - self.starts[i]]
+            parts.append(part)
+            start += len(part)
+            i += 1
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def release(self) -> None:
+        for view in self.views:
+            view.release()
+
+    def close(self) -> None:
+        for file_map in self.maps:
+            file_map.close()
+
+
+def collect_files(path: str, file_list: bool = False):
+    '''
+    The files of a multi-file session.
+    :param path: a directory, every file under it is sent with its path relative to it, or with file_list a text file
+        naming one file per line, sent by its relative path (by its base name if absolute or outside the directory).
+    :return: [(path, name)] with / separated names
+    :raise ValueError: if two files would get the same name
+    '''
+    if file_list:
+        with open(path) as file:
+            paths = [line.strip() for line in file if line.strip()]
+        names = [os.path.normpath(p) for p in paths]
+        names = [os.path.basename(n) if os.path.isabs(n) or n.startswith("..") else n for n in names]
+    else:
+        paths = []
+        for root, dirs, filenames in os.walk(path):
+            dirs.sort()
+            paths += [os.path.join(root, filename) for filename in sorted(filenames)]
+        names = [os.path.relpath(p, path) for p in paths]
+    files = [(p, name.replace(os.sep, "/")) for p, name in zip(paths, names)]
+    named = {}
+    for p, name in files:
+        if name in named:
+            raise ValueError(f"{named[name]} and {p} would both be sent as {name}")
+        named[name] = p
+    return files
+
+
+def run_stripe(index: int, sender_kwargs: dict) -> None:
+    '''
+    Entry point of a stripe process: a plain Sender restricted to its byte range, logging to its own file.
+    '''
+    logging.basicConfig(
+        filename=f"Sender_log_{index}.txt",
+        level=logging.WARNING,
+        format='%(asctime)s,%(msecs)03d %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d:%H:%M:%S',
+        force=True)
+    if sender_kwargs.get("metrics_file"):
+        stem, ext = os.path.splitext(sender_kwargs["metrics_file"])
+        sender_kwargs = dict(sender_kwargs, metrics_file=f"{stem}_{index}{ext}")
+    sender = Sender(**sender_kwargs, trace_file=f"Sender_trace_{index}.bin")
+    sender.run()
+    sys.exit(0 if sender.FIN_acked else 1)
+
+
+class StripedSender:
+    '''
+    Sends one file as N byte ranges over N flows, each one a Sender in its own process with its own port, window and
+    timers. A control flow on sender_port announces the transfer in its SYN, and its FIN, sent once every stripe
+    has been acked, confirms the completion to the receiver.
+    '''
+    def __init__(self, sender_port: int, receiver_port: int, filename: str, max_win: int, rot: int, stripes: int,
+                 **sender_kwargs) -> None:
+        '''
+        :param stripes: the number of stripes, they use the ports following sender_port.
+        :param sender_kwargs: the Sender options shared by the control flow and the stripes.
+        '''
+        self.stripes = int(stripes)
+        self.transfer_id = random.getrandbits(32)
+        self.stripe_kwargs = dict(receiver_port=receiver_port, filename=filename, max_win=max_win, rot=rot,
+                                  **sender_kwargs)
+        self.control = Sender(sender_port, receiver_port, filename, max_win, rot,
+                              striped=(self.transfer_id, self.stripes), **sender_kwargs)
+        self.completed = False
+
+    def stripe_ranges(self, file_size):
+        # whole segments per stripe, the last one takes the rest
+        per_stripe = -(-file_size // SEGMENT_SIZE // self.stripes) * SEGMENT_SIZE or SEGMENT_SIZE
+        return [(start, min(start + per_stripe, file_size)) for start in range(0, file_size, per_stripe)]
+
+    def run(self) -> None:
+        control = self.control
+        if not control.ptp_open():
+            control.send_RESET()
+            control.ptp_close()
+            logging.warning("returned to the CLOSED state")
+            return
+        if OPT_STRIPED not in control.syn_options:
+            logging.warning("the receiver does not accept striped transfers, run it with --server")
+            control.send_RESET()
+            control.ptp_close()
+            return
+
+        processes = []
+        for index, file_range in enumerate(self.stripe_ranges(control.file_size)):
+            sender_kwargs = dict(self.stripe_kwargs, sender_port=control.sender_port + 1 + index,
+                                 file_range=file_range,
+                                 stripe=(self.transfer_id, control.sender_port, index))
+            processes.append(multiprocessing.Process(target=run_stripe, args=(index, sender_kwargs)))
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        failed = [index for index, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            logging.warning(f"stripes {failed} failed, the transfer is reset")
+            control.send_RESET()
+            control.ptp_close()
+            return
+        control.send_FIN()
+        self.completed = control.FIN_acked
+        logging.warning(f"striped transfer of {control.file_size} bytes over {len(processes)} flows "
+                        f"{'completed' if self.completed else 'failed'}")
+
+
 if __name__ == '__main__':
     logging.basicConfig(
         filename="Sender_log.txt",
@@ -458,12 +1187,67 @@ if __name__ == '__main__':
         format='%(asctime)s,%(msecs)03d %(levelname)-8s %(message)s',
         datefmt='%Y-%m-%d:%H:%M:%S')
 
-    if len(sys.argv) != 6:
-        print(
-            "\n===== Error usage, python3 sender.py sender_port receiver_port FileReceived.txt max_win rot ======\n")
-        exit(0)
-
-    sender = Sender(*sys.argv[1:])
-
-    sender.run()
+    parser = argparse.ArgumentParser(usage="python3 sender.py sender_port receiver_port FileToSend.txt max_win rot [options]")
+    parser.add_argument("sender_port", type=int)
+    parser.add_argument("receiver_port", type=int)
+    parser.add_argument("filename")
+    parser.add_argument("max_win", type=int)
+    parser.add_argument("rot", type=int, help="initial retransmission timer in milliseconds")
+    parser.add_argument("--give-up-time", type=float, default=GIVE_UP_TIME,
+                        help="seconds without an ACK before the connection is reset")
+    parser.add_argument("--cc", choices=sorted(CONTROLLERS), default="reno",
+                        help="congestion controller, the window never exceeds max_win")
+    parser.add_argument("--gso", action="store_true",
+                        help="send trains of segments in one call with UDP_SEGMENT when the kernel supports it")
+    parser.add_argument("--stripes", type=int, default=1,
+                        help="split the file into this many ranges, each sent by its own process from the next ports")
+    parser.add_argument("--mss", type=int, default=SEGMENT_SIZE,
+                        help=f"DATA payload size offered in the SYN, up to {MAX_MSS}")
+    parser.add_argument("--pmtu-probe", action="store_true",
+                        help="probe the largest segment that reaches the receiver, up to the negotiated MSS")
+    parser.add_argument("--compress", choices=sorted(CODEC_IDS),
+                        help="offer per-segment compression with this codec (zlib as the fallback)")
+    parser.add_argument("--fec", type=int, default=0, metavar="K",
+                        help="send XOR parity segments after every K segments (2 to 255), adapted to the loss rate")
+    parser.add_argument("--pacing", action="store_true",
+                        help="spread the segments of each window over the RTT instead of sending it as a burst")
+    parser.add_argument("--sndbuf", type=int, help="SO_SNDBUF of the socket in bytes")
+    parser.add_argument("--rcvbuf", type=int, help="SO_RCVBUF of the socket in bytes")
+    parser.add_argument("--trace", choices=TRACE_MODES, default="binary",
+                        help="per-segment events: binary records in Sender_trace.bin (render them with ptptrace.py), "
+                             "text lines in Sender_log.txt, or off")
+    parser.add_argument("--trace-sample", type=int, default=1, metavar="N",
+                        help="keep one per-segment event out of N")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="dump the transfer metrics as JSON to this file every --metrics-interval seconds")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL)
+    parser.add_argument("--narrow-seq", action="store_true",
+                        help="do not offer 64-bit sequence numbers, keep the 2-byte header")
+    parser.add_argument("--file-list", action="store_true",
+                        help="FileToSend.txt lists the files to send, one per line, over one connection "
+                             "(a directory is always sent this way)")
+    args = parser.parse_args()
+    if args.fec and not 2 <= args.fec <= 255:
+        parser.error("--fec takes a group size of 2 to 255")
+    files = None
+    if args.file_list or os.path.isdir(args.filename):
+        if args.stripes > 1:
+            parser.error("--stripes sends a single file")
+        try:
+            files = collect_files(args.filename, args.file_list)
+        except ValueError as error:
+            parser.error(str(error))
+
+    sender_kwargs = dict(give_up_time=args.give_up_time, wide_seq=not args.narrow_seq, cc=args.cc, gso=args.gso,
+                         mss=args.mss, pmtu_probe=args.pmtu_probe, compress=args.compress,
+                         fec=args.fec, pacing=args.pacing, sndbuf=args.sndbuf, rcvbuf=args.rcvbuf,
+                         trace=args.trace, trace_sample=args.trace_sample, metrics_file=args.metrics,
+                         metrics_interval=args.metrics_interval)
+    if args.stripes > 1:
+        StripedSender(args.sender_port, args.receiver_port, args.filename, args.max_win, args.rot, args.stripes,
+                      **sender_kwargs).run()
+    else:
+        sender = Sender(args.sender_port, args.receiver_port, args.filename, args.max_win, args.rot, files=files,
+                        **sender_kwargs)
+        sender.run()
 
@@ -0,0 +1,53 @@
+'''
+End-to-end transfers of the asyncio implementation on loopback, directly and through the impairment proxy.
+'''
+import asyncio
+import random
+import socket
+
+import pytest
+
+from aioptp import receive_file, send_file
+from impair import ImpairmentProxy, Link
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def transfer(source, target, receiver_port, sender_port):
+    receiving = asyncio.ensure_future(receive_file(str(target), ("127.0.0.1", receiver_port)))
+    await asyncio.sleep(0.05)  # the receiver is listening
+    sent = await send_file(str(source), ("127.0.0.1", sender_port), max_win=64000, rot=50)
+    received = await asyncio.wait_for(receiving, 10)
+    return sent, received
+
+
+@pytest.mark.parametrize("size", [0, 999, 1000, 300000])
+def test_transfer(tmp_path, size):
+    source = tmp_path / "in.bin"
+    source.write_bytes(random.Random(size).randbytes(size))
+    target = tmp_path / "out.bin"
+    port = free_port()
+    sent, received = asyncio.run(transfer(source, target, port, port))
+    assert sent == received == size
+    assert target.read_bytes() == source.read_bytes()
+
+
+def test_transfer_lossy(tmp_path):
+    # losses and reordering in both directions, the out-of-order segments go through the reassembly ring
+    source = tmp_path / "in.bin"
+    source.write_bytes(random.Random(1).randbytes(500000))
+    target = tmp_path / "out.bin"
+    receiver_port, proxy_port = free_port(), free_port()
+    proxy = ImpairmentProxy(proxy_port, receiver_port, Link(loss=0.03, reorder=0.05, reorder_delay=3, seed=1),
+                            Link(loss=0.03, seed=2))
+    proxy.start()
+    try:
+        sent, received = asyncio.run(transfer(source, target, receiver_port, proxy_port))
+    finally:
+        proxy.stop()
+    assert sent == received == 500000
+    assert target.read_bytes() == source.read_bytes()
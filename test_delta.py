@@ -0,0 +1,54 @@
+'''
+The block matching of the delta sync: the sender's file against the signatures of the receiver's copy.
+'''
+import random
+
+import delta
+
+
+def copies(new, old, block_size=1024, mss=256):
+    sigs = delta.unpack_signatures(delta.block_signatures(memoryview(old), block_size, 0, len(old)))
+    return delta.match_blocks(memoryview(new), block_size, sigs, len(old), mss)
+
+
+def rebuild(new, old, result):
+    # the receiver's side: the copies from the old version, the rest from the new one as DATA
+    out = bytearray(new)
+    for dst, src, length in result:
+        assert new[dst:dst + length] == old[src:src + length]
+        out[dst:dst + length] = old[src:src + length]
+    return bytes(out)
+
+
+def test_identical():
+    old = random.Random(1).randbytes(10000)
+    assert copies(old, old) == [(0, 0, 10000)]  # the short last block included
+
+
+def test_nothing_in_common():
+    assert copies(random.Random(1).randbytes(8192), random.Random(2).randbytes(8192)) == []
+
+
+def test_edit_in_the_middle():
+    old = random.Random(1).randbytes(8192)
+    new = old[:4000] + b'edit' + old[4004:]
+    result = copies(new, old)
+    assert rebuild(new, old, result) == new
+    assert sum(length for _, _, length in result) >= 8192 - 2048
+    for dst, _, length in result:  # cut to whole segments, except at the end of the file
+        assert dst % 256 == 0 and (length % 256 == 0 or dst + length == len(new))
+
+
+def test_insertion_shifts_the_blocks():
+    # the rolling hash finds the blocks again after bytes are inserted
+    old = random.Random(1).randbytes(8192)
+    new = old[:1000] + b'inserted' + old[1000:]
+    result = copies(new, old)
+    assert rebuild(new, old, result) == new
+    assert any(src != dst for dst, src, _ in result)
+    assert sum(length for _, _, length in result) >= 8192 - 2048
+
+
+def test_copies_roundtrip():
+    result = [(0, 4096, 1024), (2048, 0, 512)]
+    assert delta.unpack_copies(delta.pack_copies(result)) == result
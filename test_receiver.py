@@ -0,0 +1,63 @@
+'''
+The reassembly ring of the receiver: runs merged as they touch, released in offset order, payloads that do not fit
+refused.
+'''
+from receiver import ReassemblyRing
+
+
+def released(ring, upto):
+    return [(offset, bytes(view)) for offset, view in ring.release(upto)]
+
+
+def test_in_order():
+    ring = ReassemblyRing(10)
+    assert ring.put(0, b'abc') and ring.put(3, b'def')
+    assert ring.runs == {0: 6}
+    assert released(ring, 6) == [(0, b'abcdef')]
+    assert ring.held == 0 and ring.floor is None and ring.ceiling is None
+
+
+def test_out_of_order_merge():
+    ring = ReassemblyRing(10)
+    assert ring.put(6, b'gh') and ring.put(0, b'abc') and ring.put(3, b'def')
+    assert ring.runs == {0: 8}
+    assert ring.held == 8
+
+
+def test_release_below_upto():
+    ring = ReassemblyRing(10)
+    ring.put(0, b'abcd')
+    ring.put(6, b'gh')
+    assert released(ring, 2) == [(0, b'ab')]
+    assert ring.runs == {2: 4, 6: 8}
+    assert ring.floor == 2 and ring.ceiling == 8
+
+
+def test_wrap_around():
+    ring = ReassemblyRing(10)
+    ring.put(0, b'0123456')
+    assert released(ring, 7) == [(0, b'0123456')]
+    assert ring.put(7, b'789abc')
+    assert released(ring, 13) == [(7, b'789'), (10, b'abc')]
+
+
+def test_refused_above_the_floor():
+    ring = ReassemblyRing(10)
+    assert ring.put(5, b'ABCDE')
+    assert ring.put(12, b'xyz')  # [5, 15) still spans the ring
+    assert not ring.put(15, b'!')
+    assert released(ring, 20) == [(5, b'ABCDE'), (12, b'xyz')]
+
+
+def test_refused_below_the_floor():
+    # a payload under the floor must not overwrite held bytes at the same ring positions
+    ring = ReassemblyRing(10)
+    assert ring.put(5, b'ABCDE') and ring.put(10, b'FGHI')
+    assert not ring.put(2, b'xyz')
+    assert released(ring, 20) == [(5, b'ABCDE'), (10, b'FGHI')]  # cut where the ring wraps
+
+
+def test_empty_payload():
+    ring = ReassemblyRing(10)
+    assert not ring.put(0, b'')
+    assert ring.view is None